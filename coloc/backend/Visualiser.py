@@ -1,17 +1,134 @@
 import matplotlib.pyplot as plt
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
 import numpy as np
-import math
+from threadpoolctl import threadpool_limits
 try:
     from backend.preprocessingclass import do_preprocess
+    from backend.classes import scale_frame, thresholded_frames
+    from backend.metrics import channel_pair, coloc_accumulator, \
+        coloc_metrics
+    from backend.cache import file_digest, stage_cache
+    from backend.stream import stream_pipeline
+    from backend.render import overlay_ica, overlay_kmeans, render_panels, \
+        save_png
+    from backend.results import frame_record, load_results, results_writer
+    from backend.instrument import file_size, run_log
+    from backend.volume import match_points, volume_colocalisation, \
+        write_objects, z_scale
+    from backend.spots import detect_spots
 except ModuleNotFoundError:
     from ..backend.preprocessingclass import do_preprocess
+    from ..backend.classes import scale_frame, thresholded_frames
+    from ..backend.metrics import channel_pair, coloc_accumulator, \
+        coloc_metrics
+    from ..backend.cache import file_digest, stage_cache
+    from ..backend.stream import stream_pipeline
+    from ..backend.render import overlay_ica, overlay_kmeans, \
+        render_panels, save_png
+    from ..backend.results import frame_record, load_results, \
+        results_writer
+    from ..backend.instrument import file_size, run_log
+    from ..backend.volume import match_points, volume_colocalisation, \
+        write_objects, z_scale
+    from ..backend.spots import detect_spots
+import copy
+import multiprocessing
+from multiprocessing import shared_memory
 import os
+import queue
+from functools import partial
 
+# Largest number of foreground pixels clustered with full KMeans, and with
+# KMeans on a subsample, when the clustering mode is chosen automatically.
+KMEANS_MAX_POINTS = 20000
+SUBSAMPLE_MAX_POINTS = 500000
+# Largest relative change in foreground pixel count between slices for which
+# clustering is warm-started from the previous slice's centroids.
+WARM_START_MAX_CHANGE = 0.2
+# Clustering backends accepted by fit_clusters.
+CLUSTER_MODES = ('auto', 'kmeans', 'subsample', 'minibatch', 'spots')
+# Values of the settings of run_visualiser which are not given.
+DEFAULT_PARAMS = {
+    'threshold': 0.5,
+    'channels': [0, 1],
+    'num_clusts': 10,
+    'min_dist': 20,
+    'dtype': 'float64',
+    'lazy': False,
+    'cluster_mode': 'auto',
+    'warm_start': False,
+    'n_workers': 1,
+    'cache_dir': None,
+    'cache_size': 2 * 1024**3,
+    'stream': False,
+    'window': 8,
+    'renderer': 'fast',
+    'png_compression': 1,
+    'render': 'all',
+    'keep_images': False,
+    'export': ['csv', 'json', 'npz'],
+    'run_log': True,
+    'profile_stage': None,
+    'mode': 'slices',
+    'scale': None,
+    'z_step': None,
+    'connectivity': 1,
+    'min_voxels': 1
+}
+# Pairs of colocalised centroids returned by compare_dists.
+MATCH_DTYPE = np.dtype([('index1', int), ('index2', int),
+                        ('distance', float), ('centroid', int, (2,))])
 
-def correlate(denoised, channels, num_clusts):
+
+def ica_stack(stack, channels, num_clusts, block=16):
+    """Intensity Correlation Analysis (ICA) over a whole stack. The ICA product
+    (chan1 - mean1)*(chan2 - mean2) is computed for every pixel of every frame
+    at once, and the top num_clusts pixels of each frame are found with a
+    partial selection rather than a full sort.
+
+    :param stack: Image data
+    :type stack: numpy array of shape (height x width x channels x frames)
+    :param channels: List of indices referring to the populated channels in
+    the data
+    :type channels: list of integers of length 2
+    :param num_clusts: Number of clusters to output per frame
+    :type num_clusts: integer
+    :param block: Number of frames to process at a time, which bounds the
+    memory used, defaults to 16
+    :type block: integer, optional
+    :return sums: Total fluorescence overlap of each frame
+    :type sums: numpy array of shape (frames,)
+    :return peaks: (row, column) coordinates of the top num_clusts pixels of
+    each frame, in ascending order of ICA value
+    :type peaks: numpy array of shape (frames x num_clusts x 2)
+    """
+    if len(channels) != 2:
+        raise ValueError("ICA compares exactly two channels")
+    height, width, _, depth = np.shape(stack)
+    sums = np.empty(depth)
+    peaks = np.empty((depth, num_clusts, 2), dtype=int)
+    for start in range(0, depth, block):
+        frames = slice(start, min(start + block, depth))
+        chan1, chan2 = [np.array(stack[:, :, c, frames], dtype=np.float64)
+                        for c in channels]
+        # Compute ICA between two channels for every pixel, in place
+        chan1 -= chan1.mean(axis=(0, 1))
+        chan2 -= chan2.mean(axis=(0, 1))
+        chan1 *= chan2
+        sums[frames] = chan1.sum(axis=(0, 1))
+        # Pull out the locations of the top n max values of each frame
+        flat = chan1.reshape(height * width, -1)
+        top = np.argpartition(flat, -num_clusts, axis=0)[-num_clusts:]
+        order = np.argsort(np.take_along_axis(flat, top, axis=0), axis=0)
+        top = np.take_along_axis(top, order, axis=0)
+        rows, cols = np.unravel_index(top.T, (height, width))
+        peaks[frames] = np.stack([rows, cols], axis=-1)
+    return sums, peaks
+
+
+def correlate(denoised, channels, num_clusts, return_sum=False):
     """Returns the centres of clusters based on Intensity Correlation Analysis
-    (ICA).
+    (ICA) of a single frame.
 
     :param preprocessed: Preprocessed image data
     :type preprocessed: numpy array
@@ -20,58 +137,130 @@ def correlate(denoised, channels, num_clusts):
     :type channels: list of integers of length 2
     :param num_clusts: Number of clusters to output
     :type num_clusts: integer
-    :return out: Intensity Correlation Analysis (ICA) array for every pixel in
-    the image.
-    :type out: numpy array
+    :param return_sum: Also return the total fluorescence overlap, defaults
+    to False
+    :type return_sum: bool, optional
     :return clusts: List of (x, y) coordinates of cluster centres.
     :type clusts: List of tuples.
+    :return total: Total fluorescence overlap, if return_sum is True
+    :type total: float
     """
     chan1, chan2 = [denoised[:, :, c] for c in channels]
-    shape = np.shape(chan1)
-    if np.shape(chan2) != shape:
+    if np.shape(chan2) != np.shape(chan1):
         raise ValueError("Input arrays must have the same shape")
 
     if np.array_equal(chan1, chan2):
         raise ValueError("Input channels are identical")
 
-    mu1 = np.mean(chan1)
-    mu2 = np.mean(chan2)
-
-    out = np.zeros(shape)
-    for x in range(shape[0]):
-        for y in range(shape[1]):
-            # Compute ICA between two channels for each pixel
-            out[x, y] = (chan1[x, y] - mu1)*(chan2[x, y] - mu2)
-    print("\tTotal fluorescence overlap: {:.2e}".format(np.sum(out)))
-    # Pull out the locations of the top n max values
-    idx = np.unravel_index(np.argsort(out.ravel())[-num_clusts:], shape)
+    sums, peaks = ica_stack(denoised[..., np.newaxis], channels, num_clusts)
+    print("\tTotal fluorescence overlap: {:.2e}".format(sums[0]))
     # Convert to tuple of coordinates
-    clusts = [(idx[0][i], idx[1][i]) for i in range(num_clusts)]
+    clusts = [(x, y) for x, y in peaks[0]]
+    if return_sum:
+        return clusts, float(sums[0])
     return clusts
 
 
-def fit_clusters(im, num_clusters):
+def select_cluster_mode(n_points):
+    """Choose the clustering backend from the number of foreground pixels.
+
+    :param n_points: Number of foreground pixels
+    :type n_points: int
+    :return: 'kmeans', 'subsample' or 'minibatch'
+    :rtype: string
+    """
+    if n_points <= KMEANS_MAX_POINTS:
+        return 'kmeans'
+    elif n_points <= SUBSAMPLE_MAX_POINTS:
+        return 'subsample'
+    return 'minibatch'
+
+
+def stratified_subsample(points, shape, size, grid=16, random_state=None):
+    """Draw a random subsample of points which keeps the share of points in
+    each cell of a grid x grid tiling of the image.
+
+    :param points: (x, y) coordinates of foreground pixels
+    :type points: numpy array of shape (n x 2)
+    :param shape: Shape of the image
+    :type shape: tuple of int
+    :param size: Approximate number of points to keep
+    :type size: int
+    :param grid: Number of tiles along each side, defaults to 16
+    :type grid: int, optional
+    :param random_state: Seed for the random number generator
+    :type random_state: int, optional
+    :return: Subsample of the points
+    :rtype: numpy array of shape (m x 2)
+    """
+    n = len(points)
+    if n <= size:
+        return points
+    rng = np.random.default_rng(random_state)
+    tiles = (points[:, 0]*grid//shape[0])*grid + points[:, 1]*grid//shape[1]
+    # Shuffle the points within each tile and keep the first share of each
+    order = np.lexsort((rng.random(n), tiles))
+    counts = np.bincount(tiles, minlength=grid*grid)
+    starts = np.cumsum(counts) - counts
+    sorted_tiles = tiles[order]
+    rank = np.arange(n) - starts[sorted_tiles]
+    keep = rank < np.ceil(counts[sorted_tiles]*size/n)
+    return points[order[keep]]
+
+
+def fit_clusters(im, num_clusters, mode='auto', warm=None):
     """Fits a series of k-means clusters using Scikit-Learn.
     :param im: image data
     :type im: numpy array of dims (heightxwidthxn-channels)
     :param num_clusters: Number of clusters to fit to the data
     :type num_clusters: int
+    :param mode: Clustering backend: 'kmeans' fits every foreground pixel,
+    'minibatch' uses MiniBatchKMeans, 'subsample' fits a stratified
+    subsample of the pixels, and 'auto' chooses from the number of
+    foreground pixels. 'spots' finds every spot with detect_spots instead,
+    in linear time, so the number of centres found is not num_clusters.
+    Defaults to 'auto'
+    :type mode: string, optional
+    :param warm: State carried between adjacent slices of one channel. If
+    it holds centroids from the previous slice and the foreground changed by
+    at most WARM_START_MAX_CHANGE, they seed a single k-means run instead of
+    k-means++ with restarts. It is updated with this slice's centroids.
+    :type warm: dictionary, optional
     :return clusts: Coordinates of the centres of clusters
     :type clusts: list of tuples? # NB check this
     """
 
     if 0 not in im:
         raise ValueError("No zero values, please apply a threshold")
-    xrange, yrange = np.shape(im)
-    out = []
-    for x in range(xrange):
-        for y in range(yrange):
-            # Select only pixels not masked out during denoising
-            if im[x, y] != 0:
-                out.append([x, y])
+    if mode == 'spots':
+        spots = detect_spots(im)
+        return np.stack([spots['row'], spots['col']], axis=-1)
+    # Select only pixels not masked out during denoising
+    out = np.argwhere(im != 0)
+    if mode == 'auto':
+        mode = select_cluster_mode(len(out))
+    init, n_init = 'k-means++', 5
+    if warm and len(warm['centres']) == num_clusters and \
+            abs(len(out) - warm['n_points']) <= \
+            WARM_START_MAX_CHANGE*warm['n_points']:
+        init, n_init = warm['centres'], 1
     # Derive cluster centroids and pass as an array of coordinates
-    kmeans = KMeans(n_clusters=num_clusters, n_init=5,
-                    init='k-means++').fit(out)
+    if mode == 'kmeans':
+        kmeans = KMeans(n_clusters=num_clusters, n_init=n_init,
+                        init=init).fit(out)
+    elif mode == 'subsample':
+        sample = stratified_subsample(out, np.shape(im), KMEANS_MAX_POINTS)
+        kmeans = KMeans(n_clusters=num_clusters, n_init=n_init,
+                        init=init).fit(sample)
+    elif mode == 'minibatch':
+        kmeans = MiniBatchKMeans(n_clusters=num_clusters,
+                                 n_init=min(n_init, 3), batch_size=4096,
+                                 init=init).fit(out)
+    else:
+        raise ValueError("Unknown clustering mode %s" % mode)
+    if warm is not None:
+        warm['centres'] = kmeans.cluster_centers_
+        warm['n_points'] = len(out)
 
     return np.asarray(kmeans.cluster_centers_).astype('int')
 
@@ -96,47 +285,50 @@ def scaled_dist(max_dist):
     return max_dist
 
 
-def compare_dists(ch1_clusters, ch2_clusters, max_dist):
-    """Compares the distances between centroids of channel 1 and 2 clusters.
+def compare_dists(ch1_clusters, ch2_clusters, max_dist, mode='all'):
+    """Matches centroids of channel 1 and 2 clusters which lie within
+    max_dist of each other, using a KD-tree so that only nearby pairs are
+    compared.
     :param ch1_clusters: List of the coordinates of all cluster centres for
     channel 1
     :type ch1_clusters: list of tuples (x, y)
     :param ch2_clusters: List of the coordinates of all cluster centres for
-    channel 2
+    channel 2, not necessarily as many as for channel 1
     :type ch2_clusters: list of tuples (x, y)
     :param max_dist: defines distance threshold for definition of clusters
     as colocalised
     :type max_dist: int
+    :param mode: 'all' returns every pair closer than max_dist, 'one_to_one'
+    pairs each centroid at most once, closest pairs first, defaults to 'all'
+    :type mode: string, optional
 
-    :return euc_dists: Euclidean distances between the cluster centres
-    :type euc_dists: dictionary
+    :return euc_dists: One row per pair with the indices of the two
+    centroids, the Euclidean distance between them and their midpoint
+    'centroid', reversed to (column, row) image coordinates
+    :type euc_dists: numpy structured array of dtype MATCH_DTYPE
     """
-    n = 0
-    euc_dists = {}
-    if len(ch1_clusters) != len(ch2_clusters):
-        raise ValueError("Unequal cluster vectors")
-    for c1_clust in ch1_clusters:
-        for c2_clust in ch2_clusters:
-            # Compute euclidean distance
-            centroid_dist = math.dist(c1_clust, c2_clust)
-            # Check vs. distance criterion
-            if centroid_dist < max_dist:
-                euc_dists["Pair %s" % (n)] = {}
-                # Record distance between cluster centroids
-                # NB reversal is necessary to map to 2D image coordinates
-                euc_dists["Pair %s" % (n)]["Centroid"] = list(
-                                                        reversed(
-                                                            np.mean([c1_clust,
-                                                                     c2_clust],
-                                                                    axis=0
-                                                                    ).astype(
-                                                                        int)))
-
-                n += 1
+    ch1_clusters = np.asarray(ch1_clusters, dtype=float).reshape(-1, 2)
+    ch2_clusters = np.asarray(ch2_clusters, dtype=float).reshape(-1, 2)
+    if mode not in ('all', 'one_to_one'):
+        raise ValueError("Unknown matching mode %s" % mode)
+    if len(ch1_clusters) == 0 or len(ch2_clusters) == 0:
+        return np.empty(0, dtype=MATCH_DTYPE)
+
+    distances = match_points(ch1_clusters, ch2_clusters, max_dist, mode)
+
+    euc_dists = np.empty(len(distances), dtype=MATCH_DTYPE)
+    euc_dists['index1'] = distances['i']
+    euc_dists['index2'] = distances['j']
+    euc_dists['distance'] = distances['v']
+    # Record midpoint between cluster centroids
+    # NB reversal is necessary to map to 2D image coordinates
+    midpoints = (ch1_clusters[distances['i']] +
+                 ch2_clusters[distances['j']])/2
+    euc_dists['centroid'] = midpoints.astype(int)[:, ::-1]
     return euc_dists
 
 
-def get_colocs(im, channels, num_clusts, max_dist):
+def get_colocs(im, channels, num_clusts, max_dist, mode='auto', warm=None):
     """Compare two chanels of an image and return the set of KMeans cluster
     centroids.
     Centroids fall within a minimum distance of one another.
@@ -148,9 +340,15 @@ def get_colocs(im, channels, num_clusts, max_dist):
     :type num_clusts: int
     :param max_dist: Maximum allowed distance between cluster centres
     :type max_dist: float
+    :param mode: Clustering backend passed to fit_clusters, e.g. 'spots' for
+    the linear-time spot detector, defaults to 'auto'
+    :type mode: string, optional
+    :param warm: Warm-start state of each channel, carried between adjacent
+    slices, defaults to None (fit every slice from scratch)
+    :type warm: dictionary, optional
     :return euc_dists: Average positions of cluster centres for cluster
     positions closest to each other.
-    :type euc_dists: list of tuples
+    :type euc_dists: numpy structured array of dtype MATCH_DTYPE
     """
     if len(channels) != 2:
         raise ValueError("This function can only ",
@@ -159,12 +357,35 @@ def get_colocs(im, channels, num_clusts, max_dist):
     chan1, chan2 = [im[:, :, c] for c in channels]
     if chan1.shape != chan2.shape:
         raise ValueError("Input arrays must have the same shape")
-    c1_clusters = fit_clusters(chan1, num_clusts)
-    c2_clusters = fit_clusters(chan2, num_clusts)
+    c1_clusters, c2_clusters = fit_pair(im, channels, num_clusts, mode, warm)
 
     return compare_dists(c1_clusters, c2_clusters, max_dist)
 
 
+def fit_pair(im, channels, num_clusts, mode='auto', warm=None):
+    """Fit k-means clusters to two channels of an image.
+    :param im: Image data
+    :type im: Numpy array of shape (height x width x channels)
+    :param channels: index of the two channels of interest
+    :type channels: list
+    :param num_clusts: Number of clusters to fit to each channel
+    :type num_clusts: int
+    :param mode: Clustering backend passed to fit_clusters, defaults to
+    'auto'
+    :type mode: string, optional
+    :param warm: Warm-start state of each channel, defaults to None
+    :type warm: dictionary, optional
+    :return: Cluster centres of each channel
+    :rtype: tuple of numpy arrays
+    """
+    if warm is not None:
+        warm1, warm2 = [warm.setdefault(c, {}) for c in channels]
+    else:
+        warm1 = warm2 = None
+    return (fit_clusters(im[:, :, channels[0]], num_clusts, mode, warm1),
+            fit_clusters(im[:, :, channels[1]], num_clusts, mode, warm2))
+
+
 def annotate(ax, title, coords=False):
     """Adds a circle and/title to a given position in an ICA plot.
 
@@ -219,8 +440,8 @@ def plot_kmeans(original, denoised, clusters, output_dir, filename):
     :type original: Numpy array of shape (height x width x channels)
     :param denoised: Denoised image data
     :type denoised: Numpy array of shape (height x width x channels)
-    :param clusters: List of cluster coordinates
-    :type clusters: List
+    :param clusters: Colocalised cluster pairs from compare_dists
+    :type clusters: numpy structured array of dtype MATCH_DTYPE or None
     :param output_dir: Path to output the result to
     :type output_dir: string
     :param filename: Name to output file as
@@ -232,10 +453,10 @@ def plot_kmeans(original, denoised, clusters, output_dir, filename):
     ax[1].imshow(denoised)
     titles = ['Original', 'Denoised']
     for a, axis in enumerate(ax):
-        if clusters:
-            for pair in clusters.keys():
-                coords = tuple(clusters[pair]["Centroid"])
-                circle = plt.Circle(coords, 5, color='white', fill=False)
+        if clusters is not None:
+            for coords in clusters['centroid']:
+                circle = plt.Circle(tuple(coords), 5, color='white',
+                                    fill=False)
                 axis.add_artist(circle)
         axis.set_title(titles[a])
         axis.axis("off")
@@ -244,26 +465,635 @@ def plot_kmeans(original, denoised, clusters, output_dir, filename):
     plt.close(fig)
 
 
-def run_visualiser(input_dict):
+def keep_figure(record, path, image, input_dict):
+    """Record a saved figure, and its pixels if input_dict['keep_images'] is
+    set so that a viewer can show it without reading the file back.
+
+    :param record: Results of the frame
+    :type record: dictionary
+    :param path: File the figure was saved to
+    :type path: string
+    :param image: RGB pixels of the figure, None for matplotlib figures
+    :type image: Numpy array or None
+    :param input_dict: User input values
+    :type input_dict: dictionary
+    """
+    record['figures'].append(path)
+    record['images'].append(image if input_dict.get('keep_images')
+                            else None)
+
+
+# Plotting functions of each renderer. 'fast' draws straight into an image
+# buffer; 'publication' draws matplotlib figures.
+RENDERERS = {
+    'fast': (overlay_ica, overlay_kmeans),
+    'publication': (plot, plot_kmeans)
+}
+
+
+def process_frame(n, orig, denoised, input_dict, warm=None, cache=None,
+                  digest=None, mask=None, log=None):
+    """Runs the selected analyses on one frame and saves the plots, unless
+    input_dict['render'] is 'none' or 'deferred'.
+
+    :param n: Index of the frame
+    :type n: int
+    :param orig: Input image data
+    :type orig: Numpy array of shape (height x width x channels)
+    :param denoised: Denoised image data
+    :type denoised: Numpy array of shape (height x width x channels)
+    :param input_dict: User input values
+    :type input_dict: dictionary
+    :param warm: Warm-start state of the clustering, defaults to None
+    :type warm: dictionary, optional
+    :param cache: Cache of ICA peaks and cluster centres, defaults to None.
+    Cluster centres are not cached when warm-started.
+    :type cache: stage_cache, optional
+    :param digest: Hash of the input file contents, used in cache keys
+    :type digest: string, optional
+    :param mask: Smallest value kept in each channel by the threshold, used
+    in cache keys so that only frames whose mask changed are recomputed when
+    the threshold changes, defaults to None (not thresholded)
+    :type mask: numpy array, optional
+    :param log: Log recording the time taken by each stage, defaults to None
+    :type log: run_log, optional
+    :return: Numeric results of the frame, see results.frame_record
+    :rtype: dictionary
+    """
+    output_dir = input_dict['out_path']
+    if log is None:
+        log = run_log()
+    record = frame_record(n)
+    render = input_dict.get('render', DEFAULT_PARAMS['render']) == 'all'
+    draw_ica, draw_kmeans = RENDERERS[input_dict.get(
+        'renderer', DEFAULT_PARAMS['renderer'])]
+    if draw_ica is overlay_ica:
+        compression = input_dict.get('png_compression',
+                                     DEFAULT_PARAMS['png_compression'])
+        draw_ica = partial(draw_ica, compression=compression)
+        draw_kmeans = partial(draw_kmeans, compression=compression)
+    # Parameters which change the denoised frame
+    params = {key: input_dict[key] for key in ['dtype', 'channels']}
+    params.update(file=digest, frame=n,
+                  mask=None if mask is None else np.asarray(mask).tolist())
+    if input_dict["Run Intensity Correlation Analysis"] == 'Y':
+        print("\tRunning Intensity Correlation Analysis")
+
+        def ica():
+            peaks, total = correlate(denoised, input_dict['channels'],
+                                     input_dict['num_clusts'],
+                                     return_sum=True)
+            return {'peaks': np.asarray(peaks), 'sum': np.float64(total)}
+        with log.stage('ica', n, items=input_dict['num_clusts']):
+            if cache is None:
+                result = ica()
+            else:
+                result = cache.cached('ica', ica, num_clusts=input_dict[
+                    'num_clusts'], **params)
+        corr_clusts = [tuple(p) for p in result['peaks']]
+        record['ica_peaks'] = corr_clusts
+        record['ica_sum'] = float(result.get('sum', np.nan))
+        if render:
+            path = output_dir + "/0%s_ICA.png" % n
+            with log.stage('render', n, items=1) as stage:
+                image = draw_ica(orig, denoised, corr_clusts, output_dir,
+                                 "/0%s_ICA" % n)
+                stage['bytes_written'] = file_size(path)
+            keep_figure(record, path, image, input_dict)
+            print("\tSaved")
+    if input_dict["Run KMeans"] == 'Y':
+        print("\tRunning KMeans")
+
+        def kmeans():
+            c1, c2 = fit_pair(denoised, input_dict['channels'],
+                              input_dict['num_clusts'],
+                              input_dict['cluster_mode'], warm)
+            return {'c1': c1, 'c2': c2}
+        try:
+            with log.stage('kmeans', n) as stage:
+                # Warm-started centres depend on the previous frame, which
+                # the cache key does not capture, so they are not cached
+                if cache is None or warm is not None:
+                    centres = kmeans()
+                else:
+                    centres = cache.cached(
+                        'kmeans', kmeans, num_clusts=input_dict['num_clusts'],
+                        cluster_mode=input_dict['cluster_mode'], **params)
+                stage['items'] = len(centres['c1']) + len(centres['c2'])
+            with log.stage('match', n) as stage:
+                kmeans_clusts = compare_dists(centres['c1'], centres['c2'],
+                                              input_dict['min_dist'])
+                stage['items'] = len(kmeans_clusts)
+            record['clusters'] = dict(zip(input_dict['channels'],
+                                          [centres['c1'], centres['c2']]))
+            record['pairs'] = kmeans_clusts
+        except ValueError:
+            print("\tNo clusters found within",
+                  " %s pixels for image %s" % (input_dict['min_dist'],
+                                               str(n)))
+            kmeans_clusts = None
+        if render:
+            path = output_dir + "/0%s_kmeans.png" % n
+            with log.stage('render', n, items=1) as stage:
+                image = draw_kmeans(orig, denoised, kmeans_clusts,
+                                    output_dir, "/0%s_kmeans" % n)
+                stage['bytes_written'] = file_size(path)
+            keep_figure(record, path, image, input_dict)
+            print("\tSaved")
+    return record
+
+
+def frame_mask(frames, n):
+    """Smallest value kept in each channel of frame n by the threshold.
+
+    :param frames: preprocessed stack
+    :type frames: thresholded_frames or numpy array
+    :param n: index of the frame
+    :type n: int
+    :return: mask cutoffs, or None if the stack is not thresholded
+    :rtype: numpy array
+    """
+    if isinstance(frames, thresholded_frames):
+        return frames.mask_cutoffs(n)
+    return None
+
+
+# Per-process state of the workers of run_frames_parallel.
+_worker = {}
+
+
+def _attach(name):
+    """Attach to shared memory created by the parent process, leaving the
+    parent responsible for unlinking it."""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13 workers share the parent's resource tracker, so
+        # attaching registers the same segment again, which is harmless.
+        return shared_memory.SharedMemory(name=name)
+
+
+def _init_worker(name, shape, dtype, cutoffs, policy, source_dtype,
+                 input_dict, threads, cache, digest, log, results):
+    """Set up a worker of run_frames_parallel."""
+    # Cap BLAS and OpenMP threads so that workers do not oversubscribe cores
+    threadpool_limits(limits=threads)
+    shm = _attach(name)
+    frames = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    # Figures are not pickled back to the parent; viewers read the files
+    input_dict = dict(input_dict, keep_images=False)
+    # Stage records go back to the parent with each frame, which writes them
+    log = run_log(log.path, log.profile, log.run, memory=True)
+    _worker.update(shm=shm, original=frames, policy=policy,
+                   source_dtype=source_dtype, input_dict=input_dict,
+                   cache=cache, digest=digest, log=log, results=results,
+                   preprocessed=frames if cutoffs is None
+                   else thresholded_frames(frames, cutoffs))
+
+
+def _run_worker_frame(n):
+    """Process one frame in a worker of run_frames_parallel, returning its
+    results and the records of its stages."""
+    with _worker['log'].stage('scale', n, items=1):
+        orig = scale_frame(_worker['original'][:, :, :, n],
+                           _worker['policy'], _worker['source_dtype'])
+        denoised = scale_frame(_worker['preprocessed'][:, :, :, n],
+                               _worker['policy'], _worker['source_dtype'])
+    print("\nProcessing Image %s" % (n+1))
+    mask = frame_mask(_worker['preprocessed'], n) if _worker['cache'] \
+        else None
+    record = process_frame(n, orig, denoised, _worker['input_dict'],
+                           _worker['warm'], _worker['cache'],
+                           _worker['digest'], mask, _worker['log'])
+    return record, _worker['log'].take()
+
+
+def _run_worker_frames(frames):
+    """Process a contiguous run of frames in order in a worker of
+    run_frames_parallel, so that warm starts carry over between neighbouring
+    frames, and send the results of each frame back as soon as it finishes."""
+    # Warm starts do not carry over from another run of frames
+    _worker['warm'] = {} if _worker['input_dict']['warm_start'] else None
+    for n in frames:
+        _worker['results'].put(_run_worker_frame(n))
+
+
+def run_frames_parallel(original, preprocessed, input_dict, n_workers,
+                        cache=None, digest=None, progress=None,
+                        should_stop=None, log=None, block=16):
+    """Process frames concurrently on a pool of worker processes. The
+    normalised stack is placed in shared memory once and every worker reads
+    its frames from there rather than receiving pickled copies. Each worker
+    handles a contiguous run of frames so warm starts carry over, and the
+    results of every frame are sent back as soon as it finishes.
+
+    :param original: Normalised pipeline object
+    :type original: pipeline_object
+    :param preprocessed: Thresholded pipeline object derived from original
+    :type preprocessed: pipeline_object
+    :param input_dict: User input values
+    :type input_dict: dictionary
+    :param n_workers: Number of worker processes
+    :type n_workers: int
+    :param cache: Cache of ICA peaks and cluster centres, defaults to None
+    :type cache: stage_cache, optional
+    :param digest: Hash of the input file contents, used in cache keys
+    :type digest: string, optional
+    :param progress: Called with (frames done, total frames, results of the
+    frame) as each frame finishes, defaults to None
+    :type progress: function, optional
+    :param should_stop: Polled as each frame finishes; the remaining frames
+    are abandoned once it returns True, defaults to None
+    :type should_stop: function, optional
+    :param log: Log recording the time taken by each stage, to which the
+    records of the workers are added as each frame finishes, defaults to None
+    :type log: run_log, optional
+    :param block: Number of frames copied into shared memory at a time,
+    defaults to 16
+    :type block: int, optional
+    :return: Numeric results of every frame, in the order they finished
+    :rtype: list of dictionaries
+    """
+    if log is None:
+        log = run_log()
+    shape, dtype = original.frames.shape, np.dtype(original.frames.dtype)
+    n_frames = shape[-1]
+    nbytes = int(np.prod(shape))*dtype.itemsize
+    shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+    try:
+        # Frames are copied straight into shared memory a block at a time,
+        # so the stack is never held twice
+        with log.stage('shared_memory', bytes_written=nbytes):
+            shared = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            for start in range(0, n_frames, block):
+                frames = slice(start, min(start + block, n_frames))
+                shared[:, :, :, frames] = original.frames[:, :, :, frames]
+            del shared
+        threads = max(1, (os.cpu_count() or 1)//n_workers)
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        initargs = (shm.name, shape, dtype,
+                    getattr(preprocessed, 'thresholds', None),
+                    original.dtype, original.header.dtype,
+                    input_dict, threads, cache, digest, log, results)
+        with context.Pool(n_workers, initializer=_init_worker,
+                          initargs=initargs) as pool:
+            runs = [pool.apply_async(_run_worker_frames, (frames.tolist(),))
+                    for frames in np.array_split(np.arange(n_frames),
+                                                 n_workers)]
+            records = []
+            while len(records) < n_frames:
+                try:
+                    record, stages = results.get(timeout=0.1)
+                except queue.Empty:
+                    # Raise the error of a worker which failed
+                    for run in runs:
+                        if run.ready():
+                            run.get()
+                    continue
+                for stage in stages:
+                    log.write(stage)
+                records.append(record)
+                if progress is not None:
+                    progress(len(records), n_frames, record)
+                if stopped(should_stop):
+                    # Leaving the pool terminates the workers
+                    break
+            return records
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def print_metrics(stack, channels, block=16, log=None):
+    """Print the whole-stack colocalisation coefficients.
+
+    :param stack: Preprocessed image data
+    :type stack: Array-like of shape (height x width x channels x frames)
+    :param channels: index of the two channels of interest
+    :type channels: list
+    :param block: Number of frames read at a time, defaults to 16
+    :type block: int, optional
+    :param log: Log recording the time taken by each stage, defaults to None
+    :type log: run_log, optional
+    :return: Coefficients of each frame and of the whole stack, see
+    coloc_metrics
+    :rtype: tuple of dictionaries
+    """
+    if log is None:
+        log = run_log()
+    with log.stage('metrics', items=stack.shape[3]):
+        per_frame, volume = coloc_metrics(stack, channels, block=block)
+    report_metrics(volume)
+    return per_frame, volume
+
+
+def report_metrics(volume):
+    """Print the whole-stack colocalisation coefficients.
+
+    :param volume: coefficient name to value for the whole stack
+    :type volume: dictionary
+    """
+    print("Colocalisation coefficients")
+    print("\tPearson's r: {:.3f}".format(volume['pearson']))
+    print("\tManders' M1: {:.3f}, M2: {:.3f}".format(volume['m1'],
+                                                     volume['m2']))
+    print("\tICQ: {:.3f}".format(volume['icq']))
+    print("==================================\n")
+
+
+def record_thresholds(record, thresholds, input_dict):
+    """Add the Costes thresholds of a frame to its results, so that they are
+    exported with the coefficients they were used for.
+
+    :param record: Results of the frame
+    :type record: dictionary
+    :param thresholds: Threshold of each channel and frame, None if the
+    stack is not thresholded
+    :type thresholds: numpy array of shape (channels x frames) or None
+    :param input_dict: User input values
+    :type input_dict: dictionary
+    """
+    if input_dict['threshold'] == 'costes':
+        record['thresholds'] = {c: float(thresholds[c, record['frame']])
+                                for c in input_dict['channels']}
+
+
+def export_results(input_dict, records, metrics, log=None):
+    """Write the numeric results of every frame to the output directory in
+    the formats listed in input_dict['export'].
+
+    :param input_dict: User input values
+    :type input_dict: dictionary
+    :param records: Results of each frame from process_frame
+    :type records: list of dictionaries
+    :param metrics: Coefficients of each frame and of the whole stack
+    :type metrics: tuple of dictionaries
+    :param log: Log recording the time taken by each stage, defaults to None
+    :type log: run_log, optional
+    """
+    if not input_dict['export']:
+        return
+    if log is None:
+        log = run_log()
+    per_frame, volume = metrics
+    with log.stage('export', items=len(records)) as stage:
+        writer = results_writer(input_dict['out_path'], input_dict['export'],
+                                input_dict['channels']
+                                if input_dict['threshold'] == 'costes'
+                                else ())
+        for record in records:
+            n = record['frame']
+            writer.add(record, {k: v[n] for k, v in per_frame.items()})
+        paths = writer.write(volume)
+        stage['bytes_written'] = sum(file_size(path) for path in paths)
+    for path in paths:
+        print("Saved results to %s" % path)
+
+
+def render_results(input_dict, frames=None):
+    """Draw the plots of a run made with input_dict['render'] = 'deferred'
+    from its saved results, without running the analyses again. The image is
+    preprocessed again to draw on, reusing the cache if there is one.
+
+    :param input_dict: User input values of the run
+    :type input_dict: dictionary
+    :param frames: Indices of the frames to draw, defaults to all of them
+    :type frames: list of int, optional
+    """
+    input_dict = dict(DEFAULT_PARAMS, **input_dict)
+    output_dir = input_dict['out_path']
+    results = load_results(output_dir)
+    draw_ica, draw_kmeans = RENDERERS[input_dict['renderer']]
+    if draw_ica is overlay_ica:
+        compression = input_dict['png_compression']
+        draw_ica = partial(draw_ica, compression=compression)
+        draw_kmeans = partial(draw_kmeans, compression=compression)
+    cache = None
+    if input_dict['cache_dir']:
+        cache = stage_cache(input_dict['cache_dir'], input_dict['cache_size'])
+    original, preprocessed = do_preprocess(
+        input_dict['in_path'], output_dir,
+        threshold=input_dict['threshold'], lazy=input_dict['lazy'],
+        dtype=input_dict['dtype'], channels=input_dict['channels'],
+        cache=cache)
+    if frames is None:
+        frames = results['frames']['frame']
+    for n in frames:
+        orig, denoised = original.scaled(n), preprocessed.scaled(n)
+        if input_dict["Run Intensity Correlation Analysis"] == 'Y':
+            peaks = results['ica_peaks'][results['ica_peaks']['frame'] == n]
+            draw_ica(orig, denoised, list(zip(peaks['row'], peaks['col'])),
+                     output_dir, "/0%s_ICA" % n)
+        if input_dict["Run KMeans"] == 'Y':
+            rows = results['pairs'][results['pairs']['frame'] == n]
+            pairs = np.zeros(len(rows), dtype=MATCH_DTYPE)
+            for name in ['index1', 'index2', 'distance']:
+                pairs[name] = rows[name]
+            pairs['centroid'] = np.stack([rows['x'], rows['y']], axis=-1)
+            draw_kmeans(orig, denoised, pairs if len(pairs) else None,
+                        output_dir, "/0%s_kmeans" % n)
+
+
+def run_stream(input_dict, cache=None, digest=None, progress=None,
+               should_stop=None, log=None):
+    """Runs the analyses one window of frames at a time, so that at most
+    input_dict['window'] frames are held in memory whatever the depth of the
+    stack. Frames are processed in order on a single process. The file is
+    read twice: once to find the range of each channel, and once for the
+    analyses, which also collect the colocalisation coefficients.
+
+    :param input_dict: User input values, with defaults filled in
+    :type input_dict: dictionary
+    :param cache: Cache of ICA peaks and cluster centres, defaults to None
+    :type cache: stage_cache, optional
+    :param digest: Hash of the input file contents, used in cache keys
+    :type digest: string, optional
+    :param progress: Called with (frames done, total frames, results of the
+    frame) after each frame, defaults to None
+    :type progress: function, optional
+    :param should_stop: Polled before each frame; processing stops once it
+    returns True, defaults to None
+    :type should_stop: function, optional
+    :param log: Log recording the time taken by each stage, defaults to None
+    :type log: run_log, optional
+    :return: Results of each frame, and the coefficients of each frame and
+    of the whole stack
+    :rtype: tuple of a list and a tuple of dictionaries
+    """
+    if log is None:
+        log = run_log()
+    channels = input_dict['channels']
+    # The first pass over the file finds the range of each channel
+    with log.stage('read', bytes_read=file_size(input_dict['in_path'])):
+        pipeline = stream_pipeline(input_dict['in_path'],
+                                   threshold=input_dict['threshold'],
+                                   dtype=input_dict['dtype'],
+                                   channels=channels,
+                                   window=input_dict['window'])
+    n_frames = pipeline.shape[3]
+    print("Complete")
+    print("==================================\n")
+    print("Running fluorescence colocalisation analysis")
+    coefficients = coloc_accumulator(
+        n_frames, [pipeline.value_range(c) for c in channels])
+    warm = {} if input_dict['warm_start'] else None
+    records = []
+    with pipeline:
+        for first, block, view in pipeline.blocks():
+            if stopped(should_stop):
+                break
+            # The coefficients are collected from the frames read for the
+            # analyses, rather than in passes of their own
+            with log.stage('metrics', items=block.shape[3]):
+                coefficients.add(*channel_pair(view, channels, slice(None)),
+                                 slice(first, first + block.shape[3]))
+            for i in range(block.shape[3]):
+                n = first + i
+                if stopped(should_stop):
+                    break
+                print("\nProcessing Image %s/%s" % (str(n+1), str(n_frames)))
+                if input_dict['threshold'] == 'costes':
+                    print("\tCostes thresholds: " + ", ".join(
+                        "channel %s: %.3f" % (c, pipeline.thresholds[c, n])
+                        for c in channels))
+                mask = frame_mask(view, i) if cache else None
+                with log.stage('scale', n, items=1):
+                    orig, denoised = [scale_frame(frames[:, :, :, i],
+                                                  pipeline.dtype,
+                                                  pipeline.header.dtype)
+                                      for frames in (block, view)]
+                records.append(process_frame(n, orig, denoised, input_dict,
+                                             warm, cache, digest, mask, log))
+                record_thresholds(records[-1], pipeline.thresholds,
+                                  input_dict)
+                if progress is not None:
+                    progress(len(records), n_frames, records[-1])
+    print("Complete")
+    print("==================================\n")
+    metrics = coefficients.result()
+    report_metrics(metrics[1])
+    return records, metrics
+
+
+def run_volume(input_dict, original, preprocessed, metrics, log=None):
+    """Runs the volumetric analysis: the foreground of each channel is
+    labelled in 3D in a single pass over the stack, and objects of the two
+    channels whose centroids lie within input_dict['min_dist'] pixels are
+    matched. Distances along z are scaled by the spacing of the frames,
+    input_dict['z_step'] in um, over the size of a pixel,
+    input_dict['scale'] in um over the width of the frames. The per frame
+    analyses are not run, so the 'Run Intensity Correlation Analysis' and
+    'Run KMeans' flags have no effect.
+
+    :param input_dict: User input values, with defaults filled in
+    :type input_dict: dictionary
+    :param original: Normalised pipeline object
+    :type original: pipeline_object
+    :param preprocessed: Thresholded pipeline object
+    :type preprocessed: pipeline_object
+    :param metrics: Coefficients of each frame and of the whole stack
+    :type metrics: tuple of dictionaries
+    :param log: Log recording the time taken by each stage, defaults to None
+    :type log: run_log, optional
+    :return: Objects, pairs and the projection figure, with the keys of a
+    frame record and a frame of None
+    :rtype: dictionary
+    """
+    if log is None:
+        log = run_log()
+    output_dir = input_dict['out_path']
+    channels = input_dict['channels']
+    frames = preprocessed.frames
+    spacing = z_scale(frames.shape[1], input_dict['scale'],
+                      input_dict['z_step'])
+    print("Finding objects in 3D, frames %.2f pixels apart" % spacing)
+    with log.stage('objects', items=frames.shape[3]) as stage:
+        objects, pairs = volume_colocalisation(
+            frames, channels, input_dict['min_dist'], spacing,
+            input_dict['connectivity'], input_dict['min_voxels'])
+        stage['items'] = len(objects)
+    for c in channels:
+        print("\tChannel %s: %s objects"
+              % (c, np.sum(objects['channel'] == c)))
+    print("\tColocalised pairs: %s" % len(pairs))
+    record = frame_record(None)
+    record.update(objects=objects, pairs=pairs)
+    if input_dict['render'] == 'all':
+        # Matched pairs are drawn on the maximum projections of the stacks
+        path = output_dir + "/volume_objects.png"
+        with log.stage('render', items=1) as stage:
+            projections = [scale_frame(np.max(stack, axis=3), original.dtype,
+                                       original.header.dtype)
+                           for stack in (original.frames,
+                                         np.asarray(frames))]
+            image = render_panels(projections[0], projections[1],
+                                  pairs['centroid'][:, :2] if len(pairs)
+                                  else None,
+                                  "3D objects (maximum projection)")
+            save_png(path, image, input_dict['png_compression'])
+            stage['bytes_written'] = file_size(path)
+        keep_figure(record, path, image, input_dict)
+        print("\tSaved")
+    if input_dict['export']:
+        with log.stage('export', items=len(objects)) as stage:
+            paths = write_objects(output_dir, objects, pairs, metrics[1],
+                                  input_dict['export'])
+            stage['bytes_written'] = sum(file_size(path) for path in paths)
+        for path in paths:
+            print("Saved results to %s" % path)
+    return record
+
+
+def finish_log(log):
+    """Print the time taken by each stage of this run, over every process
+    that wrote to the log, and close it. Earlier runs appended to the same
+    file are not counted.
+
+    :param log: Log of the run
+    :type log: run_log
+    """
+    print("==================================\n")
+    log.print_summary(log.read())
+    log.close()
+
+
+def stopped(should_stop):
+    """Whether a run has been asked to stop, printing a message if so.
+
+    :param should_stop: Function returning True to stop, or None
+    :type should_stop: function
+    :rtype: bool
+    """
+    if should_stop is not None and should_stop():
+        print("Cancelled")
+        return True
+    return False
+
+
+def run_visualiser(input_dict, progress=None, should_stop=None):
     """ Generates ICA and/or K-means plots in response to user-defined inputs
 
     :param input_dict: User input values
     :type input_dict: dictionary
+    :param progress: Called with (frames done, total frames, results of the
+    frame) as each frame finishes, e.g. to update a progress bar, defaults to
+    None
+    :type progress: function, optional
+    :param should_stop: Polled between frames; the run stops early, saving
+    the results of the frames already done, once it returns True, defaults to
+    None
+    :type should_stop: function, optional
+    :return: Results of each frame processed, see results.frame_record
+    :rtype: list of dictionaries
     """
     # Get parameters from user input
 
     sourcefile, output_dir = [input_dict[key] for key in ["in_path",
                                                           "out_path"]]
-    default_params = {
-        'threshold': 0.5,
-        'channels': [0, 1],
-        'num_clusts': 10,
-        'min_dist': 20
-    }
-
-    for key in default_params.keys():
+    for key, value in DEFAULT_PARAMS.items():
         if key not in input_dict.keys():
-            input_dict[key] = default_params[key]
+            input_dict[key] = copy.copy(value)
 
     if not os.path.isfile(sourcefile):
         raise KeyError("%s does not exist" % (sourcefile))
@@ -272,6 +1102,33 @@ def run_visualiser(input_dict):
         raise KeyError("%s does not exist" % (output_dir))
     if (input_dict['threshold'] == 0) or (input_dict['threshold'] == 1):
         raise ValueError("Please enter a threshold between (but not including) 0 and 1 ")
+    if (input_dict["Run Intensity Correlation Analysis"] != 'Y') and (input_dict["Run KMeans"] != 'Y'):
+        raise KeyError("Please select a method for colocalisation analysis")
+    if len(input_dict['channels']) != 2:
+        raise ValueError("Colocalisation compares exactly two channels")
+    if input_dict['lazy'] not in [True, False]:
+        raise ValueError("lazy must be True or False")
+    if input_dict['cluster_mode'] not in CLUSTER_MODES:
+        raise ValueError("cluster_mode must be one of %s"
+                         % ", ".join(CLUSTER_MODES))
+    if input_dict['stream'] and input_dict['n_workers'] != 1:
+        raise ValueError("Streaming processes frames in order on one "
+                         "process; set n_workers to 1")
+    if input_dict['renderer'] not in RENDERERS:
+        raise ValueError("renderer must be one of %s" % ", ".join(RENDERERS))
+    if input_dict['render'] not in ['all', 'none', 'deferred']:
+        raise ValueError("render must be one of all, none or deferred")
+    if input_dict['render'] == 'deferred' and \
+            'npz' not in input_dict['export']:
+        raise ValueError("Deferred rendering needs the npz export")
+    if input_dict['mode'] not in ['slices', 'volume']:
+        raise ValueError("mode must be one of slices or volume")
+    if input_dict['mode'] == 'volume' and \
+            (input_dict['stream'] or input_dict['render'] == 'deferred'):
+        raise ValueError("Volume mode needs the whole stack in memory and "
+                         "cannot stream or defer rendering")
+    if input_dict['z_step'] and not input_dict['scale']:
+        raise ValueError("The scale of the image is needed to use z_step")
 
     print("=========================================\n",
           "=========================================")
@@ -279,83 +1136,83 @@ def run_visualiser(input_dict):
     print("Analysing files from ", sourcefile)
     print("Preprocessing")
 
+    # Time taken by each stage is appended to run_log.jsonl
+    log = run_log(os.path.join(output_dir, 'run_log.jsonl')
+                  if input_dict['run_log'] else None,
+                  input_dict['profile_stage'])
+
+    # Results of unchanged stages are reused from the cache between runs
+    if input_dict['cache_dir']:
+        cache = stage_cache(input_dict['cache_dir'], input_dict['cache_size'])
+        digest = file_digest(sourcefile)
+    else:
+        cache = digest = None
+    if input_dict['stream']:
+        records, metrics = run_stream(input_dict, cache, digest, progress,
+                                      should_stop, log)
+        export_results(input_dict, records, metrics, log)
+        finish_log(log)
+        return records
     original, preprocessed = do_preprocess(sourcefile,
                                            output_dir,
-                                           threshold=input_dict['threshold'])
+                                           threshold=input_dict['threshold'],
+                                           lazy=input_dict['lazy'],
+                                           dtype=input_dict['dtype'],
+                                           channels=input_dict['channels'],
+                                           cache=cache, log=log)
 
-    # Rescale in range (0, 255)
-    original = (original.frames*255).astype(int)
-    preprocessed = (preprocessed.frames*255).astype(int)
+    # Frames are rescaled in range (0, 255) one at a time
+    n_frames = original.frames.shape[-1]
+    if input_dict['threshold'] == 'costes':
+        print("Costes thresholds")
+        for n in range(n_frames):
+            print("\tImage %s: " % (n+1) + ", ".join(
+                "channel %s: %.3f" % (c, preprocessed.thresholds[c, n])
+                for c in input_dict['channels']))
     print("Complete")
     print("==================================\n")
+    metrics = print_metrics(preprocessed.frames, input_dict['channels'],
+                            log=log)
+    if input_dict['mode'] == 'volume':
+        print("Volume mode matches objects in 3D; ICA and KMeans are not run")
+        records = []
+        if not stopped(should_stop):
+            records.append(run_volume(input_dict, original, preprocessed,
+                                      metrics, log))
+            if progress is not None:
+                progress(1, 1, records[-1])
+        print("Complete")
+        finish_log(log)
+        return records
     print("Running fluorescence colocalisation analysis")
-    if (input_dict["Run Intensity Correlation Analysis"] == 'Y') and (input_dict["Run KMeans"] == 'Y'):
-        for n in range(original.shape[-1]):
-            print("\nProcessing Image %s/%s" % (str(n+1),
-                                                str(original.shape[-1])))
-        # for n in [3, 8,9]:   # For debugging only
-            orig = original[:, :, :, n]
-            denoised = preprocessed[:, :, :, n]
-            print("\tRunning Intensity Correlation Analysis")
-            corr_clusts = correlate(denoised, input_dict['channels'],
-                                    input_dict['num_clusts'])
-            plot(orig, denoised, corr_clusts, output_dir, "/0%s_ICA" % n)
-            print("\tSaved")
-            print("\tRunning KMeans")
-
-            try:
-                kmeans_clusts = get_colocs(denoised,
-                                           input_dict['channels'],
-                                           input_dict['num_clusts'],
-                                           input_dict['min_dist'])
-                plot_kmeans(orig, denoised, kmeans_clusts,
-                            output_dir, "/0%s_kmeans" % n)
-            except ValueError:
-                print("\tNo clusters found within",
-                      " %s pixels for image %s" % (input_dict['min_dist'],
-                                                   str(n)))
-                plot_kmeans(orig, denoised, None,
-                            output_dir, "/0%s_kmeans" % n)
-            print("\tSaved")
-
-    elif (input_dict["Run Intensity Correlation Analysis"] == 'Y') and (input_dict["Run KMeans"] == 'N'):
-        for n in range(original.shape[-1]):
-            print("\nProcessing Image %s/%s" % (str(n+1),
-                                                str(original.shape[-1])))
-        # for n in [8,9]:   # For debugging only
-            orig = original[:, :, :, n]
-            denoised = preprocessed[:, :, :, n].astype(int)
-            print("\tRunning Intensity Correlation Analysis")
-            corr_clusts = correlate(denoised, input_dict['channels'],
-                                    input_dict['num_clusts'])
-            plot(orig, denoised, corr_clusts, output_dir, "/0%s_ICA" % n)
-            print("\tSaved")
-
-    elif (input_dict["Run Intensity Correlation Analysis"] == 'N') and (input_dict["Run KMeans"] == 'Y'):
-        for n in range(original.shape[-1]):
-            print("\nProcessing Image %s/%s" % (str(n+1),
-                                                str(original.shape[-1])))
-        # for n in [8,9]:   # For debugging only
-            orig = original[:, :, :, n]
-            denoised = preprocessed[:, :, :, n]
-            print("\tRunning KMeans")
-            try:
-                kmeans_clusts = get_colocs(denoised,
-                                           input_dict['channels'],
-                                           input_dict['num_clusts'],
-                                           input_dict['min_dist'])
-                plot_kmeans(orig, denoised, kmeans_clusts,
-                            output_dir, "/0%s_kmeans" % n)
-            except ValueError:
-                print("\tNo clusters found within",
-                      " %s pixels for image %s" % (input_dict['min_dist'],
-                                                   str(n)))
-                plot_kmeans(orig, denoised, None,
-                            output_dir, "/0%s_kmeans" % n)
-            print("\tSaved")
+    n_workers = input_dict['n_workers'] or os.cpu_count() or 1
+    if n_workers > 1 and n_frames > 1:
+        records = run_frames_parallel(original, preprocessed, input_dict,
+                                      min(n_workers, n_frames), cache, digest,
+                                      progress, should_stop, log)
     else:
-        raise KeyError("Please select a method for colocalisation analysis")
+        # Seed each slice's clustering with the previous slice's centroids
+        warm = {} if input_dict['warm_start'] else None
+        records = []
+        for n in range(n_frames):
+            if stopped(should_stop):
+                break
+            print("\nProcessing Image %s/%s" % (str(n+1),
+                                                str(n_frames)))
+            mask = frame_mask(preprocessed.frames, n) if cache else None
+            with log.stage('scale', n, items=1):
+                orig, denoised = original.scaled(n), preprocessed.scaled(n)
+            records.append(process_frame(n, orig, denoised, input_dict,
+                                         warm, cache, digest, mask, log))
+            if progress is not None:
+                progress(len(records), n_frames, records[-1])
+    for record in records:
+        record_thresholds(record, getattr(preprocessed, 'thresholds', None),
+                          input_dict)
     print("Complete")
+    export_results(input_dict, records, metrics, log)
+    finish_log(log)
+    return records
 
 
 if __name__ == "__main__":
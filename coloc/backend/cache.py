@@ -0,0 +1,132 @@
+from functools import lru_cache
+import hashlib
+import json
+import os
+import numpy as np
+
+
+@lru_cache(maxsize=256)
+def _cached_digest(inpath, mtime, size):
+    digest = hashlib.sha256()
+    with open(inpath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_digest(inpath):
+    """SHA-256 of a file's contents. Results are remembered until the file is
+    modified, so the file is only hashed once per session.
+
+    :param inpath: File path
+    :type inpath: string or os.path
+
+    :return: hexadecimal digest
+    :rtype: string
+    """
+    stat = os.stat(inpath)
+    return _cached_digest(os.path.abspath(inpath), stat.st_mtime_ns,
+                          stat.st_size)
+
+
+class stage_cache():
+    """On-disk cache of the results of pipeline stages. Entries are keyed by
+    a hash of the stage name, the input file contents and the parameters
+    which affect that stage, so changing a downstream parameter reuses every
+    upstream result. The least recently used entries are evicted once the
+    cache grows beyond max_bytes.
+
+    :param directory: Folder to store the cache in, created if needed
+    :type directory: string or os.path
+    :param max_bytes: Largest total size of the cache, defaults to 2 GB
+    :type max_bytes: int, optional
+    """
+    def __init__(self, directory, max_bytes=2 * 1024**3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, stage, **params):
+        """Key of a stage's result for the given parameters.
+
+        :param stage: Name of the stage
+        :type stage: string
+        :return: hexadecimal key
+        :rtype: string
+        """
+        params = json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha256((stage + params).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key):
+        """Load a cached result and mark it as recently used.
+
+        :param key: key from stage_cache.key
+        :type key: string
+        :return: name to array, or None if the key is not cached
+        :rtype: dictionary
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                arrays = {name: data[name] for name in data.files}
+        except (OSError, ValueError):
+            # Missing, evicted by another process or partly written.
+            return None
+        os.utime(path)
+        return arrays
+
+    def put(self, key, **arrays):
+        """Store a result, then evict old entries if the cache is too big.
+
+        :param key: key from stage_cache.key
+        :type key: string
+        """
+        path = self._path(key)
+        tmp = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.savez(f, **arrays)
+        # Replace atomically so readers never see a partial entry.
+        os.replace(tmp, path)
+        self.evict()
+
+    def evict(self):
+        """Delete the least recently used entries until the cache fits."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+
+    def cached(self, stage, compute, **params):
+        """Return a stage's cached result, computing and storing it if it is
+        not cached yet.
+
+        :param stage: Name of the stage
+        :type stage: string
+        :param compute: Function returning the result as a dictionary of
+        arrays
+        :type compute: function
+        :return: name to array
+        :rtype: dictionary
+        """
+        key = self.key(stage, **params)
+        arrays = self.get(key)
+        if arrays is None:
+            arrays = compute()
+            self.put(key, **arrays)
+        return arrays
@@ -1,11 +1,156 @@
 from datetime import datetime
+import copy
 import os
 from PIL import Image
 import numpy as np
 import matplotlib.pyplot as plt
-import cv2
 import tifffile
-import exifread
+try:
+    from backend.reader import open_frames, read_header, tiff_header
+    from backend.resample import resample_frames
+    from backend.metrics import costes_thresholds
+except ModuleNotFoundError:
+    from ..backend.reader import open_frames, read_header, tiff_header
+    from ..backend.resample import resample_frames
+    from ..backend.metrics import costes_thresholds
+
+
+# Working (resize and normalise) and analysis (0-255) data types of each
+# dtype policy. Every policy analyses values in (0, 255); 'native' resizes
+# and normalises in float32 and stores the analysis values in the integer
+# type of the source image (int32 for float images), so a uint16 image is
+# still scaled to (0, 255), not to its full range.
+DTYPE_POLICIES = {
+    'float64': (np.float64, np.int64),
+    'float32': (np.float32, np.int32),
+    'native': (np.float32, None)
+}
+
+
+def scale_frame(frame, policy='float64', source_dtype=np.uint8):
+    """Rescale a frame from (0, 1) to (0, 255) in the analysis data type of a
+    dtype policy.
+
+    :param frame: image of shape (height, width, channels)
+    :type frame: numpy array
+    :param policy: dtype policy, defaults to 'float64'
+    :type policy: string, optional
+    :param source_dtype: data type of the source image, which the 'native'
+    policy stores the (0, 255) values in, defaults to uint8
+    :type source_dtype: numpy dtype, optional
+
+    :return: rescaled image
+    :rtype: numpy array
+    """
+    work, out = DTYPE_POLICIES[policy]
+    if out is None:
+        out = np.dtype(source_dtype).newbyteorder('=')
+        if not np.issubdtype(out, np.integer):
+            out = np.int32
+    frame = np.multiply(frame, 255, dtype=work)
+    info = np.iinfo(out)
+    np.clip(frame, info.min, info.max, out=frame)
+    return frame.astype(out)
+
+
+class thresholded_frames():
+    """Read-only view of a normalised stack in which values below the
+    threshold are set to zero. The mask is applied only to the slices that are
+    indexed, so no second full-size stack is held in memory.
+
+    :param frames: normalised stack of shape (height, width, channels, frames)
+    :type frames: numpy array
+    :param threshold: values below this are set to zero, either one value or
+    one per channel and frame
+    :type threshold: float or numpy array of shape (channels, frames)
+    :param channels: which channels to threshold, defaults to all of them
+    :type channels: list of bool, optional
+    """
+    def __init__(self, frames, threshold, channels=None):
+        self.frames = frames
+        self.threshold = threshold
+        if channels is None:
+            channels = [True] * frames.shape[2]
+        self.channels = np.asarray(channels, dtype=bool)
+        # Per channel and frame cutoffs; channels left alone never trim.
+        self.cutoffs = np.empty(frames.shape[2:])
+        self.cutoffs[...] = threshold
+        self.cutoffs[~self.channels] = -np.inf
+        self.shape = frames.shape
+        self.dtype = frames.dtype
+        self.ndim = 4
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        out = self[:, :, :, :]
+        return out if dtype is None else out.astype(dtype)
+
+    def with_threshold(self, threshold, channels=None):
+        """Re-apply a new threshold to the same normalised stack. Only the
+        cutoffs are recomputed; the stack is neither copied nor re-read.
+
+        :param threshold: values below this are set to zero, either one value
+        or one per channel and frame
+        :type threshold: float or numpy array of shape (channels, frames)
+        :param channels: which channels to threshold, defaults to the
+        channels of this view
+        :type channels: list of bool, optional
+
+        :return: thresholded view of the same stack
+        :rtype: thresholded_frames
+        """
+        if channels is None:
+            channels = self.channels
+        return thresholded_frames(self.frames, threshold, channels)
+
+    def mask_cutoffs(self, n):
+        """Smallest value kept in each channel of frame n. Two thresholds
+        which trim the same pixels of a frame give the same mask cutoffs, so
+        these identify the thresholded frame without comparing whole masks.
+
+        :param n: index of the frame
+        :type n: integer
+
+        :return: smallest kept value of each channel, inf if all of a
+        channel is trimmed
+        :rtype: numpy array of shape (channels,)
+        """
+        frame = self.frames[:, :, :, n]
+        kept = np.where(frame >= self.cutoffs[:, n], frame, np.inf)
+        return kept.min(axis=(0, 1))
+
+    def changed_frames(self, other):
+        """Frames whose mask differs between this view and another view of the
+        same stack, found with one comparison pass over the frames whose
+        cutoffs differ.
+
+        :param other: another thresholded view of the same stack
+        :type other: thresholded_frames
+
+        :return: indices of the frames with a different mask
+        :rtype: list of integers
+        """
+        if other.frames is not self.frames:
+            raise ValueError("Masks can only be compared on the same stack")
+        candidates = np.flatnonzero(np.any(self.cutoffs != other.cutoffs,
+                                           axis=0))
+        return [int(n) for n in candidates
+                if np.any(self.mask_cutoffs(n) != other.mask_cutoffs(n))]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (4 - len(key))
+        # Keep every axis while masking so the channel axis stays in place.
+        squeeze = [i for i, k in enumerate(key) if isinstance(k, (int, np.integer))]
+        key = [slice(k, k + 1 or None) if i in squeeze else k
+               for i, k in enumerate(key)]
+        data = self.frames[key[0], key[1], :, key[3]]
+        trim = data < self.cutoffs[np.newaxis, np.newaxis, :, key[3]]
+        data = np.where(trim, 0, data)[:, :, key[2]]
+        return np.squeeze(data, axis=tuple(squeeze)) if squeeze else data
 
 
 class pipeline_object():
@@ -19,8 +164,15 @@ class pipeline_object():
     :type outpath:
     :param threshold: threshold, defaults to False
     :type threshold: bool, optional
+    :param lazy: memory-map or decode the stack page by page on demand rather
+    than reading it all into memory, defaults to False
+    :type lazy: bool, optional
+    :param dtype: dtype policy, one of 'float64', 'float32' or 'native',
+    defaults to 'float64'
+    :type dtype: string, optional
     """
-    def __init__(self, inpath, outpath, threshold=False):
+    def __init__(self, inpath, outpath, threshold=False, lazy=False,
+                 dtype='float64'):
         # Some error handling to make sure the image file exists.
         if not os.path.exists(inpath):
             raise ValueError('File to be accessed does not exist.')
@@ -33,62 +185,66 @@ class pipeline_object():
         if ((not isinstance(threshold, float)) and (threshold is not False)):
             raise TypeError('Invalid type for threshold.')
         self.threshold = threshold
-        im = tifffile.imread(self.filepath)
-
-        # Find out which dimensions are which and order correctly.
-        with open(self.filepath, 'rb') as f:
-            tags = exifread.process_file(f)
-
-        dims_xyc = {'h': int(tags['Image ImageLength'].printable),
-                    'w': int(tags['Image ImageWidth'].printable),
-                    'c': 3}
-        old_pos = {}
-
-        for k, v in dims_xyc.items():
-            found_idx = im.shape.index(v)
-            if found_idx in old_pos.values():
-                shapecopy = list(im.shape)
-                del shapecopy[found_idx]
-                new_idx = shapecopy.index(v)
-                if new_idx >= found_idx:
-                    old_pos[k] = new_idx + 1
-                else:
-                    old_pos[k] = new_idx
-            else:    
-                old_pos[k] = found_idx
-
-        for v in im.shape:
-            if v not in dims_xyc.values():
-                old_pos['f'] = im.shape.index(v)
-
-        self.frames = np.moveaxis(im, (old_pos['f'], old_pos['c'],
-                                       old_pos['h'], old_pos['w']),
-                                  (3, 2, 0, 1))
+        if dtype not in DTYPE_POLICIES:
+            raise ValueError("dtype must be one of %s"
+                             % ", ".join(DTYPE_POLICIES))
+        self.dtype = dtype
+        self.lazy = lazy
+        # Dimensions and axis order come from the tags parsed on opening.
+        if lazy:
+            # Frames are only read from disk when a stage indexes them.
+            self.header = read_header(self.filepath)
+            self.frames = open_frames(self.filepath)
+            # Kept so that the file can be closed once the frames are loaded
+            self._source = self.frames
+        else:
+            with tifffile.TiffFile(self.filepath) as tif:
+                self.header = tiff_header(tif)
+                im = tif.asarray()
+            self.frames = np.moveaxis(im, self.header.order, (0, 1, 2, 3))
 
         self.smallest_dim = min(self.frames.shape[0:2])
 
-    def reshape(self):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Close the file a lazy object reads its frames from. Frames which
+        were already loaded, e.g. by reshape or normalise_all, stay usable.
+        """
+        source = getattr(self, '_source', None)
+        self._source = None
+        if hasattr(source, 'close'):
+            source.close()
+
+    def reshape(self, dtype=None, n_jobs=1):
         """Reshapes an image such that the dimensions are square, using the dimension
         of the smallest side.
 
+        :param dtype: data type of the resized image, defaults to the working
+        type of the dtype policy
+        :type dtype: numpy dtype, optional
+        :param n_jobs: number of frames to resize concurrently, defaults to 1
+        :type n_jobs: int, optional
+
         :return: resized image
         :rtype: class object, image array
         """
 
+        if dtype is None:
+            dtype = DTYPE_POLICIES[self.dtype][0]
         # Find smallest dimension n and set image size to square n x n.
-        newframes = np.empty((self.smallest_dim, self.smallest_dim,
-                             self.frames.shape[2], self.frames.shape[3]))
-        for i in range(self.frames.shape[3]):
-            for j in range(self.frames.shape[2]):
-                newframes[:, :, j, i] = cv2.resize(self.frames[:, :, j, i],
-                            (self.smallest_dim, self.smallest_dim),
-                             interpolation=cv2.INTER_CUBIC)
-        self.frames = newframes
+        self.frames = resample_frames(self.frames, self.smallest_dim,
+                                      dtype=dtype, n_jobs=n_jobs)
         return
 
     def normalise(self, j):
         """Minmax rescale a 2D image at index j, where
-        j is the channel index.
+        j is the channel index. The threshold is not applied here, see
+        normalise_all.
 
         :param j: index of channel
         :type j: integer
@@ -102,33 +258,93 @@ class pipeline_object():
 
         if len(np.shape(im_3D)) != 3:
             raise ValueError("Input image should have three dimensions")
-        if im_3D.all() == 0 or (im_3D.max()-im_3D.min() == 0):
+        im_min, im_max = im_3D.min(), im_3D.max()
+        if im_3D.all() == 0 or (im_max-im_min == 0):
             return False
-        elif self.threshold:
-            im_3D = (im_3D-im_3D.min())/(im_3D.max()-im_3D.min())
-            trim = im_3D < self.threshold
-            im_3D[trim] = 0
-            self.frames[:, :, j, :] = im_3D
-            return True
+        if np.issubdtype(im_3D.dtype, np.floating):
+            # Rescale in place, in the precision of the frames.
+            im_3D -= im_min
+            im_3D /= (im_max-im_min)
         else:
-            self.frames[:, :, j, :] = (im_3D-im_3D.min())/(im_3D.max()-im_3D.min())
-            return True
+            im_3D = (im_3D-im_min)/(im_max-im_min)
+        self.frames[:, :, j, :] = im_3D
+        return True
 
     def normalise_all(self):
-        """Rescale RGB image using minmax rescaling
-
-        :param im_3d: input RGB image
-        :type im_3d: numpy array
+        """Rescale RGB image using minmax rescaling. If the object has a
+        threshold, the frames become a thresholded view of the retained
+        normalised stack, so the threshold can later be changed without
+        normalising again.
 
         :return:
         :rtype: bool
         """
 
-        for j in range(self.frames.shape[2]):
-            self.normalise(j)
+        if not isinstance(self.frames, np.ndarray) or \
+                not self.frames.flags.writeable:
+            # Lazy stacks are read-only, so load them before rescaling.
+            self.frames = np.array(self.frames)
+        # Record which channels were rescaled so thresholds can be derived.
+        self.rescaled = [self.normalise(j)
+                         for j in range(self.frames.shape[2])]
+        if self.threshold:
+            self.frames = thresholded_frames(self.frames, self.threshold,
+                                             self.rescaled)
 
         return True
 
+    def scaled(self, n):
+        """Rescale frame n from (0, 1) to (0, 255) in the analysis data type
+        of the dtype policy.
+
+        :param n: index of the frame
+        :type n: integer
+
+        :return: image of shape (height, width, channels)
+        :rtype: numpy array
+        """
+        return scale_frame(self.frames[:, :, :, n], self.dtype,
+                           self.header.dtype)
+
+    def thresholded(self, threshold, channels=(0, 1)):
+        """Derive a thresholded pipeline object from this normalised one
+        without copying or re-reading the image data. With threshold='costes'
+        the thresholds of the given pair of channels are found automatically
+        for every frame using Costes' method.
+
+        :param threshold: values below this are set to zero, or 'costes'
+        :type threshold: float, bool or string
+        :param channels: channels to threshold in 'costes' mode, defaults to
+        (0, 1)
+        :type channels: list of integers of length 2, optional
+
+        :return: pipeline object whose frames are a thresholded view, with
+        the cutoff of every channel and frame in its thresholds attribute
+        :rtype: pipeline_object
+        """
+        if ((not isinstance(threshold, float)) and (threshold is not False)
+                and threshold != 'costes'):
+            raise TypeError('Invalid type for threshold.')
+        derived = copy.copy(self)
+        derived.threshold = threshold
+        rescaled = getattr(self, 'rescaled', None)
+        # Thresholds are always applied to the normalised stack, so
+        # re-thresholding a thresholded object does not compound.
+        frames = self.frames
+        if isinstance(frames, thresholded_frames):
+            frames = frames.frames
+        derived.frames = frames
+        if threshold == 'costes':
+            cutoffs = np.full(frames.shape[2:], -np.inf)
+            cutoffs[list(channels)] = costes_thresholds(frames, channels)
+            derived.frames = thresholded_frames(frames, cutoffs)
+        elif threshold:
+            derived.frames = thresholded_frames(frames, threshold, rescaled)
+        else:
+            return derived
+        derived.thresholds = derived.frames.cutoffs
+        return derived
+
     def visualise(self):
         """Visualise the stack of RGB images
         """
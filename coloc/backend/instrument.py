@@ -0,0 +1,168 @@
+from contextlib import contextmanager
+import cProfile
+import json
+import os
+import time
+import uuid
+
+# Counters recorded for every stage, on top of its wall and CPU time.
+COUNTERS = ('bytes_read', 'bytes_written', 'items')
+
+
+def file_size(path):
+    """Size of a file in bytes, 0 if it does not exist."""
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class run_log():
+    """Records the wall time, CPU time, bytes read and written and number of
+    items of every pipeline stage, and writes each record as one JSON line.
+    The log can be sent to worker processes, which append to the same file,
+    or which keep their records in memory to be sent back and written by the
+    parent. Every record carries the id of the run, so several runs can share one
+    file and each is totalled on its own.
+
+    Optionally one named stage is run under cProfile; its statistics,
+    accumulated over every time the stage runs in a process, are written next
+    to the log as profile_<stage>_<pid>.prof for use with pstats or snakeviz.
+
+    :param path: JSON lines file to append records to, defaults to None
+    (records are only kept in memory)
+    :type path: string or os.path, optional
+    :param profile: name of the stage to profile, defaults to None
+    :type profile: string, optional
+    :param run: id of the run, defaults to None (a new id is made)
+    :type run: string, optional
+    :param memory: only keep the records in memory, even if there is a path,
+    which then only places the profiles, defaults to False
+    :type memory: bool, optional
+    """
+    def __init__(self, path=None, profile=None, run=None, memory=False):
+        self.path = path
+        self.profile = profile
+        self.run = run or uuid.uuid4().hex
+        self.memory = memory
+        self.records = []
+        self._file = None
+        self._profiler = None
+
+    def __getstate__(self):
+        # Each process opens its own handle and keeps its own records.
+        return {'path': self.path, 'profile': self.profile, 'run': self.run,
+                'memory': self.memory}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @contextmanager
+    def stage(self, name, frame=None, **counters):
+        """Time a stage. The yielded record can be updated with counters, e.g.
+        record['bytes_written'] += size, before the stage ends.
+
+        :param name: name of the stage
+        :type name: string
+        :param frame: index of the frame the stage works on, defaults to None
+        :type frame: int, optional
+        :return: record of the stage
+        :rtype: dictionary
+        """
+        record = {'stage': name, 'frame': frame, 'run': self.run,
+                  'pid': os.getpid(), 'start': time.time()}
+        record.update({k: 0 for k in COUNTERS})
+        record.update(counters)
+        profile = name == self.profile
+        if profile:
+            if self._profiler is None:
+                self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            record['wall'] = time.perf_counter() - wall
+            record['cpu'] = time.process_time() - cpu
+            if profile:
+                self._profiler.disable()
+                self._dump_profile()
+            self.write(record)
+
+    def write(self, record):
+        """Keep a record and append it to the log file.
+
+        :param record: record of a stage
+        :type record: dictionary
+        """
+        self.records.append(record)
+        if self.path is None or self.memory:
+            return
+        if self._file is None:
+            self._file = open(self.path, 'a')
+        self._file.write(json.dumps(record, default=float) + '\n')
+        self._file.flush()
+
+    def take(self):
+        """Remove and return the records kept in memory, e.g. to send the
+        records of a worker process back to the parent.
+
+        :return: records
+        :rtype: list of dictionaries
+        """
+        records, self.records = self.records, []
+        return records
+
+    def _dump_profile(self):
+        folder = os.path.dirname(os.path.abspath(self.path or '.'))
+        self._profiler.dump_stats(os.path.join(
+            folder, 'profile_%s_%s.prof' % (self.profile, os.getpid())))
+
+    def summary(self, records=None):
+        """Totals of every stage in order of first appearance.
+
+        :param records: records to total, defaults to the records of this
+        process
+        :type records: list of dictionaries, optional
+        :return: stage name to totals of calls, wall, cpu and counters
+        :rtype: dictionary
+        """
+        totals = {}
+        for record in records if records is not None else self.records:
+            total = totals.setdefault(record['stage'], dict.fromkeys(
+                ('calls', 'wall', 'cpu') + COUNTERS, 0))
+            total['calls'] += 1
+            for key in ('wall', 'cpu') + COUNTERS:
+                total[key] += record.get(key, 0)
+        return totals
+
+    def read(self):
+        """Records of every process of this run, read back from the log
+        file. Records of earlier runs appended to the same file are skipped.
+
+        :return: records
+        :rtype: list of dictionaries
+        """
+        if self.path is None or self.memory or \
+                not os.path.exists(self.path):
+            return list(self.records)
+        with open(self.path) as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        return [r for r in records if r.get('run') == self.run]
+
+    def print_summary(self, records=None):
+        """Print the totals of every stage."""
+        print("Stage timings")
+        print("\t%-16s %6s %9s %9s %10s %10s" % ('stage', 'calls', 'wall s',
+                                                'cpu s', 'read MB',
+                                                'written MB'))
+        for name, t in self.summary(records).items():
+            print("\t%-16s %6d %9.3f %9.3f %10.2f %10.2f"
+                  % (name, t['calls'], t['wall'], t['cpu'],
+                     t['bytes_read']/1e6, t['bytes_written']/1e6))
+
+    def close(self):
+        """Close the log file."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,291 @@
+import numpy as np
+
+# Sums accumulated for every frame in the fused pass over a channel pair.
+MOMENTS = ('n', 'sx', 'sy', 'sxx', 'syy', 'sxy', 'sx_coloc', 'sy_coloc')
+
+
+def channel_pair(stack, channels, frames):
+    """Read two channels of a range of frames as float64.
+
+    :param stack: Image data
+    :type stack: numpy array of shape (height x width x channels x frames)
+    :param channels: indices of the two channels
+    :type channels: list of integers of length 2
+    :param frames: frames to read
+    :type frames: slice
+
+    :return: the two channels, each of shape (height x width x frames)
+    :rtype: tuple of numpy arrays
+    """
+    if len(channels) != 2:
+        raise ValueError("Colocalisation compares exactly two channels")
+    return tuple(np.array(stack[:, :, c, frames], dtype=np.float64)
+                 for c in channels)
+
+
+def _per_frame(value, depth):
+    """Broadcast a scalar or per-frame threshold to one value per frame."""
+    return np.broadcast_to(np.asarray(value, dtype=np.float64), (depth,))
+
+
+def _positive_products(x, y, mx, my):
+    """Count pixels where (x - mx)*(y - my) > 0 without forming the product."""
+    return (np.count_nonzero((x > mx) & (y > my), axis=(0, 1)) +
+            np.count_nonzero((x < mx) & (y < my), axis=(0, 1)))
+
+
+def _coefficients(m, pos):
+    """Derive the colocalisation coefficients from accumulated sums."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = m['sxy'] - m['sx']*m['sy']/m['n']
+        var_x = m['sxx'] - m['sx']**2/m['n']
+        var_y = m['syy'] - m['sy']**2/m['n']
+        return {
+            'pearson': cov/np.sqrt(var_x*var_y),
+            'm1': m['sx_coloc']/m['sx'],
+            'm2': m['sy_coloc']/m['sy'],
+            'icq': pos/m['n'] - 0.5,
+            'ica': cov
+        }
+
+
+def _block_sums(m, pos, x, y, frames, t1, t2):
+    """Fill in the sums shared between every coefficient, and the count of
+    positive ICA products, of a block of frames."""
+    m['n'][frames] = x.shape[0]*x.shape[1]
+    m['sx'][frames] = x.sum(axis=(0, 1))
+    m['sy'][frames] = y.sum(axis=(0, 1))
+    m['sxx'][frames] = np.einsum('ijk,ijk->k', x, x)
+    m['syy'][frames] = np.einsum('ijk,ijk->k', y, y)
+    m['sxy'][frames] = np.einsum('ijk,ijk->k', x, y)
+    m['sx_coloc'][frames] = np.einsum('ijk,ijk->k', x, y > t2[frames])
+    m['sy_coloc'][frames] = np.einsum('ijk,ijk->k', y, x > t1[frames])
+    pos[frames] = _positive_products(x, y,
+                                     m['sx'][frames]/m['n'][frames],
+                                     m['sy'][frames]/m['n'][frames])
+
+
+def coloc_metrics(stack, channels=(0, 1), thresholds=(0, 0), block=16):
+    """Computes Pearson's correlation coefficient, Manders' M1 and M2, Li's
+    intensity correlation quotient (ICQ) and the summed ICA product
+    sum((x - mean_x)*(y - mean_y)) for every frame and for the whole stack.
+
+    All coefficients are derived from one set of sums and masks collected in
+    a single vectorised pass over each block of frames, so adding a
+    coefficient costs no extra reads of the image. Only the whole-stack ICQ,
+    which needs the whole-stack means, re-reads the frames when the stack
+    spans more than one block.
+
+    :param stack: Image data
+    :type stack: numpy array of shape (height x width x channels x frames)
+    :param channels: indices of the two channels to compare, defaults to
+    (0, 1)
+    :type channels: list of integers of length 2, optional
+    :param thresholds: intensity above which a pixel of each channel counts
+    towards Manders' coefficients, either one value or one per frame,
+    defaults to (0, 0)
+    :type thresholds: tuple of float or numpy arrays, optional
+    :param block: Number of frames to process at a time, defaults to 16
+    :type block: int, optional
+
+    :return per_frame: coefficient name to array of shape (frames,)
+    :rtype per_frame: dictionary
+    :return volume: coefficient name to value for the whole stack
+    :rtype volume: dictionary
+    """
+    depth = np.shape(stack)[3]
+    t1, t2 = [_per_frame(t, depth) for t in thresholds]
+    m = {k: np.zeros(depth) for k in MOMENTS}
+    pos = np.zeros(depth)
+    for start in range(0, depth, block):
+        frames = slice(start, min(start + block, depth))
+        x, y = channel_pair(stack, channels, frames)
+        _block_sums(m, pos, x, y, frames, t1, t2)
+    per_frame = _coefficients(m, pos)
+
+    total = {k: v.sum() for k, v in m.items()}
+    mx, my = total['sx']/total['n'], total['sy']/total['n']
+    if depth <= block:
+        total_pos = _positive_products(x, y, mx, my).sum()
+    else:
+        total_pos = 0
+        for start in range(0, depth, block):
+            x, y = channel_pair(stack, channels,
+                                slice(start, min(start + block, depth)))
+            total_pos += _positive_products(x, y, mx, my).sum()
+    volume = {k: float(v) for k, v in _coefficients(total, total_pos).items()}
+    return per_frame, volume
+
+
+class coloc_accumulator():
+    """The coefficients of coloc_metrics, collected from blocks of frames as
+    another pass over the stack reads them, so they cost no reads of their
+    own.
+
+    Every coefficient of each frame, and every whole-stack coefficient but
+    ICQ, comes from the same sums as coloc_metrics. The whole-stack ICQ
+    needs the whole-stack means before the pixels can be counted, so the
+    pixels are tabulated in a joint histogram of the two channels and
+    counted against the means at the end. Only pixels in the bin of either
+    mean can be counted on the wrong side, so with the default bins ICQ
+    differs from coloc_metrics by well under 0.01.
+
+    :param depth: number of frames in the stack
+    :type depth: int
+    :param ranges: smallest and largest value of each channel
+    :type ranges: list of two tuples of float
+    :param thresholds: intensity above which a pixel of each channel counts
+    towards Manders' coefficients, defaults to (0, 0)
+    :type thresholds: tuple of float or numpy arrays, optional
+    :param bins: number of intensity bins per channel, defaults to 1024
+    :type bins: int, optional
+    """
+    def __init__(self, depth, ranges, thresholds=(0, 0), bins=1024):
+        self.t1, self.t2 = [_per_frame(t, depth) for t in thresholds]
+        self.m = {k: np.zeros(depth) for k in MOMENTS}
+        self.pos = np.zeros(depth)
+        self.bins = bins
+        self.lows = [float(low) for low, _ in ranges]
+        self.widths = [max(high - low, np.finfo(float).eps)/bins
+                       for low, high in ranges]
+        self.hist = np.zeros(bins*bins, dtype=np.int64)
+
+    def _bin(self, values, c):
+        index = ((values - self.lows[c])/self.widths[c]).astype(np.intp)
+        return np.clip(index, 0, self.bins - 1)
+
+    def add(self, x, y, frames):
+        """Add a block of frames.
+
+        :param x: first channel
+        :type x: numpy array of shape (height x width x frames)
+        :param y: second channel
+        :type y: numpy array of shape (height x width x frames)
+        :param frames: indices of the frames in the stack
+        :type frames: slice
+        """
+        _block_sums(self.m, self.pos, x, y, frames, self.t1, self.t2)
+        self.hist += np.bincount(
+            (self._bin(x, 0)*self.bins + self._bin(y, 1)).ravel(),
+            minlength=self.bins*self.bins)
+
+    def result(self):
+        """Coefficients of the frames added so far. Frames never added have
+        coefficients of nan and are left out of the whole-stack values.
+
+        :return per_frame: coefficient name to array of shape (frames,)
+        :rtype per_frame: dictionary
+        :return volume: coefficient name to value for the whole stack
+        :rtype volume: dictionary
+        """
+        per_frame = _coefficients(self.m, self.pos)
+        total = {k: v.sum() for k, v in self.m.items()}
+        hist = self.hist.reshape(self.bins, self.bins)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mx, my = total['sx']/total['n'], total['sy']/total['n']
+        cx, cy = [self.lows[c] + (np.arange(self.bins) + 0.5)*self.widths[c]
+                  for c in (0, 1)]
+        total_pos = hist[np.ix_(cx > mx, cy > my)].sum() + \
+            hist[np.ix_(cx < mx, cy < my)].sum()
+        volume = {k: float(v)
+                  for k, v in _coefficients(total, total_pos).items()}
+        return per_frame, volume
+
+
+def _pearson(n, sx, sy, sxx, syy, sxy):
+    """Pearson's r from sums, nan where it is undefined."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = sxy - sx*sy/n
+        return cov/np.sqrt((sxx - sx**2/n)*(syy - sy**2/n))
+
+
+def costes_threshold(x, y, bins=256):
+    """Costes' automatic threshold for a pair of channels of one frame.
+
+    Intensities are binned into a 2D histogram from which the sums needed by
+    Pearson's r are tabulated as cumulative sums, so r of the pixels below
+    any pair of thresholds is found in constant time. The thresholds lie on
+    the orthogonal regression line of y on x, and the highest threshold for
+    which the pixels below it (x < t1 or y < t2) are uncorrelated is found by
+    bisection. The cost is one pass over the pixels plus O(bins**2).
+
+    :param x: first channel
+    :type x: numpy array
+    :param y: second channel
+    :type y: numpy array
+    :param bins: number of intensity bins per channel, defaults to 256
+    :type bins: int, optional
+
+    :return: thresholds of the two channels. If the channels are not
+    positively correlated, the minimum intensities are returned so nothing
+    is removed.
+    :rtype: tuple of float
+    """
+    x = np.ravel(x).astype(np.float64)
+    y = np.ravel(y).astype(np.float64)
+    x_min, y_min = x.min(), y.min()
+    x_width = max(x.max() - x_min, np.finfo(float).eps)/bins
+    y_width = max(y.max() - y_min, np.finfo(float).eps)/bins
+    ix = np.minimum(((x - x_min)/x_width).astype(np.intp), bins - 1)
+    iy = np.minimum(((y - y_min)/y_width).astype(np.intp), bins - 1)
+    hist = np.bincount(ix*bins + iy, minlength=bins*bins)
+    hist = hist.reshape(bins, bins).astype(np.float64)
+
+    # Tabulate sums over the pixels above both bins (i, j).
+    cx = (x_min + (np.arange(bins) + 0.5)*x_width)[:, np.newaxis]
+    cy = (y_min + (np.arange(bins) + 0.5)*y_width)[np.newaxis, :]
+    above = []
+    for table in (hist, hist*cx, hist*cy, hist*cx**2, hist*cy**2,
+                  hist*cx*cy):
+        table = table[::-1, ::-1].cumsum(0).cumsum(1)[::-1, ::-1]
+        above.append(np.pad(table, ((0, 1), (0, 1))))
+    total = [table[0, 0] for table in above]
+
+    n, sx, sy, sxx, syy, sxy = total
+    var_x, var_y = sxx/n - (sx/n)**2, syy/n - (sy/n)**2
+    cov = sxy/n - sx*sy/n**2
+    if cov <= 0:
+        return float(x_min), float(y_min)
+    slope = (var_y - var_x + np.sqrt((var_y - var_x)**2 + 4*cov**2))/(2*cov)
+    intercept = sy/n - slope*sx/n
+
+    def below(i):
+        t1 = x_min + i*x_width
+        j = int(np.clip(np.ceil((slope*t1 + intercept - y_min)/y_width),
+                        0, bins))
+        r = _pearson(*[t - table[i, j] for t, table in zip(total, above)])
+        return np.isnan(r) or r <= 0
+
+    # Find the highest threshold at which the remaining pixels are
+    # uncorrelated.
+    low, high = 0, bins
+    while high - low > 1:
+        mid = (low + high)//2
+        if below(mid):
+            low = mid
+        else:
+            high = mid
+    t1 = x_min + low*x_width
+    t2 = np.clip(slope*t1 + intercept, y_min, y_min + bins*y_width)
+    return float(t1), float(t2)
+
+
+def costes_thresholds(stack, channels=(0, 1), bins=256):
+    """Costes' automatic thresholds of a pair of channels for every frame.
+
+    :param stack: Image data
+    :type stack: numpy array of shape (height x width x channels x frames)
+    :param channels: indices of the two channels, defaults to (0, 1)
+    :type channels: list of integers of length 2, optional
+    :param bins: number of intensity bins per channel, defaults to 256
+    :type bins: int, optional
+
+    :return: thresholds of the two channels in each frame
+    :rtype: numpy array of shape (2 x frames)
+    """
+    depth = np.shape(stack)[3]
+    out = np.empty((2, depth))
+    for n in range(depth):
+        x, y = channel_pair(stack, channels, slice(n, n + 1))
+        out[:, n] = costes_threshold(x, y, bins)
+    return out
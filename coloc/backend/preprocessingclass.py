@@ -2,22 +2,94 @@
 # from ..backend.classes import pipeline_object
 try:
     from backend.classes import pipeline_object
+    from backend.cache import file_digest
+    from backend.instrument import file_size, run_log
 except ModuleNotFoundError:
     from ..backend.classes import pipeline_object
+    from ..backend.cache import file_digest
+    from ..backend.instrument import file_size, run_log
 
 
-def do_preprocess(sourcefile, outpath, threshold=False, visualise=False):
-    pipeline_full = pipeline_object(sourcefile, outpath, threshold)
-    pipeline_original = pipeline_object(sourcefile,
-                                        outpath, threshold=False)
+def do_preprocess(sourcefile, outpath, threshold=False, visualise=False,
+                  lazy=False, dtype='float64', channels=(0, 1), cache=None,
+                  log=None):
+    """Reads, resizes and normalises an image once, and derives the
+    thresholded stack from the normalised one.
 
-    #pipeline_full.split()
-    #pipeline_original.split()
+    :param sourcefile: File path of image in directory
+    :type sourcefile: string or os.path
+    :param outpath: Path to output the result to
+    :type outpath: string
+    :param threshold: threshold, or 'costes' to find one automatically for
+    every frame, defaults to False
+    :type threshold: float, bool or string, optional
+    :param visualise: plot the processed stack, defaults to False
+    :type visualise: bool, optional
+    :param lazy: read the stack from disk on demand, defaults to False
+    :type lazy: bool, optional
+    :param dtype: dtype policy, defaults to 'float64'
+    :type dtype: string, optional
+    :param channels: channels to threshold in 'costes' mode, defaults to
+    (0, 1)
+    :type channels: list of integers of length 2, optional
+    :param cache: cache of normalised stacks, keyed by the file contents and
+    dtype policy, defaults to None
+    :type cache: stage_cache, optional
+    :param log: log recording the time taken by each stage, defaults to None
+    :type log: run_log, optional
 
-    pipeline_full.reshape()
-    pipeline_original.reshape()
-    pipeline_full.normalise_all()
-    pipeline_original.normalise_all()
+    :return: normalised and thresholded pipeline objects
+    :rtype: tuple of pipeline_object
+    """
+    if ((not isinstance(threshold, float)) and (threshold is not False)
+            and threshold != 'costes'):
+        raise TypeError('Invalid type for threshold.')
+    if log is None:
+        log = run_log()
+
+    def normalised():
+        with log.stage('read', bytes_read=file_size(sourcefile)) as record:
+            pipeline = pipeline_object(sourcefile, outpath, threshold=False,
+                                       lazy=lazy, dtype=dtype)
+            record['items'] = pipeline.frames.shape[-1]
+        # Normalising loads the frames, after which the file can be closed
+        with pipeline:
+            with log.stage('reshape', items=pipeline.frames.shape[-1]):
+                pipeline.reshape()
+            with log.stage('normalise', items=pipeline.frames.shape[-1]):
+                pipeline.normalise_all()
+        return pipeline
+
+    if cache is None:
+        pipeline_original = normalised()
+    else:
+        stored = {}
+
+        def compute():
+            stored['pipeline'] = normalised()
+            return {'frames': stored['pipeline'].frames,
+                    'rescaled': stored['pipeline'].rescaled}
+
+        with log.stage('cache_preprocess') as record:
+            arrays = cache.cached('preprocess', compute,
+                                  file=file_digest(sourcefile), dtype=dtype)
+            # A miss is read and counted by the 'read' stage
+            record['bytes_read'] = (0 if 'pipeline' in stored
+                                    else arrays['frames'].nbytes)
+        if 'pipeline' in stored:
+            pipeline_original = stored['pipeline']
+        else:
+            # Only the header is read; the frames come from the cache.
+            pipeline_original = pipeline_object(sourcefile, outpath,
+                                                threshold=False, lazy=True,
+                                                dtype=dtype)
+            pipeline_original.close()
+            pipeline_original.frames = arrays['frames']
+            pipeline_original.rescaled = [bool(r) for r in
+                                          arrays['rescaled']]
+            pipeline_original.smallest_dim = arrays['frames'].shape[0]
+    with log.stage('threshold', items=pipeline_original.frames.shape[-1]):
+        pipeline_full = pipeline_original.thresholded(threshold, channels)
     if visualise:
         pipeline_full.visualise()
 
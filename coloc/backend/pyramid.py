@@ -0,0 +1,144 @@
+from collections import OrderedDict
+import numpy as np
+import cv2
+
+# Side length of the square tiles each pyramid level is cut into.
+TILE_SIZE = 256
+
+
+def level_shapes(shape, tile_size=TILE_SIZE):
+    """Height and width of every level of the pyramid of an image of the
+    given shape, each half the size of the one before, rounded up, until it
+    fits in a single tile.
+
+    :param shape: Shape of the image
+    :type shape: tuple
+    :param tile_size: Side length of the tiles, defaults to TILE_SIZE
+    :type tile_size: int, optional
+    :return: (height, width) of each level, from the full image to the
+    smallest
+    :rtype: list of tuples
+    """
+    shapes = [tuple(shape[:2])]
+    while max(shapes[-1]) > tile_size:
+        h, w = shapes[-1]
+        shapes.append(((h + 1)//2, (w + 1)//2))
+    return shapes
+
+
+class lazy_pyramid():
+    """Pyramid of an image, downsampled by halves until it fits in a single
+    tile, whose levels are only made when they are asked for. Each level is
+    made from the nearest finer level which is kept, and the image is only
+    loaded when there is none. Every coarse level is kept once made, which
+    together take at most a third of the memory of the image, while at most
+    max_fine of the full resolution and half resolution levels are kept.
+
+    :param load: Function returning the full resolution image
+    :type load: function
+    :param shape: Shape of the image
+    :type shape: tuple
+    :param tile_size: Side length of the tiles, defaults to TILE_SIZE
+    :type tile_size: int, optional
+    :param max_fine: Number of the levels 0 and 1 kept, defaults to 1
+    :type max_fine: int, optional
+    """
+    def __init__(self, load, shape, tile_size=TILE_SIZE, max_fine=1):
+        self.load = load
+        self.shapes = level_shapes(shape, tile_size)
+        self.max_fine = max_fine
+        self._levels = {}
+        # Levels 0 and 1 kept, least recently used first
+        self._fine = OrderedDict()
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def level(self, n):
+        """One level of the pyramid, made now if it is not kept.
+
+        :param n: Index of the level, 0 for the full image
+        :type n: int
+        :return: Level
+        :rtype: numpy array
+        """
+        if n not in self._levels:
+            finer = [k for k in self._levels if k < n]
+            if finer:
+                k = max(finer)
+                level = self._levels[k]
+            else:
+                k, level = 0, np.ascontiguousarray(self.load())
+                self._keep(0, level)
+            for k in range(k + 1, n + 1):
+                h, w = self.shapes[k]
+                level = cv2.resize(level, (w, h),
+                                   interpolation=cv2.INTER_AREA)
+                self._keep(k, level)
+        if n in self._fine:
+            self._fine.move_to_end(n)
+        return self._levels[n]
+
+    def _keep(self, n, level):
+        self._levels[n] = level
+        if n > 1:
+            return
+        self._fine[n] = None
+        self._fine.move_to_end(n)
+        while len(self._fine) > self.max_fine:
+            del self._levels[self._fine.popitem(last=False)[0]]
+
+
+def choose_level(scale, n_levels):
+    """Coarsest pyramid level with at least one pixel per screen pixel.
+
+    :param scale: Screen pixels per full resolution pixel
+    :type scale: float
+    :param n_levels: Number of levels of the pyramid
+    :type n_levels: int
+    :return: Index of the level to display
+    :rtype: int
+    """
+    if scale >= 1:
+        return 0
+    return int(min(np.floor(np.log2(1/scale)), n_levels - 1))
+
+
+def visible_tiles(shape, rect, tile_size=TILE_SIZE):
+    """Tiles of a pyramid level which overlap a rectangle.
+
+    :param shape: Shape of the level
+    :type shape: tuple
+    :param rect: (left, top, right, bottom) in pixels of the level
+    :type rect: tuple of floats
+    :param tile_size: Side length of the tiles, defaults to TILE_SIZE
+    :type tile_size: int, optional
+    :return: (row, column) of each tile
+    :rtype: list of tuples
+    """
+    h, w = shape[:2]
+    left, top, right, bottom = rect
+    cols = range(max(int(left//tile_size), 0),
+                 min(int(np.ceil(right/tile_size)), -(-w//tile_size)))
+    rows = range(max(int(top//tile_size), 0),
+                 min(int(np.ceil(bottom/tile_size)), -(-h//tile_size)))
+    return [(row, col) for row in rows for col in cols]
+
+
+def get_tile(level, row, col, tile_size=TILE_SIZE):
+    """View of one tile of a pyramid level. Tiles on the right and bottom
+    edges may be smaller than tile_size.
+
+    :param level: Level of the pyramid
+    :type level: numpy array
+    :param row: Tile row
+    :type row: int
+    :param col: Tile column
+    :type col: int
+    :param tile_size: Side length of the tiles, defaults to TILE_SIZE
+    :type tile_size: int, optional
+    :return: Tile
+    :rtype: numpy array
+    """
+    return level[row*tile_size:(row + 1)*tile_size,
+                 col*tile_size:(col + 1)*tile_size]
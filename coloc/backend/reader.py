@@ -0,0 +1,194 @@
+import os
+from functools import lru_cache
+import numpy as np
+import tifffile
+
+
+def frame_axes(axes):
+    """Maps the axes of a tifffile series onto the pipeline order
+    (height, width, channels, frames).
+
+    :param axes: tifffile axes string, e.g. 'ZYXS' or 'ZCYX'
+    :type axes: string
+
+    :raises ValueError: The series is not a 4D multichannel stack
+
+    :return: position of the height, width, channel and frame axes in the
+    series
+    :rtype: tuple of integers
+    """
+    if len(axes) != 4:
+        raise ValueError("Expected a 4D stack of multichannel images, "
+                         "got axes '%s'" % axes)
+    chan = 'S' if 'S' in axes else 'C'
+    if 'Y' not in axes or 'X' not in axes or chan not in axes:
+        raise ValueError("Could not identify the image axes in '%s'" % axes)
+    others = [i for i, a in enumerate(axes) if a not in ('Y', 'X', chan)]
+    return (axes.index('Y'), axes.index('X'), axes.index(chan), others[0])
+
+
+class tiff_header():
+    """Metadata of a .tiff stack, parsed from the tags tifffile reads when the
+    file is opened. No pixel data is decoded.
+
+    :param tif: open tifffile handle
+    :type tif: tifffile.TiffFile
+    """
+    def __init__(self, tif):
+        series = tif.series[0]
+        keyframe = series.keyframe
+        self.filepath = tif.filehandle.path
+        self.axes = series.axes
+        self.series_shape = tuple(series.shape)
+        self.order = frame_axes(self.axes)
+        self.height, self.width, self.channels, self.frames = \
+            (self.series_shape[i] for i in self.order)
+        self.dtype = np.dtype(tif.byteorder + series.dtype.char)
+        self.compression = int(keyframe.compression)
+        self.page_count = len(tif.pages)
+        # Offset of the image data if it is stored contiguously, else None.
+        self.dataoffset = getattr(series, 'dataoffset',
+                                  getattr(series, 'offset', None))
+
+    @property
+    def shape(self):
+        """Shape of the stack in (height, width, channels, frames) order."""
+        return (self.height, self.width, self.channels, self.frames)
+
+    @property
+    def compressed(self):
+        """Whether the pages are compressed."""
+        return self.compression != 1
+
+    @property
+    def memmappable(self):
+        """Whether the image data can be memory-mapped."""
+        return self.dataoffset is not None and not self.compressed
+
+    def __repr__(self):
+        return "tiff_header(%s, shape=%s, axes='%s', dtype=%s)" % (
+            os.path.basename(self.filepath), self.shape, self.axes,
+            self.dtype)
+
+
+@lru_cache(maxsize=256)
+def _cached_header(inpath, mtime, size):
+    with tifffile.TiffFile(inpath) as tif:
+        return tiff_header(tif)
+
+
+def read_header(inpath):
+    """Read the header of a .tiff stack. Results are cached until the file
+    is modified, so files can be inspected repeatedly without reopening them.
+
+    :param inpath: File path of image in directory
+    :type inpath: string or os.path
+
+    :return: dimensions, axis order, dtype, compression and page count
+    :rtype: tiff_header
+    """
+    stat = os.stat(inpath)
+    return _cached_header(os.path.abspath(inpath), stat.st_mtime_ns,
+                          stat.st_size)
+
+
+class lazy_stack():
+    """Read-only view of a compressed .tiff stack which decodes pages on
+    demand. Indexing follows the (height, width, channels, frames) order of
+    pipeline_object.frames, and only the pages covering the requested frames
+    are decoded.
+
+    :param inpath: File path of image in directory
+    :type inpath: string or os.path
+    """
+    def __init__(self, inpath):
+        self._tif = tifffile.TiffFile(inpath)
+        series = self._tif.series[0]
+        self._series_shape = tuple(series.shape)
+        self._page_shape = tuple(series.keyframe.shape)
+        self._order = frame_axes(series.axes)
+        # Axes which are not stored within a page index the pages.
+        self._n_lead = len(self._series_shape) - len(self._page_shape)
+        self.dtype = series.dtype
+        self.shape = tuple(self._series_shape[i] for i in self._order)
+        self.ndim = 4
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        out = self[:, :, :, :]
+        return out if dtype is None else out.astype(dtype)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if Ellipsis in key:
+            i = key.index(Ellipsis)
+            fill = (slice(None),) * (4 - len(key) + 1)
+            key = key[:i] + fill + key[i+1:]
+        key = key + (slice(None),) * (4 - len(key))
+        if len(key) != 4:
+            raise IndexError("Too many indices for a 4D stack")
+
+        frames = np.arange(self.shape[3])[key[3]]
+        data = self._decode(np.atleast_1d(frames))
+        data = data[key[0], key[1], key[2]]
+        if np.ndim(frames) == 0:
+            data = data[..., 0]
+        return data
+
+    def frame(self, n):
+        """Decode a single frame.
+
+        :param n: index of the frame
+        :type n: integer
+
+        :return: image of shape (height, width, channels)
+        :rtype: numpy array
+        """
+        return self[:, :, :, n]
+
+    def _decode(self, frames):
+        """Decode the pages holding the given frames and return them in
+        (height, width, channels, frames) order.
+        """
+        f_axis = self._order[3]
+        lead = [np.arange(n) for n in self._series_shape[:self._n_lead]]
+        if f_axis < self._n_lead:
+            lead[f_axis] = frames
+        grid = np.meshgrid(*lead, indexing='ij')
+        pages = np.ravel_multi_index(grid, self._series_shape[:self._n_lead])
+        data = self._tif.asarray(key=[int(p) for p in pages.ravel()],
+                                 series=0)
+        shape = list(self._series_shape)
+        for i, idx in enumerate(lead):
+            shape[i] = len(idx)
+        data = data.reshape(shape)
+        if f_axis >= self._n_lead:
+            data = np.take(data, frames, axis=f_axis)
+        return np.moveaxis(data, self._order, (0, 1, 2, 3))
+
+    def close(self):
+        """Close the underlying file handle."""
+        self._tif.close()
+
+
+def open_frames(inpath):
+    """Open a .tiff stack without reading its pixels into memory.
+    Uncompressed files are memory-mapped, compressed files are wrapped in a
+    lazy_stack which decodes pages on demand.
+
+    :param inpath: File path of image in directory
+    :type inpath: string or os.path
+
+    :return: stack of shape (height, width, channels, frames)
+    :rtype: numpy memmap view or lazy_stack
+    """
+    header = read_header(inpath)
+    if not header.memmappable:
+        # Compressed or fragmented image data cannot be mapped.
+        return lazy_stack(inpath)
+    im = np.memmap(inpath, dtype=header.dtype, mode='r',
+                   offset=header.dataoffset, shape=header.series_shape)
+    return np.moveaxis(im, header.order, (0, 1, 2, 3))
@@ -0,0 +1,154 @@
+import numpy as np
+import cv2
+
+# Size of the drawn panels relative to the image, so circles and titles stay
+# legible on small images.
+MIN_PANEL_SIZE = 400
+TITLE_HEIGHT = 40
+LABEL_HEIGHT = 28
+MARGIN = 10
+CIRCLE_RADIUS = 5
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+
+
+def to_rgb8(frame):
+    """Convert a frame in (0, 255) to an 8-bit RGB image as imshow displays
+    it. Single channel images are shown in grey, a missing third channel is
+    left black and channels after the third are dropped.
+
+    :param frame: Image data
+    :type frame: Numpy array of shape (height x width x channels)
+    :return: RGB image
+    :rtype: Numpy array of shape (height x width x 3) of uint8
+    """
+    frame = np.asarray(frame)
+    if frame.ndim == 2:
+        frame = frame[:, :, np.newaxis]
+    if frame.shape[2] == 1:
+        frame = np.repeat(frame, 3, axis=2)
+    rgb = np.zeros(frame.shape[:2] + (3,), dtype=np.uint8)
+    c = min(frame.shape[2], 3)
+    np.clip(frame[:, :, :c], 0, 255, out=rgb[:, :, :c], casting='unsafe')
+    return rgb
+
+
+def _centre_text(canvas, text, centre_x, top, height, scale):
+    (width, text_height), _ = cv2.getTextSize(text, FONT, scale, 1)
+    origin = (int(centre_x - width/2), int(top + (height + text_height)/2))
+    cv2.putText(canvas, text, origin, FONT, scale, (0, 0, 0), 1, cv2.LINE_AA)
+
+
+def render_panels(original, denoised, coords, title,
+                  titles=('Original', 'Denoised')):
+    """Draw the original and denoised images side by side with a circle
+    around every cluster, directly into an image buffer.
+
+    :param original: Input image data
+    :type original: Numpy array of shape (height x width x channels)
+    :param denoised: Denoised image data
+    :type denoised: Numpy array of shape (height x width x channels)
+    :param coords: (x, y) centre of each circle, in image pixels
+    :type coords: Array-like of shape (clusters x 2) or None
+    :param title: Figure title
+    :type title: string
+    :param titles: Panel titles, defaults to ('Original', 'Denoised')
+    :type titles: tuple of strings, optional
+    :return: RGB image
+    :rtype: Numpy array of uint8
+    """
+    h, w = np.shape(original)[:2]
+    # Upscale by a whole number so pixels stay square and sharp.
+    zoom = max(1, -(-MIN_PANEL_SIZE // max(h, w)))
+    ph, pw = h*zoom, w*zoom
+    top = TITLE_HEIGHT + LABEL_HEIGHT
+    canvas = np.full((top + ph + MARGIN, 3*MARGIN + 2*pw, 3), 255,
+                     dtype=np.uint8)
+    _centre_text(canvas, title, canvas.shape[1]/2, 0, TITLE_HEIGHT, 0.8)
+    for i, (image, label) in enumerate(zip((original, denoised), titles)):
+        left = MARGIN + i*(pw + MARGIN)
+        panel = canvas[top:top + ph, left:left + pw]
+        panel[...] = cv2.resize(to_rgb8(image), (pw, ph),
+                                interpolation=cv2.INTER_NEAREST)
+        _centre_text(canvas, label, left + pw/2, TITLE_HEIGHT, LABEL_HEIGHT,
+                     0.6)
+        if coords is None:
+            continue
+        for x, y in np.reshape(coords, (-1, 2)):
+            centre = (int(round((x + 0.5)*zoom)), int(round((y + 0.5)*zoom)))
+            cv2.circle(panel, centre, CIRCLE_RADIUS*zoom, (255, 255, 255), 1,
+                       cv2.LINE_AA)
+    return canvas
+
+
+def save_png(path, image, compression=1):
+    """Encode an RGB image as a PNG file.
+
+    :param path: Output file path
+    :type path: string
+    :param image: RGB image
+    :type image: Numpy array of shape (height x width x 3) of uint8
+    :param compression: zlib compression level from 0 (fastest, largest) to
+    9 (slowest, smallest), defaults to 1
+    :type compression: int, optional
+    """
+    ok, data = cv2.imencode('.png', cv2.cvtColor(image, cv2.COLOR_RGB2BGR),
+                            [cv2.IMWRITE_PNG_COMPRESSION, int(compression)])
+    if not ok:
+        raise ValueError("Could not encode %s" % path)
+    with open(path, 'wb') as f:
+        f.write(data.tobytes())
+
+
+def overlay_ica(original, denoised, clusters, output_dir, filename,
+                compression=1):
+    """Fast counterpart of Visualiser.plot: draws the ICA peaks on a pair of
+    images and saves them as <output_dir><filename>.png.
+
+    :param original: Input image data
+    :type original: Numpy array of shape (height x width x channels)
+    :param denoised: Denoised image data
+    :type denoised: Numpy array of shape (height x width x channels)
+    :param clusters: (y, x) coordinates of the peaks
+    :type clusters: List of tuples
+    :param output_dir: Path to output the result to
+    :type output_dir: string
+    :param filename: Name to output file as
+    :type filename: string
+    :param compression: PNG compression level, defaults to 1
+    :type compression: int, optional
+    :return: the saved image
+    :rtype: Numpy array of shape (height x width x 3) of uint8
+    """
+    coords = None
+    if clusters:
+        coords = np.asarray(clusters)[:, ::-1]
+    image = render_panels(original, denoised, coords,
+                          "Intensity Correlation Analysis")
+    save_png(output_dir + filename + '.png', image, compression)
+    return image
+
+
+def overlay_kmeans(original, denoised, clusters, output_dir, filename,
+                   compression=1):
+    """Fast counterpart of Visualiser.plot_kmeans: draws the matched cluster
+    pairs on a pair of images and saves them as <output_dir><filename>.png.
+
+    :param original: Input image data
+    :type original: Numpy array of shape (height x width x channels)
+    :param denoised: Denoised image data
+    :type denoised: Numpy array of shape (height x width x channels)
+    :param clusters: Colocalised cluster pairs from compare_dists
+    :type clusters: numpy structured array or None
+    :param output_dir: Path to output the result to
+    :type output_dir: string
+    :param filename: Name to output file as
+    :type filename: string
+    :param compression: PNG compression level, defaults to 1
+    :type compression: int, optional
+    :return: the saved image
+    :rtype: Numpy array of shape (height x width x 3) of uint8
+    """
+    coords = None if clusters is None else clusters['centroid']
+    image = render_panels(original, denoised, coords, "K-means")
+    save_png(output_dir + filename + '.png', image, compression)
+    return image
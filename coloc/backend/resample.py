@@ -0,0 +1,75 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+
+# Pixel types cv2.resize can interpolate directly.
+CV2_DTYPES = (np.uint8, np.uint16, np.int16, np.float32, np.float64)
+
+
+def resize_frame(frame, size, interpolation=cv2.INTER_CUBIC):
+    """Resize every channel of a single frame in one call.
+
+    :param frame: image of shape (height, width, channels)
+    :type frame: numpy array
+    :param size: side length of the square output
+    :type size: int
+    :param interpolation: cv2 interpolation flag, defaults to cubic
+    :type interpolation: int, optional
+
+    :return: image of shape (size, size, channels)
+    :rtype: numpy array
+    """
+    frame = np.ascontiguousarray(frame)
+    if frame.dtype.type not in CV2_DTYPES:
+        frame = frame.astype(np.float64)
+    out = cv2.resize(frame, (size, size), interpolation=interpolation)
+    # cv2 drops the channel axis of single channel images.
+    return out.reshape(size, size, frame.shape[2])
+
+
+def resample_frames(frames, size, dtype=np.float64, n_jobs=1,
+                    interpolation=cv2.INTER_CUBIC, out=None):
+    """Resize a stack of frames to size x size into a preallocated buffer.
+    Frames are read, resized and written one at a time, optionally on a pool
+    of threads (cv2 releases the GIL while resizing). Stacks which are already
+    the requested size are only cast to dtype.
+
+    :param frames: stack of shape (height, width, channels, frames)
+    :type frames: numpy array or lazy_stack
+    :param size: side length of the square output
+    :type size: int
+    :param dtype: data type of the output, defaults to float64
+    :type dtype: numpy dtype, optional
+    :param n_jobs: number of frames to resize concurrently, defaults to 1
+    :type n_jobs: int, optional
+    :param interpolation: cv2 interpolation flag, defaults to cubic
+    :type interpolation: int, optional
+    :param out: buffer of shape (size, size, channels, frames) to write into
+    :type out: numpy array, optional
+
+    :return: resized stack of shape (size, size, channels, frames)
+    :rtype: numpy array
+    """
+    h, w, c, f = frames.shape
+    if (h, w) == (size, size) and out is None:
+        return np.asarray(frames, dtype=dtype)
+    if out is None:
+        out = np.empty((size, size, c, f), dtype=dtype)
+    elif out.shape != (size, size, c, f):
+        raise ValueError("Output buffer has shape %s, expected %s"
+                         % (out.shape, (size, size, c, f)))
+
+    def work(i):
+        frame = np.asarray(frames[:, :, :, i])
+        if (h, w) == (size, size):
+            out[:, :, :, i] = frame
+        else:
+            out[:, :, :, i] = resize_frame(frame, size, interpolation)
+
+    if n_jobs == 1:
+        for i in range(f):
+            work(i)
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            list(pool.map(work, range(f)))
+    return out
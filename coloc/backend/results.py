@@ -0,0 +1,182 @@
+import csv
+import json
+import os
+import numpy as np
+
+# Columns of each results table.
+TABLES = {
+    'frames': [('frame', int), ('ica_sum', float), ('n_pairs', int),
+               ('pearson', float), ('m1', float), ('m2', float),
+               ('icq', float), ('ica', float)],
+    'ica_peaks': [('frame', int), ('rank', int), ('row', int),
+                  ('col', int)],
+    'clusters': [('frame', int), ('channel', int), ('index', int),
+                 ('row', float), ('col', float)],
+    'pairs': [('frame', int), ('index1', int), ('index2', int),
+              ('distance', float), ('x', int), ('y', int)]
+}
+FORMATS = ('csv', 'json', 'npz')
+
+
+def json_value(value):
+    """A value as JSON allows it: NaN and infinities, which are not valid
+    JSON, become null.
+
+    :param value: number, or a list or dictionary of them
+    :type value: float, list or dictionary
+    :return: the value with non-finite numbers replaced by None
+    :rtype: float, list or dictionary
+    """
+    if isinstance(value, dict):
+        return {k: json_value(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [json_value(v) for v in value]
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    return value
+
+
+def json_tables(tables):
+    """Columns of each table as lists, for writing to JSON.
+
+    :param tables: table name to structured array
+    :type tables: dictionary
+    :return: table name to column name to list of values
+    :rtype: dictionary
+    """
+    return {name: {col: json_value(table[col].tolist())
+                   for col in table.dtype.names}
+            for name, table in tables.items()}
+
+
+def frame_record(n):
+    """Empty record of the numeric results of one frame and the figures
+    saved for it, filled in by process_frame.
+
+    :param n: index of the frame
+    :type n: int
+    :return: result name to value
+    :rtype: dictionary
+    """
+    return {'frame': n, 'ica_sum': np.nan, 'ica_peaks': None,
+            'clusters': None, 'pairs': None, 'thresholds': None,
+            'figures': [], 'images': []}
+
+
+class results_writer():
+    """Collects the numeric results of every frame and writes them to
+    columnar files in the output directory: one CSV file per table, a JSON
+    file of all tables and the whole-stack metrics, in which missing values
+    are null, and an NPZ file with one structured array per table.
+
+    :param output_dir: Folder to write the results to
+    :type output_dir: string or os.path
+    :param formats: Formats to write, defaults to all of 'csv', 'json' and
+    'npz'
+    :type formats: list of strings, optional
+    :param thresholds: Channels whose Costes threshold is added to the
+    frames table as a costes_threshold_<channel> column, defaults to none
+    :type thresholds: list of integers, optional
+    """
+    def __init__(self, output_dir, formats=FORMATS, thresholds=()):
+        unknown = set(formats) - set(FORMATS)
+        if unknown:
+            raise ValueError("Unknown export formats: %s"
+                             % ", ".join(sorted(unknown)))
+        self.output_dir = output_dir
+        self.formats = list(formats)
+        self.thresholds = list(thresholds)
+        self.columns = dict(TABLES, frames=TABLES['frames'] + [
+            ('costes_threshold_%s' % c, float) for c in self.thresholds])
+        self.rows = {name: [] for name in TABLES}
+
+    def add(self, record, metrics=None):
+        """Add the results of one frame.
+
+        :param record: results of the frame, see frame_record
+        :type record: dictionary
+        :param metrics: colocalisation coefficients of the frame, defaults to
+        None
+        :type metrics: dictionary, optional
+        """
+        n = record['frame']
+        pairs = record['pairs']
+        metrics = metrics or {}
+        thresholds = record.get('thresholds') or {}
+        self.rows['frames'].append(
+            (n, record['ica_sum'], 0 if pairs is None else len(pairs)) +
+            tuple(metrics.get(k, np.nan)
+                  for k in ['pearson', 'm1', 'm2', 'icq', 'ica']) +
+            tuple(thresholds.get(c, np.nan) for c in self.thresholds))
+        if record['ica_peaks'] is not None:
+            for rank, (row, col) in enumerate(record['ica_peaks']):
+                self.rows['ica_peaks'].append((n, rank, row, col))
+        if record['clusters'] is not None:
+            for channel, centres in record['clusters'].items():
+                for i, (row, col) in enumerate(centres):
+                    self.rows['clusters'].append((n, channel, i, row, col))
+        if pairs is not None:
+            for pair in pairs:
+                x, y = pair['centroid']
+                self.rows['pairs'].append((n, pair['index1'], pair['index2'],
+                                           pair['distance'], x, y))
+
+    def table(self, name):
+        """One table as a structured array sorted by frame.
+
+        :param name: name of the table, a key of TABLES
+        :type name: string
+        :return: table
+        :rtype: numpy structured array
+        """
+        table = np.array([tuple(row) for row in self.rows[name]],
+                         dtype=self.columns[name])
+        return np.sort(table, order='frame', kind='stable')
+
+    def write(self, volume=None):
+        """Write the results to the output directory.
+
+        :param volume: whole-stack colocalisation coefficients, defaults to
+        None
+        :type volume: dictionary, optional
+        :return: paths of the files written
+        :rtype: list of strings
+        """
+        volume = volume or {}
+        tables = {name: self.table(name) for name in TABLES}
+        paths = []
+        if 'csv' in self.formats:
+            for name, table in tables.items():
+                path = os.path.join(self.output_dir, name + '.csv')
+                with open(path, 'w', newline='') as f:
+                    writer = csv.writer(f)
+                    writer.writerow(table.dtype.names)
+                    writer.writerows(table.tolist())
+                paths.append(path)
+        if 'json' in self.formats:
+            path = os.path.join(self.output_dir, 'results.json')
+            with open(path, 'w') as f:
+                json.dump({'volume': json_value(volume),
+                           **json_tables(tables)}, f, indent=1,
+                          allow_nan=False)
+            paths.append(path)
+        if 'npz' in self.formats:
+            path = os.path.join(self.output_dir, 'results.npz')
+            np.savez(path, volume=np.array(list(volume.items()),
+                                           dtype=[('name', 'U16'),
+                                                  ('value', float)]),
+                     **tables)
+            paths.append(path)
+        return paths
+
+
+def load_results(output_dir):
+    """Read the tables written by results_writer in NPZ format.
+
+    :param output_dir: Folder the results were written to
+    :type output_dir: string or os.path
+    :return: table name to structured array
+    :rtype: dictionary
+    """
+    with np.load(os.path.join(output_dir, 'results.npz')) as data:
+        return {name: data[name] for name in data.files}
@@ -0,0 +1,88 @@
+import numpy as np
+import cv2
+from scipy import ndimage
+from scipy.spatial import cKDTree
+
+# Spots found by detect_spots. row and col are the intensity-weighted
+# centroid, area the number of pixels and intensity their summed intensity.
+SPOT_DTYPE = np.dtype([('row', float), ('col', float), ('area', int),
+                       ('intensity', float)])
+
+
+def detect_spots(im, size=3, sigma=1., min_area=1):
+    """Find the spots of a thresholded image by local maximum filtering and
+    connected component labelling, in time proportional to the number of
+    pixels. Each connected patch of foreground is one spot, unless it holds
+    several local maxima of the smoothed image, in which case each of its
+    pixels joins the spot of the nearest maximum.
+
+    :param im: thresholded image data, zero in the background
+    :type im: numpy array of shape (height x width)
+    :param size: width of the window a maximum must be the largest value
+    of, defaults to 3
+    :type size: int, optional
+    :param sigma: standard deviation of the Gaussian smoothing applied
+    before finding the maxima, so that noise does not split spots, defaults
+    to 1 (0 for none)
+    :type sigma: float, optional
+    :param min_area: smaller spots are dropped, defaults to 1
+    :type min_area: int, optional
+    :return: one row per spot
+    :rtype: numpy structured array of dtype SPOT_DTYPE
+    """
+    im = np.asarray(im)
+    if im.ndim != 2:
+        raise ValueError("Expected an image of shape (height, width)")
+    foreground = im > 0
+    structure = np.ones((3, 3), dtype=bool)
+    components, n_components = ndimage.label(foreground, structure)
+    # OpenCV filters in single precision are several times faster than
+    # scipy.ndimage on large images
+    smooth = im.astype(np.float32)
+    if sigma:
+        smooth = cv2.GaussianBlur(smooth, (0, 0), sigma)
+    # A grey dilation is a maximum filter. Plateaus of equal maxima count as
+    # one peak
+    peaks = foreground & (smooth == cv2.dilate(
+        smooth, np.ones((size, size), dtype=np.uint8)))
+    markers, n_peaks = ndimage.label(peaks, structure)
+
+    pixels = np.flatnonzero(foreground)
+    component = components.ravel()[pixels]
+    rows, cols = np.unravel_index(pixels, im.shape)
+    # Component of each peak, and the peaks in each component
+    peak_pixels = np.flatnonzero(markers)
+    peak_of = markers.ravel()[peak_pixels]
+    peak_component = np.zeros(n_peaks + 1, dtype=int)
+    peak_component[peak_of] = components.ravel()[peak_pixels]
+    n_in = np.bincount(peak_component[1:], minlength=n_components + 1)
+
+    # Components with one peak, or none, are one spot each
+    spot = component.copy()
+    split = n_in[component] > 1
+    if split.any():
+        counts = np.bincount(peak_of)
+        centres = np.stack([np.bincount(peak_of, weights=r)
+                            for r in np.unravel_index(peak_pixels,
+                                                      im.shape)],
+                           axis=-1)[1:]/counts[1:, np.newaxis]
+        shared = np.flatnonzero(n_in[peak_component[1:]] > 1)
+        # Separate the components along a third axis so that pixels only
+        # find peaks of their own component
+        offset = float(sum(im.shape))
+        tree = cKDTree(np.column_stack(
+            [centres[shared], peak_component[1:][shared]*offset]))
+        _, nearest = tree.query(np.column_stack(
+            [rows[split], cols[split], component[split]*offset]))
+        spot[split] = n_components + 1 + shared[nearest]
+
+    spot_ids, spot = np.unique(spot, return_inverse=True)
+    weights = im.ravel()[pixels].astype(np.float64)
+    area = np.bincount(spot, minlength=len(spot_ids))
+    intensity = np.bincount(spot, weights, len(spot_ids))
+    spots = np.zeros(len(spot_ids), dtype=SPOT_DTYPE)
+    spots['row'] = np.bincount(spot, weights*rows, len(spot_ids))/intensity
+    spots['col'] = np.bincount(spot, weights*cols, len(spot_ids))/intensity
+    spots['area'] = area
+    spots['intensity'] = intensity
+    return spots[area >= min_area]
@@ -0,0 +1,206 @@
+import numpy as np
+try:
+    from backend.reader import open_frames, read_header
+    from backend.resample import resample_frames
+    from backend.classes import DTYPE_POLICIES, scale_frame, \
+        thresholded_frames
+    from backend.metrics import channel_pair, costes_threshold
+except ModuleNotFoundError:
+    from ..backend.reader import open_frames, read_header
+    from ..backend.resample import resample_frames
+    from ..backend.classes import DTYPE_POLICIES, scale_frame, \
+        thresholded_frames
+    from ..backend.metrics import channel_pair, costes_threshold
+
+
+class stream_pipeline():
+    """Frame-at-a-time version of do_preprocess which holds at most window
+    frames in memory. A first pass reads, resizes and discards every window
+    of frames to find the min-max range of each channel; afterwards windows
+    are read, resized, normalised and thresholded again as they are needed.
+    The result matches pipeline_object after reshape and normalise_all.
+
+    The object can be indexed like a (height, width, channels, frames) stack,
+    so block-wise analyses such as coloc_metrics run on it directly.
+
+    :param inpath: File path of image in directory
+    :type inpath: string or os.path
+    :param threshold: values below this are set to zero, False or 'costes',
+    defaults to False
+    :type threshold: float, bool or string, optional
+    :param dtype: dtype policy, defaults to 'float64'
+    :type dtype: string, optional
+    :param channels: channels to threshold in 'costes' mode, defaults to
+    (0, 1)
+    :type channels: list of integers of length 2, optional
+    :param window: largest number of frames held in memory, defaults to 8
+    :type window: int, optional
+    """
+    def __init__(self, inpath, threshold=False, dtype='float64',
+                 channels=(0, 1), window=8):
+        if ((not isinstance(threshold, float)) and (threshold is not False)
+                and threshold != 'costes'):
+            raise TypeError('Invalid type for threshold.')
+        if dtype not in DTYPE_POLICIES:
+            raise ValueError("dtype must be one of %s"
+                             % ", ".join(DTYPE_POLICIES))
+        if window < 1:
+            raise ValueError("window must be at least one frame")
+        self.filepath = inpath
+        self.threshold = threshold
+        self.dtype = dtype
+        self.channels = list(channels)
+        self.window = window
+        self.header = read_header(inpath)
+        self.source = open_frames(inpath)
+        h, w, c, f = self.source.shape
+        self.smallest_dim = min(h, w)
+        self.shape = (self.smallest_dim, self.smallest_dim, c, f)
+        self.ndim = 4
+        self.minimum, self.maximum, self.rescaled = self._ranges()
+        # Cutoffs of each channel and frame, filled in as frames are read in
+        # 'costes' mode.
+        self.thresholds = np.full((c, f), -np.inf)
+        if threshold == 'costes':
+            self.thresholds[self.channels] = np.nan
+        elif threshold:
+            self.thresholds[np.asarray(self.rescaled)] = threshold
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Close the file the frames are read from."""
+        if hasattr(self.source, 'close'):
+            self.source.close()
+
+    def value_range(self, c):
+        """Smallest and largest value of a channel once normalised and
+        thresholded, zero included.
+
+        :param c: index of the channel
+        :type c: int
+
+        :return: range of the channel
+        :rtype: tuple of float
+        """
+        if self.rescaled[c]:
+            return 0., 1.
+        return min(0., self.minimum[c]), max(0., self.maximum[c])
+
+    def _resized(self, frames):
+        """Read and resize a range of frames in the working data type."""
+        return resample_frames(self.source[:, :, :, frames],
+                               self.smallest_dim,
+                               dtype=DTYPE_POLICIES[self.dtype][0])
+
+    def _windows(self, start=0, stop=None):
+        stop = self.shape[3] if stop is None else stop
+        for i in range(start, stop, self.window):
+            yield slice(i, min(i + self.window, stop))
+
+    def _ranges(self):
+        """First pass: min and max of every channel and whether it can be
+        rescaled, with the same rules as pipeline_object.normalise."""
+        c = self.shape[2]
+        minimum, maximum = np.full(c, np.inf), np.full(c, -np.inf)
+        has_zero = np.zeros(c, dtype=bool)
+        for frames in self._windows():
+            block = self._resized(frames)
+            minimum = np.minimum(minimum, block.min(axis=(0, 1, 3)))
+            maximum = np.maximum(maximum, block.max(axis=(0, 1, 3)))
+            has_zero |= np.any(block == 0, axis=(0, 1, 3))
+        rescaled = [not (has_zero[j] or maximum[j] - minimum[j] == 0)
+                    for j in range(c)]
+        return minimum, maximum, rescaled
+
+    def normalised(self, frames):
+        """Read, resize and normalise a range of frames.
+
+        :param frames: frames to read
+        :type frames: slice
+
+        :return: normalised frames
+        :rtype: numpy array of shape (height, width, channels, frames)
+        """
+        block = self._resized(frames)
+        for j, rescale in enumerate(self.rescaled):
+            if rescale:
+                block[:, :, j, :] -= self.minimum[j]
+                block[:, :, j, :] /= (self.maximum[j] - self.minimum[j])
+        return block
+
+    def cutoffs(self, block, frames):
+        """Thresholds of every channel for a normalised range of frames,
+        finding Costes' thresholds of frames not seen before.
+
+        :param block: normalised frames
+        :type block: numpy array of shape (height, width, channels, frames)
+        :param frames: indices of the frames in the stack
+        :type frames: slice
+
+        :return: cutoff of every channel and frame
+        :rtype: numpy array of shape (channels, frames)
+        """
+        cutoffs = self.thresholds[:, frames]
+        for i in np.flatnonzero(np.isnan(cutoffs).any(axis=0)):
+            x, y = channel_pair(block, self.channels, slice(i, i + 1))
+            cutoffs[self.channels, i] = costes_threshold(x, y)
+        return cutoffs
+
+    def blocks(self, start=0, stop=None):
+        """Generate the stack one window of frames at a time.
+
+        :param start: first frame, defaults to 0
+        :type start: int, optional
+        :param stop: frame to stop before, defaults to the last frame
+        :type stop: int, optional
+
+        :return: generator of (first frame index, normalised frames,
+        thresholded frames). The thresholded frames are the normalised
+        frames if there is no threshold.
+        :rtype: generator of tuples
+        """
+        for frames in self._windows(start, stop):
+            block = self.normalised(frames)
+            if self.threshold:
+                view = thresholded_frames(block, self.cutoffs(block, frames))
+            else:
+                view = block
+            yield frames.start, block, view
+
+    def frames(self):
+        """Generate each frame in (0, 255) in the analysis data type of the
+        dtype policy.
+
+        :return: generator of (frame index, original frame, thresholded
+        frame)
+        :rtype: generator of tuples
+        """
+        for first, block, view in self.blocks():
+            for i in range(block.shape[3]):
+                yield (first + i,
+                       scale_frame(block[:, :, :, i], self.dtype,
+                                   self.header.dtype),
+                       scale_frame(view[:, :, :, i], self.dtype,
+                                   self.header.dtype))
+
+    def __getitem__(self, key):
+        """Thresholded frames; only the requested frames are read."""
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (4 - len(key))
+        frames = np.arange(self.shape[3])[key[3]]
+        indices = np.atleast_1d(frames)
+        if len(indices) == 0:
+            return np.empty(self.shape[:3] + (0,))[key[:3]]
+        start, stop = int(indices.min()), int(indices.max()) + 1
+        data = np.concatenate([np.asarray(view[:, :, :, :]) for _, _, view
+                               in self.blocks(start, stop)], axis=3)
+        data = data[:, :, :, indices - start]
+        if np.ndim(frames) == 0:
+            data = data[..., 0]
+        return data[key[:3]]
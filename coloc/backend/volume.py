@@ -0,0 +1,250 @@
+import csv
+import json
+import os
+import numpy as np
+from scipy import ndimage
+from scipy.spatial import cKDTree
+try:
+    from backend.results import json_tables, json_value
+except ModuleNotFoundError:
+    from ..backend.results import json_tables, json_value
+
+# Objects found in the foreground of one channel. x, y and z are the
+# intensity-weighted centroid in pixels and frames, volume is the number of
+# voxels times z_scale, in cubic pixels, and intensity the summed intensity.
+OBJECT_DTYPE = np.dtype([('channel', int), ('label', int), ('x', float),
+                         ('y', float), ('z', float), ('voxels', int),
+                         ('volume', float), ('intensity', float)])
+# Pairs of colocalised objects returned by match_objects, with the midpoint
+# of their centroids as (x, y, z).
+OBJECT_MATCH_DTYPE = np.dtype([('index1', int), ('index2', int),
+                               ('distance', float),
+                               ('centroid', float, (3,))])
+
+
+def z_scale(width, scale=None, z_step=None):
+    """Spacing of the frames relative to the size of a pixel, so that
+    distances along z can be compared with distances in x and y.
+
+    :param width: width of the frames in pixels
+    :type width: int
+    :param scale: width of the image in um, defaults to None
+    :type scale: float, optional
+    :param z_step: distance between frames in um, defaults to None (the
+    frames are as far apart as the pixels)
+    :type z_step: float, optional
+    :return: pixel widths between adjacent frames
+    :rtype: float
+    """
+    if not z_step:
+        return 1.
+    if not scale:
+        raise ValueError("The scale of the image is needed to use z_step")
+    return z_step/(scale/width)
+
+
+def find_objects(stack, channel=0, z_scale=1., connectivity=1,
+                 min_voxels=1):
+    """Label the connected foreground of one channel of a thresholded stack
+    in 3D, and measure every object, in a single pass over the voxels.
+
+    :param stack: thresholded image data, zero in the background
+    :type stack: Array-like of shape (height x width x frames)
+    :param channel: channel number recorded in the table, defaults to 0
+    :type channel: int, optional
+    :param z_scale: pixel widths between adjacent frames, defaults to 1
+    :type z_scale: float, optional
+    :param connectivity: 1 joins voxels sharing a face, 2 also an edge and 3
+    also a corner, defaults to 1
+    :type connectivity: int, optional
+    :param min_voxels: smaller objects are dropped, defaults to 1
+    :type min_voxels: int, optional
+    :return: one row per object
+    :rtype: numpy structured array of dtype OBJECT_DTYPE
+    """
+    stack = np.asarray(stack)
+    if stack.ndim != 3:
+        raise ValueError("Expected a stack of shape (height, width, frames)")
+    if connectivity not in (1, 2, 3):
+        raise ValueError("connectivity must be 1, 2 or 3")
+    structure = ndimage.generate_binary_structure(3, connectivity)
+    labels, n = ndimage.label(stack > 0, structure)
+    # Sums over the foreground voxels of each label
+    voxels = np.flatnonzero(labels)
+    label = labels.ravel()[voxels]
+    weights = stack.ravel()[voxels].astype(np.float64)
+    rows, cols, frames = np.unravel_index(voxels, labels.shape)
+    counts = np.bincount(label, minlength=n + 1)[1:]
+    intensity = np.bincount(label, weights, n + 1)[1:]
+
+    objects = np.zeros(n, dtype=OBJECT_DTYPE)
+    objects['channel'] = channel
+    objects['label'] = np.arange(1, n + 1)
+    for name, coords in [('x', cols), ('y', rows), ('z', frames)]:
+        objects[name] = np.bincount(label, weights*coords, n + 1)[1:] / \
+            intensity
+    objects['voxels'] = counts
+    objects['volume'] = counts*z_scale
+    objects['intensity'] = intensity
+    return objects[counts >= min_voxels]
+
+
+def match_points(points1, points2, max_dist, mode='all'):
+    """Match points of two sets, of any number of dimensions, which lie
+    within max_dist of each other, using a KD-tree so that only nearby pairs
+    are compared.
+
+    :param points1: coordinates of the first set
+    :type points1: numpy array of shape (points x dimensions)
+    :param points2: coordinates of the second set
+    :type points2: numpy array of shape (points x dimensions)
+    :param max_dist: pairs at least this far apart are not matched
+    :type max_dist: float
+    :param mode: 'all' returns every pair closer than max_dist, sorted by
+    index, 'one_to_one' pairs each point at most once, closest pairs first,
+    defaults to 'all'
+    :type mode: string, optional
+    :return: one row per pair with the index 'i' of the first point, 'j' of
+    the second and their distance 'v'
+    :rtype: numpy structured array
+    """
+    if mode not in ('all', 'one_to_one'):
+        raise ValueError("Unknown matching mode %s" % mode)
+    distances = cKDTree(points1).sparse_distance_matrix(
+        cKDTree(points2), max_dist, output_type='ndarray')
+    distances = distances[distances['v'] < max_dist]
+    if mode == 'all':
+        return np.sort(distances, order=['i', 'j'])
+    distances = np.sort(distances, order=['v', 'i', 'j'])
+    used1, used2 = set(), set()
+    keep = []
+    for n, (i, j) in enumerate(zip(distances['i'], distances['j'])):
+        if i not in used1 and j not in used2:
+            used1.add(i)
+            used2.add(j)
+            keep.append(n)
+    return distances[keep]
+
+
+def match_objects(objects1, objects2, max_dist, z_scale=1., mode='all'):
+    """Match the centroids of objects of two channels which lie within
+    max_dist of each other in 3D, using a KD-tree so that only nearby pairs
+    are compared. Distances along z are multiplied by z_scale.
+
+    :param objects1: objects of the first channel, from find_objects
+    :type objects1: numpy structured array of dtype OBJECT_DTYPE
+    :param objects2: objects of the second channel
+    :type objects2: numpy structured array of dtype OBJECT_DTYPE
+    :param max_dist: largest distance in pixels between matched centroids
+    :type max_dist: float
+    :param z_scale: pixel widths between adjacent frames, defaults to 1
+    :type z_scale: float, optional
+    :param mode: 'all' returns every pair closer than max_dist, 'one_to_one'
+    pairs each object at most once, closest pairs first, defaults to 'all'
+    :type mode: string, optional
+    :return: one row per pair with the indices of the two objects, their
+    distance and the midpoint of their centroids
+    :rtype: numpy structured array of dtype OBJECT_MATCH_DTYPE
+    """
+    if mode not in ('all', 'one_to_one'):
+        raise ValueError("Unknown matching mode %s" % mode)
+    if len(objects1) == 0 or len(objects2) == 0:
+        return np.empty(0, dtype=OBJECT_MATCH_DTYPE)
+    scale = np.array([1., 1., z_scale])
+    points1, points2 = [np.stack([o['x'], o['y'], o['z']], axis=-1)
+                        for o in (objects1, objects2)]
+    distances = match_points(points1*scale, points2*scale, max_dist, mode)
+
+    pairs = np.empty(len(distances), dtype=OBJECT_MATCH_DTYPE)
+    pairs['index1'] = distances['i']
+    pairs['index2'] = distances['j']
+    pairs['distance'] = distances['v']
+    pairs['centroid'] = (points1[distances['i']] +
+                         points2[distances['j']])/2
+    return pairs
+
+
+def volume_colocalisation(stack, channels, max_dist, z_scale=1.,
+                          connectivity=1, min_voxels=1, mode='all'):
+    """Find the 3D objects of two channels of a thresholded stack and the
+    pairs of them which are colocalised.
+
+    :param stack: thresholded image data, zero in the background
+    :type stack: Array-like of shape (height x width x channels x frames)
+    :param channels: index of the two channels of interest
+    :type channels: list of integers of length 2
+    :param max_dist: largest distance in pixels between matched centroids
+    :type max_dist: float
+    :param z_scale: pixel widths between adjacent frames, defaults to 1
+    :type z_scale: float, optional
+    :param connectivity: see find_objects, defaults to 1
+    :type connectivity: int, optional
+    :param min_voxels: smaller objects are dropped, defaults to 1
+    :type min_voxels: int, optional
+    :param mode: matching mode, see match_objects, defaults to 'all'
+    :type mode: string, optional
+    :return: objects of both channels, and the pairs, whose index2 counts
+    from the first object of the second channel
+    :rtype: tuple of numpy structured arrays
+    """
+    if len(channels) != 2:
+        raise ValueError("Colocalisation compares exactly two channels")
+    found = [find_objects(stack[:, :, c, :], c, z_scale, connectivity,
+                          min_voxels) for c in channels]
+    pairs = match_objects(found[0], found[1], max_dist, z_scale, mode)
+    return np.concatenate(found), pairs
+
+
+def write_objects(output_dir, objects, pairs, volume=None,
+                  formats=('csv', 'json', 'npz')):
+    """Write the objects and pairs of a volumetric analysis to
+    objects.csv and object_pairs.csv, objects.json and objects.npz.
+
+    :param output_dir: Folder to write the results to
+    :type output_dir: string or os.path
+    :param objects: objects of both channels
+    :type objects: numpy structured array of dtype OBJECT_DTYPE
+    :param pairs: pairs from match_objects
+    :type pairs: numpy structured array of dtype OBJECT_MATCH_DTYPE
+    :param volume: whole-stack colocalisation coefficients, defaults to
+    None
+    :type volume: dictionary, optional
+    :param formats: Formats to write, defaults to all of 'csv', 'json' and
+    'npz'
+    :type formats: list of strings, optional
+    :return: paths of the files written
+    :rtype: list of strings
+    """
+    volume = volume or {}
+    # Flatten the centroids so every table has scalar columns
+    flat = np.zeros(len(pairs), dtype=[('index1', int), ('index2', int),
+                                       ('distance', float), ('x', float),
+                                       ('y', float), ('z', float)])
+    for name in ['index1', 'index2', 'distance']:
+        flat[name] = pairs[name]
+    for i, name in enumerate(['x', 'y', 'z']):
+        flat[name] = pairs['centroid'][:, i]
+    tables = {'objects': objects, 'object_pairs': flat}
+    paths = []
+    if 'csv' in formats:
+        for name, table in tables.items():
+            path = os.path.join(output_dir, name + '.csv')
+            with open(path, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(table.dtype.names)
+                writer.writerows(table.tolist())
+            paths.append(path)
+    if 'json' in formats:
+        path = os.path.join(output_dir, 'objects.json')
+        with open(path, 'w') as f:
+            json.dump({'volume': json_value(volume), **json_tables(tables)},
+                      f, indent=1, allow_nan=False)
+        paths.append(path)
+    if 'npz' in formats:
+        path = os.path.join(output_dir, 'objects.npz')
+        np.savez(path, volume=np.array(list(volume.items()),
+                                       dtype=[('name', 'U16'),
+                                              ('value', float)]),
+                 **tables)
+        paths.append(path)
+    return paths
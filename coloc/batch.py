@@ -0,0 +1,253 @@
+"""Headless batch processing of directories of .tif/.tiff stacks.
+
+Usage: python batch.py INPUT [--params params.json] [--out DIR] [--workers N]
+
+INPUT is a directory or a glob pattern. The parameter file holds the same keys
+as the GUI input dictionary, e.g. {"threshold": 0.5, "num_clusts": 10}.
+Results for each file are written to their own folder in the output directory,
+at the file's path relative to the input directory, and recorded in
+manifest.jsonl. Files already completed there are skipped so an interrupted run
+resumes where it stopped.
+"""
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import redirect_stdout
+from datetime import datetime
+import glob
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+try:
+    from backend.Visualiser import run_visualiser
+except ModuleNotFoundError:
+    from .backend.Visualiser import run_visualiser
+
+MANIFEST = 'manifest.jsonl'
+DEFAULT_PARAMS = {
+    'Run Intensity Correlation Analysis': 'Y',
+    'Run KMeans': 'Y'
+}
+
+
+def find_inputs(pattern):
+    """List the .tif/.tiff files in a directory or matching a glob.
+
+    :param pattern: directory or glob pattern
+    :type pattern: string
+    :return: sorted file paths
+    :rtype: list of strings
+    """
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*')
+    return sorted(path for path in glob.glob(pattern)
+                  if os.path.splitext(path)[1].lower() in ['.tif', '.tiff'])
+
+
+def input_root(pattern):
+    """Folder which the files found by find_inputs are keyed relative to:
+    the directory itself, or the deepest folder of a glob pattern without
+    wildcards.
+
+    :param pattern: directory or glob pattern
+    :type pattern: string
+    :return: absolute path of the folder
+    :rtype: string
+    """
+    if os.path.isdir(pattern):
+        return os.path.abspath(pattern)
+    root = os.path.dirname(pattern)
+    while glob.has_magic(root):
+        root = os.path.dirname(root)
+    return os.path.abspath(root)
+
+
+def file_key(path, root):
+    """Key of an input file in the manifest and the output directory: its
+    path relative to the input root, so that files of the same name in
+    different folders are kept apart.
+
+    :param path: input file
+    :type path: string
+    :param root: folder the inputs were found in
+    :type root: string
+    :return: relative path with '/' separators
+    :rtype: string
+    """
+    return os.path.relpath(os.path.abspath(path), root).replace(os.sep, '/')
+
+
+def load_params(path=None):
+    """Read run parameters from a JSON file.
+
+    :param path: parameter file, defaults to None (default parameters)
+    :type path: string, optional
+    :return: input dictionary without the in_path and out_path keys
+    :rtype: dictionary
+    """
+    params = dict(DEFAULT_PARAMS)
+    if path:
+        with open(path) as f:
+            params.update(json.load(f))
+    for key in ['in_path', 'out_path']:
+        params.pop(key, None)
+    return params
+
+
+def read_manifest(out_root):
+    """Read the latest record of every file in the manifest.
+
+    :param out_root: output directory of the batch
+    :type out_root: string
+    :return: key of each file, see file_key, to its last manifest record
+    :rtype: dictionary
+    """
+    records = {}
+    path = os.path.join(out_root, MANIFEST)
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A line cut short by an interrupted run.
+                    continue
+                records[record['key']] = record
+    return records
+
+
+def output_dir(key, out_root):
+    """Output folder of the input file with the given key."""
+    return os.path.join(out_root, *os.path.splitext(key)[0].split('/'))
+
+
+def process_file(path, params, out_root, key):
+    """Run the analysis on one file, logging its output to run.log.
+
+    :param path: input file
+    :type path: string
+    :param params: run parameters
+    :type params: dictionary
+    :param out_root: output directory of the batch
+    :type out_root: string
+    :param key: key of the file, see file_key
+    :type key: string
+    :return: manifest record of the file
+    :rtype: dictionary
+    """
+    out = output_dir(key, out_root)
+    os.makedirs(out, exist_ok=True)
+    input_dict = dict(params, in_path=path, out_path=out)
+    record = {'file': path, 'key': key, 'output': out}
+    start = time.time()
+    with open(os.path.join(out, 'run.log'), 'w') as log, \
+            redirect_stdout(log):
+        try:
+            run_visualiser(input_dict)
+            record['status'] = 'done'
+        except Exception as e:
+            traceback.print_exc(file=log)
+            record['status'] = 'failed'
+            record['error'] = '%s: %s' % (type(e).__name__, e)
+    record['seconds'] = round(time.time() - start, 3)
+    record['finished'] = datetime.now().isoformat(timespec='seconds')
+    return record
+
+
+def run_batch(inputs, params, out_root, workers=1, queue_size=None,
+              root=None):
+    """Process files, skipping those already completed in the manifest.
+    With more than one worker, files are processed on a pool of processes
+    and at most queue_size files are queued at a time.
+
+    :param inputs: input files
+    :type inputs: list of strings
+    :param params: run parameters
+    :type params: dictionary
+    :param out_root: output directory of the batch
+    :type out_root: string
+    :param workers: number of files processed concurrently, defaults to 1
+    :type workers: int, optional
+    :param queue_size: most files submitted but not finished, defaults to
+    twice the number of workers
+    :type queue_size: int, optional
+    :param root: folder the inputs were found in, which their keys are
+    relative to, defaults to the deepest folder holding all of them
+    :type root: string, optional
+    :return: manifest records of the files processed in this run
+    :rtype: list of dictionaries
+    """
+    os.makedirs(out_root, exist_ok=True)
+    done = read_manifest(out_root)
+    inputs = [os.path.abspath(path) for path in inputs]
+    if root is None:
+        root = os.path.commonpath([os.path.dirname(path)
+                                   for path in inputs]) if inputs else ''
+    todo = [(path, file_key(path, root)) for path in inputs]
+    todo = [(path, key) for path, key in todo
+            if done.get(key, {}).get('status') != 'done']
+    print("%s files to process, %s already complete"
+          % (len(todo), len(inputs) - len(todo)))
+    records = []
+
+    with open(os.path.join(out_root, MANIFEST), 'a') as manifest:
+        def finish(record):
+            manifest.write(json.dumps(record) + '\n')
+            manifest.flush()
+            records.append(record)
+            print("[%s/%s] %s: %s" % (len(records), len(todo),
+                                      record['key'],
+                                      record['status']))
+
+        if workers == 1:
+            for path, key in todo:
+                finish(process_file(path, params, out_root, key))
+            return records
+
+        queue_size = queue_size or 2*workers
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(workers, mp_context=context) as pool:
+            pending = set()
+            for path, key in todo:
+                if len(pending) >= queue_size:
+                    finished, pending = wait(pending,
+                                             return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        finish(future.result())
+                pending.add(pool.submit(process_file, path, params,
+                                        out_root, key))
+            for future in wait(pending).done:
+                finish(future.result())
+    return records
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run colocalisation analysis on a batch of .tif files.")
+    parser.add_argument('input', help="directory or glob of .tif files")
+    parser.add_argument('--params', help="JSON file of run parameters")
+    parser.add_argument('--out', help="output directory, defaults to "
+                        "acg_batch_output next to the input")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="files processed concurrently")
+    parser.add_argument('--queue', type=int,
+                        help="most files queued at a time")
+    args = parser.parse_args(argv)
+
+    inputs = find_inputs(args.input)
+    if not inputs:
+        parser.error("no .tif/.tiff files found in %s" % args.input)
+    out_root = args.out or os.path.join(
+        os.path.dirname(os.path.abspath(inputs[0])), 'acg_batch_output')
+    records = run_batch(inputs, load_params(args.params), out_root,
+                        args.workers, args.queue, input_root(args.input))
+    failed = [r for r in records if r['status'] != 'done']
+    print("Complete: %s processed, %s failed. Manifest: %s"
+          % (len(records), len(failed), os.path.join(out_root, MANIFEST)))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,435 @@
+"""Benchmarks of every backend stage over synthetic stacks of puncta.
+
+Usage: python -m benchmarks.bench [--quick] [--save FILE] [--compare FILE]
+
+Run from the coloc directory. A grid of frame sizes, depths and channel
+counts is drawn with benchmarks.synthetic, written to .tif files and taken
+through reading, preprocessing, the colocalisation metrics, ICA, k-means,
+the spot detector, matching and both renderers. The time, throughput in
+megapixels per second and peak memory of every stage, and the share of the
+true colocalised pairs found, are printed. A report saved with --save is the
+baseline that a later run given --compare is checked against; the run exits
+with status 1 if any stage became slower or used more memory than the
+tolerance allows.
+"""
+import argparse
+from contextlib import contextmanager, redirect_stdout
+import io
+import itertools
+import json
+import os
+import platform
+import sys
+import tempfile
+import tracemalloc
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+try:
+    from backend.classes import pipeline_object, scale_frame
+    from backend.metrics import coloc_metrics
+    from backend.instrument import run_log
+    from backend.render import overlay_kmeans, to_rgb8
+    from backend.Visualiser import correlate, fit_pair, compare_dists, \
+        plot_kmeans
+    from benchmarks.synthetic import make_stack, write_stack, true_pairs, \
+        score_matches
+except ModuleNotFoundError:
+    from ..backend.classes import pipeline_object, scale_frame
+    from ..backend.metrics import coloc_metrics
+    from ..backend.instrument import run_log
+    from ..backend.render import overlay_kmeans, to_rgb8
+    from ..backend.Visualiser import correlate, fit_pair, compare_dists, \
+        plot_kmeans
+    from .synthetic import make_stack, write_stack, true_pairs, \
+        score_matches
+
+GRID = {'size': [128, 256, 512], 'depth': [4, 16], 'channels': [2, 3]}
+QUICK_GRID = {'size': [64], 'depth': [2], 'channels': [2]}
+STAGES = ('read', 'reshape', 'normalise', 'threshold', 'metrics', 'scale',
+          'correlate', 'fit_clusters', 'detect_spots', 'compare_dists',
+          'render', 'plot')
+# Analysis settings of every case. Spots are two pixels from their partner
+# at most, so pairs are matched within a few pixels.
+SETTINGS = {'n_spots': 10, 'threshold': 0.3, 'channels': [0, 1],
+            'min_dist': 5, 'tolerance': 3}
+
+
+def case_name(case):
+    """Name of a grid case, e.g. 256x256_z16_c2."""
+    return "{size}x{size}_z{depth}_c{channels}".format(**case)
+
+
+def grid_cases(grid):
+    """Every combination of the values of a grid.
+
+    :param grid: lists of sizes, depths and channel counts
+    :type grid: dictionary
+    :return: cases
+    :rtype: list of dictionaries
+    """
+    keys = ['size', 'depth', 'channels']
+    return [dict(zip(keys, values))
+            for values in itertools.product(*(grid[k] for k in keys))]
+
+
+@contextmanager
+def measure(log, peaks, name, items, memory=False):
+    """Time a stage with the run log and, if memory is True, record the peak
+    memory allocated while it runs, as traced by tracemalloc.
+
+    :param log: log of the run
+    :type log: run_log
+    :param peaks: peak bytes of each stage, updated in place
+    :type peaks: dictionary
+    :param name: name of the stage
+    :type name: string
+    :param items: pixels processed by the stage
+    :type items: int
+    :param memory: trace memory, defaults to False
+    :type memory: bool, optional
+    """
+    if memory:
+        tracemalloc.start()
+    try:
+        with log.stage(name, items=items):
+            yield
+    finally:
+        if memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            peaks[name] = max(peaks.get(name, 0), peak)
+
+
+def run_stages(path, output_dir, case, stages=STAGES, memory=False):
+    """Take one stack through every stage of the analysis.
+
+    :param path: .tif file of the stack
+    :type path: string
+    :param output_dir: folder for the figures
+    :type output_dir: string
+    :param case: size, depth and channels of the stack
+    :type case: dictionary
+    :param stages: stages to run; the stages they depend on always run but
+    are only timed if listed, defaults to STAGES
+    :type stages: list of strings, optional
+    :param memory: trace the peak memory of each stage, defaults to False
+    :type memory: bool, optional
+    :return: log of the run, peak bytes of each stage and the (x, y)
+    midpoints of the pairs found in each frame by each detector
+    :rtype: tuple of run_log, dictionary and dictionary of lists of numpy
+    arrays
+    """
+    log, peaks = run_log(), {}
+    frame_pixels = case['size']**2*case['channels']
+    channels = SETTINGS['channels']
+
+    def stage(name, items):
+        if name in stages:
+            return measure(log, peaks, name, items, memory)
+        return _untimed()
+
+    with stage('read', frame_pixels*case['depth']):
+        pipeline = pipeline_object(path, output_dir)
+    with stage('reshape', frame_pixels*case['depth']):
+        pipeline.reshape()
+    with stage('normalise', frame_pixels*case['depth']):
+        pipeline.normalise_all()
+    with stage('threshold', frame_pixels*case['depth']):
+        derived = pipeline.thresholded(SETTINGS['threshold'])
+        frames = np.asarray(derived.frames)
+    if 'metrics' in stages:
+        with stage('metrics', case['size']**2*2*case['depth']):
+            coloc_metrics(frames, channels)
+    found = {'kmeans': []}
+    if 'detect_spots' in stages:
+        found['spots'] = []
+    for n in range(case['depth']):
+        with stage('scale', 2*frame_pixels):
+            orig = pipeline.scaled(n)
+            denoised = scale_frame(frames[:, :, :, n], pipeline.dtype,
+                                   pipeline.header.dtype)
+        if 'correlate' in stages:
+            with stage('correlate', case['size']**2*2):
+                correlate(denoised, channels, SETTINGS['n_spots'])
+        with stage('fit_clusters', case['size']**2*2):
+            c1, c2 = fit_pair(denoised, channels, SETTINGS['n_spots'])
+        if 'detect_spots' in stages:
+            with stage('detect_spots', case['size']**2*2):
+                s1, s2 = fit_pair(denoised, channels, SETTINGS['n_spots'],
+                                  'spots')
+            found['spots'].append(compare_dists(s1, s2,
+                                                SETTINGS['min_dist'])
+                                  ['centroid'])
+        with stage('compare_dists', case['size']**2*2):
+            pairs = compare_dists(c1, c2, SETTINGS['min_dist'])
+        found['kmeans'].append(pairs['centroid'])
+        if 'render' in stages:
+            with stage('render', 2*frame_pixels):
+                overlay_kmeans(orig, denoised, pairs, output_dir,
+                               "/0%s_kmeans" % n)
+        if 'plot' in stages:
+            # imshow only takes one, three or four channels
+            rgb = [to_rgb8(image) for image in (orig, denoised)]
+            with stage('plot', 2*frame_pixels):
+                plot_kmeans(rgb[0], rgb[1], pairs, output_dir,
+                            "/0%s_kmeans" % n)
+    return log, peaks, found
+
+
+@contextmanager
+def _untimed():
+    yield
+
+
+def run_case(case, workdir, repeat=3, memory=True, stages=STAGES, seed=0):
+    """Benchmark one grid case. Each stage is timed repeat times and the
+    fastest run kept; memory is traced in a separate run, as tracing slows
+    allocation down.
+
+    :param case: size, depth and channels of the stack
+    :type case: dictionary
+    :param workdir: folder for the stack and figures
+    :type workdir: string
+    :param repeat: timed runs, defaults to 3
+    :type repeat: int, optional
+    :param memory: also measure peak memory, defaults to True
+    :type memory: bool, optional
+    :param stages: stages to time, defaults to STAGES
+    :type stages: list of strings, optional
+    :param seed: seed of the synthetic stack, defaults to 0
+    :type seed: int, optional
+    :return: results of each stage, and the accuracy of the colocalised
+    pairs found by each detector against the ground truth
+    :rtype: tuple of lists of dictionaries
+    """
+    name = case_name(case)
+    folder = os.path.join(workdir, name)
+    os.makedirs(folder, exist_ok=True)
+    stack, spots = make_stack(case['size'], case['depth'], case['channels'],
+                              n_spots=SETTINGS['n_spots'], seed=seed)
+    path = os.path.join(folder, name + '.tif')
+    write_stack(path, stack)
+
+    best = {}
+    with redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            log, _, found = run_stages(path, folder, case, stages)
+            for stage, total in log.summary().items():
+                if stage not in best or total['wall'] < best[stage]['wall']:
+                    best[stage] = total
+        peaks = {}
+        if memory:
+            _, peaks, _ = run_stages(path, folder, case, stages, True)
+
+    results = []
+    for stage in STAGES:
+        if stage not in best:
+            continue
+        total = best[stage]
+        results.append({
+            'case': name, 'stage': stage, 'calls': total['calls'],
+            'seconds': total['wall'], 'cpu_seconds': total['cpu'],
+            'mpix_per_s': total['items']/total['wall']/1e6
+            if total['wall'] > 0 else float('inf'),
+            'peak_mb': peaks[stage]/1e6 if stage in peaks else None})
+    accuracy = []
+    for detector, pairs in found.items():
+        scores = [score_matches(pairs[n],
+                                true_pairs(spots, case['depth'], n),
+                                SETTINGS['tolerance'])
+                  for n in range(case['depth'])]
+        accuracy.append({
+            'case': name, 'detector': detector,
+            'recall': float(np.mean([s['recall'] for s in scores])),
+            'precision': float(np.mean([s['precision'] for s in scores]))})
+    return results, accuracy
+
+
+def environment():
+    """Versions and hardware a report was made with."""
+    import scipy
+    import sklearn
+    return {'python': platform.python_version(),
+            'numpy': np.__version__, 'scipy': scipy.__version__,
+            'sklearn': sklearn.__version__, 'machine': platform.machine(),
+            'system': platform.system(), 'cpus': os.cpu_count()}
+
+
+def run_suite(grid=GRID, workdir=None, repeat=3, memory=True, stages=STAGES,
+              seed=0):
+    """Benchmark every case of a grid.
+
+    :param grid: lists of sizes, depths and channel counts, defaults to GRID
+    :type grid: dictionary, optional
+    :param workdir: folder for the stacks and figures, defaults to a
+    temporary folder which is removed afterwards
+    :type workdir: string, optional
+    :param repeat: timed runs of each case, defaults to 3
+    :type repeat: int, optional
+    :param memory: also measure peak memory, defaults to True
+    :type memory: bool, optional
+    :param stages: stages to time, defaults to STAGES
+    :type stages: list of strings, optional
+    :param seed: seed of the synthetic stacks, defaults to 0
+    :type seed: int, optional
+    :return: report with the environment, results and accuracy
+    :rtype: dictionary
+    """
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise ValueError("Unknown stages %s" % ", ".join(sorted(unknown)))
+    report = {'environment': environment(), 'grid': grid,
+              'settings': SETTINGS, 'results': [], 'accuracy': []}
+    with tempfile.TemporaryDirectory() as tmp:
+        for case in grid_cases(grid):
+            print("Benchmarking %s" % case_name(case))
+            results, accuracy = run_case(case, workdir or tmp, repeat,
+                                         memory, stages, seed)
+            report['results'] += results
+            report['accuracy'] += accuracy
+    return report
+
+
+def save_report(report, path):
+    """Save a report as JSON, e.g. as a baseline."""
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1)
+
+
+def load_report(path):
+    """Read a report saved with save_report."""
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(baseline, current, tolerance=0.25, min_seconds=0.005,
+            min_mb=1.):
+    """Compare the stages of two reports.
+
+    :param baseline: earlier report
+    :type baseline: dictionary
+    :param current: new report
+    :type current: dictionary
+    :param tolerance: largest relative increase in time or peak memory that
+    is not a regression, defaults to 0.25
+    :type tolerance: float, optional
+    :param min_seconds: slowdowns smaller than this many seconds are ignored,
+    as timings of very short stages are noisy, defaults to 0.005
+    :type min_seconds: float, optional
+    :param min_mb: memory increases smaller than this many megabytes are
+    ignored, defaults to 1
+    :type min_mb: float, optional
+    :return: one row per stage in either report with the time and memory
+    ratios of current to baseline and a status of 'ok', 'slower', 'faster',
+    'more memory', 'new' or 'missing'
+    :rtype: list of dictionaries
+    """
+    old = {(r['case'], r['stage']): r for r in baseline['results']}
+    new = {(r['case'], r['stage']): r for r in current['results']}
+    rows = []
+    for key in list(old) + [k for k in new if k not in old]:
+        row = {'case': key[0], 'stage': key[1], 'time_ratio': None,
+               'memory_ratio': None}
+        if key not in new:
+            row['status'] = 'missing'
+        elif key not in old:
+            row['status'] = 'new'
+        else:
+            a, b = old[key], new[key]
+            row['time_ratio'] = b['seconds']/a['seconds'] \
+                if a['seconds'] > 0 else float('inf')
+            if a['peak_mb'] is not None and b['peak_mb'] is not None:
+                row['memory_ratio'] = b['peak_mb']/a['peak_mb'] \
+                    if a['peak_mb'] > 0 else float('inf')
+            if row['time_ratio'] > 1 + tolerance and \
+                    b['seconds'] - a['seconds'] > min_seconds:
+                row['status'] = 'slower'
+            elif row['memory_ratio'] is not None and \
+                    row['memory_ratio'] > 1 + tolerance and \
+                    b['peak_mb'] - a['peak_mb'] > min_mb:
+                row['status'] = 'more memory'
+            elif row['time_ratio'] < 1/(1 + tolerance) and \
+                    a['seconds'] - b['seconds'] > min_seconds:
+                row['status'] = 'faster'
+            else:
+                row['status'] = 'ok'
+        rows.append(row)
+    return rows
+
+
+def print_report(report):
+    """Print the results and accuracy of a report."""
+    print("%-18s %-14s %6s %9s %9s %9s" % ('case', 'stage', 'calls',
+                                          'seconds', 'Mpix/s', 'peak MB'))
+    for r in report['results']:
+        peak = '-' if r['peak_mb'] is None else '%.1f' % r['peak_mb']
+        print("%-18s %-14s %6d %9.4f %9.1f %9s"
+              % (r['case'], r['stage'], r['calls'], r['seconds'],
+                 r['mpix_per_s'], peak))
+    print("\nColocalised pairs found against the ground truth")
+    for a in report['accuracy']:
+        print("%-18s %-8s recall %.2f precision %.2f"
+              % (a['case'], a['detector'], a['recall'], a['precision']))
+
+
+def print_comparison(rows):
+    """Print the rows of compare, regressions first."""
+    order = ['slower', 'more memory', 'missing', 'new', 'faster', 'ok']
+    print("%-18s %-14s %8s %8s  %s" % ('case', 'stage', 'time', 'memory',
+                                       'status'))
+    for row in sorted(rows, key=lambda r: order.index(r['status'])):
+        ratios = ['-' if v is None else 'x%.2f' % v
+                  for v in (row['time_ratio'], row['memory_ratio'])]
+        print("%-18s %-14s %8s %8s  %s" % (row['case'], row['stage'],
+                                           ratios[0], ratios[1],
+                                           row['status']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the analysis stages on synthetic stacks.")
+    parser.add_argument('--quick', action='store_true',
+                        help="run a single small case")
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        help="frame sizes in pixels")
+    parser.add_argument('--depths', type=int, nargs='+',
+                        help="numbers of frames")
+    parser.add_argument('--channels', type=int, nargs='+',
+                        help="numbers of channels")
+    parser.add_argument('--stages', nargs='+', default=list(STAGES),
+                        choices=STAGES, help="stages to time")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="timed runs of each case, the fastest is kept")
+    parser.add_argument('--no-memory', action='store_true',
+                        help="skip the peak memory run")
+    parser.add_argument('--workdir', help="keep the stacks and figures here")
+    parser.add_argument('--save', help="save the report to this JSON file")
+    parser.add_argument('--compare', help="baseline report to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="relative slowdown allowed before a stage "
+                        "counts as a regression")
+    args = parser.parse_args(argv)
+
+    grid = dict(QUICK_GRID if args.quick else GRID)
+    for key, values in [('size', args.sizes), ('depth', args.depths),
+                        ('channels', args.channels)]:
+        if values:
+            grid[key] = values
+    report = run_suite(grid, args.workdir, args.repeat, not args.no_memory,
+                       args.stages)
+    print_report(report)
+    if args.save:
+        save_report(report, args.save)
+        print("Saved report to %s" % args.save)
+    if args.compare:
+        rows = compare(load_report(args.compare), report, args.tolerance)
+        print()
+        print_comparison(rows)
+        if any(r['status'] in ('slower', 'more memory') for r in rows):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,197 @@
+import numpy as np
+import cv2
+from scipy.spatial import cKDTree
+import tifffile
+
+# Ground truth of every spot drawn by make_stack. x and y are the column and
+# row of the spot centre, z its depth in frames, and partner the id of the
+# colocalised spot in the other channel of the pair, or -1.
+SPOT_DTYPE = np.dtype([('id', int), ('channel', int), ('x', int), ('y', int),
+                       ('z', float), ('amplitude', float), ('partner', int)])
+
+
+def spot_weights(z, depth, z_sigma=0.):
+    """Brightness of spots in every frame relative to their peak.
+
+    :param z: depth of each spot, in frames
+    :type z: numpy array
+    :param depth: number of frames
+    :type depth: int
+    :param z_sigma: standard deviation of the spots along z, in frames,
+    defaults to 0 (each spot lies in a single frame)
+    :type z_sigma: float, optional
+    :return: weights
+    :rtype: numpy array of shape (spots x frames)
+    """
+    frames = np.arange(depth)
+    if z_sigma == 0:
+        return (np.round(z)[:, np.newaxis] == frames).astype(float)
+    return np.exp(-(frames - z[:, np.newaxis])**2/(2*z_sigma**2))
+
+
+def make_stack(size=256, depth=8, channels=2, n_spots=20, coloc_fraction=0.5,
+               max_shift=2, sigma=2., z_sigma=0., amplitude=(150, 230),
+               background=10, noise=4, seed=0):
+    """Draw a stack of Gaussian puncta with known colocalisation. Channel 0
+    has n_spots spots per frame, and coloc_fraction of them have a partner in
+    channel 1 at most max_shift pixels away in x and y. The rest of channel 1,
+    and every further channel, is placed independently.
+
+    :param size: height and width of the frames, defaults to 256
+    :type size: int, optional
+    :param depth: number of frames, defaults to 8
+    :type depth: int, optional
+    :param channels: number of channels, at least 2, defaults to 2
+    :type channels: int, optional
+    :param n_spots: spots per frame in each channel, defaults to 20
+    :type n_spots: int, optional
+    :param coloc_fraction: share of channel 0 spots with a partner in
+    channel 1, defaults to 0.5
+    :type coloc_fraction: float, optional
+    :param max_shift: largest offset in pixels between partners, defaults to
+    2
+    :type max_shift: int, optional
+    :param sigma: standard deviation of the spots in x and y, in pixels,
+    defaults to 2
+    :type sigma: float, optional
+    :param z_sigma: standard deviation of the spots along z, in frames. With
+    the default of 0 every spot lies in one frame; otherwise spots are placed
+    at any depth and span neighbouring frames
+    :type z_sigma: float, optional
+    :param amplitude: range of peak intensities, defaults to (150, 230)
+    :type amplitude: tuple, optional
+    :param background: mean background intensity, defaults to 10
+    :type background: float, optional
+    :param noise: standard deviation of the Gaussian noise, defaults to 4
+    :type noise: float, optional
+    :param seed: seed of the random number generator, defaults to 0
+    :type seed: int, optional
+    :return: stack, and the ground truth of every spot
+    :rtype: tuple of a numpy array of uint8 of shape (height x width x
+    channels x frames) and a numpy structured array of dtype SPOT_DTYPE
+    """
+    if channels < 2:
+        raise ValueError("Colocalisation needs at least two channels")
+    if not 0 <= coloc_fraction <= 1:
+        raise ValueError("coloc_fraction must be between 0 and 1")
+    rng = np.random.default_rng(seed)
+    margin = int(np.ceil(3*sigma)) + max_shift
+    if size <= 2*margin:
+        raise ValueError("Frames of size %s are too small for spots of "
+                         "sigma %s" % (size, sigma))
+    total = n_spots*depth
+    if z_sigma == 0:
+        z = np.repeat(np.arange(depth), n_spots).astype(float)
+    else:
+        z = rng.uniform(0, depth - 1, total)
+    n_coloc = int(round(coloc_fraction*n_spots))
+    coloc = np.tile(np.arange(n_spots) < n_coloc, depth)
+
+    def place(channel, z, first_id):
+        spots = np.zeros(len(z), dtype=SPOT_DTYPE)
+        spots['id'] = first_id + np.arange(len(z))
+        spots['channel'] = channel
+        spots['x'], spots['y'] = rng.integers(margin, size - margin,
+                                              (2, len(z)))
+        spots['z'] = z
+        spots['amplitude'] = rng.uniform(*amplitude, len(z))
+        spots['partner'] = -1
+        return spots
+
+    groups = [place(0, z, 0)]
+    # Partners share the depth of their channel 0 spot and are shifted in xy
+    partners = place(1, z[coloc], total)
+    shift = rng.integers(-max_shift, max_shift + 1, (2, len(partners)))
+    partners['x'] = groups[0]['x'][coloc] + shift[0]
+    partners['y'] = groups[0]['y'][coloc] + shift[1]
+    partners['partner'] = groups[0]['id'][coloc]
+    groups[0]['partner'][coloc] = partners['id']
+    groups.append(partners)
+    next_id = total + len(partners)
+    # Channel 1 keeps n_spots spots per frame
+    others = place(1, z[~coloc], next_id)
+    groups.append(others)
+    next_id += len(others)
+    for c in range(2, channels):
+        groups.append(place(c, z, next_id))
+        next_id += total
+    spots = np.concatenate(groups)
+
+    stack = rng.normal(background, noise, (size, size, channels, depth))
+    weights = spot_weights(spots['z'], depth, z_sigma)
+    # Point sources blurred to Gaussians whose peak is the spot amplitude
+    gain = 2*np.pi*sigma**2
+    for c in range(channels):
+        of_channel = spots[spots['channel'] == c]
+        for n in range(depth):
+            impulses = np.zeros((size, size))
+            np.add.at(impulses, (of_channel['y'], of_channel['x']),
+                      of_channel['amplitude']*weights[spots['channel'] == c,
+                                                      n])
+            stack[:, :, c, n] += gain*cv2.GaussianBlur(impulses, (0, 0),
+                                                       sigma)
+    # pipeline_object.normalise leaves channels containing zeros unscaled and
+    # unthresholded, so the background is kept above zero
+    return np.clip(np.round(stack), 1, 255).astype(np.uint8), spots
+
+
+def write_stack(path, stack):
+    """Save a stack as an ImageJ hyperstack which the pipeline can read.
+
+    :param path: output file path, ending in .tif
+    :type path: string
+    :param stack: image data
+    :type stack: numpy array of shape (height x width x channels x frames)
+    """
+    tifffile.imwrite(path, np.transpose(stack, (3, 2, 0, 1)), imagej=True,
+                     metadata={'axes': 'ZCYX'})
+
+
+def true_pairs(spots, depth, frame=None, z_sigma=0.):
+    """Midpoints of the colocalised channel 0 and 1 spots, in the (x, y)
+    image coordinates compare_dists reports.
+
+    :param spots: ground truth from make_stack
+    :type spots: numpy structured array of dtype SPOT_DTYPE
+    :param depth: number of frames of the stack
+    :type depth: int
+    :param frame: only return the pairs visible in this frame, at least half
+    as bright as their peak, defaults to None (every pair)
+    :type frame: int, optional
+    :param z_sigma: z_sigma the stack was drawn with, defaults to 0
+    :type z_sigma: float, optional
+    :return: (x, y) midpoint of each pair
+    :rtype: numpy array of shape (pairs x 2)
+    """
+    first = spots[(spots['channel'] == 0) & (spots['partner'] >= 0)]
+    if frame is not None:
+        first = first[spot_weights(first['z'], depth, z_sigma)[:, frame]
+                      >= 0.5]
+    second = spots[np.searchsorted(spots['id'], first['partner'])]
+    return np.stack([(first['x'] + second['x'])/2,
+                     (first['y'] + second['y'])/2], axis=-1)
+
+
+def score_matches(found, expected, tolerance=3.):
+    """Compare detected colocalised positions with the ground truth.
+
+    :param found: (x, y) of each detected pair
+    :type found: array-like of shape (n x 2)
+    :param expected: (x, y) of each true pair
+    :type expected: array-like of shape (m x 2)
+    :param tolerance: largest distance in pixels at which a detection counts
+    as finding a true pair, defaults to 3
+    :type tolerance: float, optional
+    :return: recall, the share of true pairs detected, and precision, the
+    share of detections near a true pair
+    :rtype: dictionary
+    """
+    found = np.asarray(found, dtype=float).reshape(-1, 2)
+    expected = np.asarray(expected, dtype=float).reshape(-1, 2)
+    if len(found) == 0 or len(expected) == 0:
+        return {'recall': float(len(expected) == 0),
+                'precision': float(len(found) == 0)}
+    to_expected, _ = cKDTree(expected).query(found)
+    to_found, _ = cKDTree(found).query(expected)
+    return {'recall': float(np.mean(to_found <= tolerance)),
+            'precision': float(np.mean(to_expected <= tolerance))}
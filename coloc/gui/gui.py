@@ -1,10 +1,16 @@
 import sys
 from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
-from PyQt5.QtCore import pyqtSlot
+from PyQt5.QtCore import pyqtSlot, pyqtSignal, QObject, QThread
 import os
 import time
 from backend.Visualiser import run_visualiser # Is this the correct way to call dependencies scripts
+from gui.viewer import FigureCache
+from gui.tiled_viewer import TiledViewer
+
+# Folder the GUI caches results between runs in, if the cache is on
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".acg_cache")
+
 
 class App(QMainWindow):
 
@@ -23,6 +29,38 @@ class App(QMainWindow):
         
         self.show()
     
+class AnalysisWorker(QObject):
+    '''
+    Runs the image analysis away from the GUI thread so the window stays responsive. Progress is reported
+    after every frame and the run can be cancelled between frames.
+    '''
+    # Frames done, total frames and the results of the frame just finished
+    progress = pyqtSignal(int, int, object)
+    # True if every frame was processed, False if the run was cancelled
+    finished = pyqtSignal(bool)
+    failed = pyqtSignal(str)
+
+    def __init__(self, input_dict):
+        super().__init__()
+        self.input_dict = input_dict
+        self._cancelled = False
+
+    def cancel(self):
+        '''
+        Asks the run to stop once the current frame is complete.
+        '''
+        self._cancelled = True
+
+    def run(self):
+        try:
+            run_visualiser(self.input_dict, progress=self.progress.emit,
+                           should_stop=lambda: self._cancelled)
+        except Exception as e:
+            self.failed.emit("%s: %s" % (type(e).__name__, e))
+        else:
+            self.finished.emit(not self._cancelled)
+
+
 class MyTableWidget(QWidget):
     
     def __init__(self, parent):
@@ -30,6 +68,10 @@ class MyTableWidget(QWidget):
         self.layout = QVBoxLayout(self)
         self._current_index = 0
         self._filenames = []
+        self._figure_frames = {}
+        self.worker = None
+        # Figures shown in the View tab, held in memory and prefetched around the current one
+        self.figures = FigureCache(parent=self)
         
         # Initialize tab screen
         self.tabs = QTabWidget()
@@ -73,8 +115,8 @@ class MyTableWidget(QWidget):
         self.scaleDropdown.addItems(["--Image Scale--", "1 ", "10", "50", "100", "500"])
         self.thresholdDropdown = QComboBox()
         self.thresholdLabel = QLabel('Select Threshold Value:')
-        self.thresholdDropdown.addItems(["--Threshold Value--", "0.1 ", "0.2", "0.3", "0.4", "0.5 ", "0.6", "0.7", "0.8", "0.9"])
-        self.thresholdDropdown.setToolTip("Threshold refers to the degree of pixel noise filtering. Higher thresholds result in more filtering")
+        self.thresholdDropdown.addItems(["--Threshold Value--", "0.1 ", "0.2", "0.3", "0.4", "0.5 ", "0.6", "0.7", "0.8", "0.9", "Auto (Costes)"])
+        self.thresholdDropdown.setToolTip("Threshold refers to the degree of pixel noise filtering. Higher thresholds result in more filtering. Auto finds a threshold for each image using Costes' method")
         self.channelsDropdown = QComboBox()
         self.channelsDropdownLabel = QLabel('Select Number of Channels:')
         self.channelsDropdown.addItems(["--Channel Number--", "1 ", "2", "3"])
@@ -90,8 +132,15 @@ class MyTableWidget(QWidget):
         self.kmeansCheckbox = QCheckBox()
         self.kmeansCheckbox.setToolTip("Groups datapoints which are similar")
         self.kmeansLabel = QLabel('Run KMeans Analysis:')
+        self.cacheDropdown = QComboBox()
+        self.cacheDropdownLabel = QLabel('Cache Results Between Runs:')
+        self.cacheDropdown.addItems(["Off", "1 GB", "2 GB", "5 GB", "10 GB"])
+        self.cacheDropdown.setCurrentText("2 GB")
+        self.cacheDropdown.setToolTip("Keeps preprocessed images and clustering results in %s so that runs on the same file are faster. Up to the chosen size is written there, and the least recently used results are removed first." % CACHE_DIR)
         self.runButton = QPushButton("Run")
         self.resetButton = QPushButton("Reset")
+        self.cancelButton = QPushButton("Cancel")
+        self.progressBar = QProgressBar()
 
         # Add widgets and define positioning on QGridLayout
         self.tab1.layout.addWidget(self.logo, 1, 3)
@@ -115,14 +164,20 @@ class MyTableWidget(QWidget):
         self.tab1.layout.addWidget(self.intensitycorrLabel, 11, 2)
         self.tab1.layout.addWidget(self.kmeansCheckbox, 12, 3)
         self.tab1.layout.addWidget(self.kmeansLabel, 12, 2)
-        self.tab1.layout.addWidget(self.runButton, 13, 6)
-        self.tab1.layout.addWidget(self.resetButton, 13, 5)
+        self.tab1.layout.addWidget(self.cacheDropdown, 13, 3)
+        self.tab1.layout.addWidget(self.cacheDropdownLabel, 13, 2)
+        self.tab1.layout.addWidget(self.runButton, 14, 6)
+        self.tab1.layout.addWidget(self.resetButton, 14, 5)
+        self.tab1.layout.addWidget(self.cancelButton, 14, 4)
+        self.tab1.layout.addWidget(self.progressBar, 15, 2, 1, 5)
         self.tab1.setLayout(self.tab1.layout)
 
         # Disable/'grey-out' widgets
         self.resetButton.setDisabled(False)
         self.fileLabel1.setDisabled(True)
         self.clusterNoLabel.setDisabled(True)
+        self.cancelButton.setDisabled(True)
+        self.progressBar.setVisible(False)
             
         # Define path as empty for later use
         self.in_path = 'Empty'
@@ -132,6 +187,7 @@ class MyTableWidget(QWidget):
         self.inputClusterNo.clicked.connect(self.define_cluster_number)
         self.runButton.clicked.connect(self.run_program)
         self.resetButton.clicked.connect(self.reset_clicked)
+        self.cancelButton.clicked.connect(self.cancel_clicked)
 
         #Tab 2 - Visualiser is created in the activate_visualiser() function
 
@@ -174,7 +230,7 @@ class MyTableWidget(QWidget):
         self.loading = QLabel()
         self.gif = QMovie('./coloc/loading.gif')
         self.loading.setMovie(self.gif)
-        self.tab1.layout.addWidget(self.loading, 13, 7)
+        self.tab1.layout.addWidget(self.loading, 14, 7)
         self.gif.start()
 
     def stop_animation(self):
@@ -202,12 +258,23 @@ class MyTableWidget(QWidget):
         dict_data = {}
         dict_data["in_path"] = self.in_path
         dict_data["out_path"] = self.out_path
-        dict_data["threshold"] = float(self.thresholdDropdown.currentText())
+        if self.thresholdDropdown.currentText() == "Auto (Costes)":
+            dict_data["threshold"] = "costes"
+        else:
+            dict_data["threshold"] = float(self.thresholdDropdown.currentText())
         self.create_channels()
         dict_data["channels"] = self.channel_list
         dict_data["num_clusts"] = int(self.clusterInput)
         dict_data["min_dist"] = float(self.scaleDropdown.currentText()) #This converts scale in microns to pixel distance between clusters
         dict_data["visualise"] = True
+        # Reuse preprocessing and clustering from earlier runs on the same file, up to the chosen size on disk
+        if self.cacheDropdown.currentText() == "Off":
+            dict_data["cache_dir"] = None
+        else:
+            dict_data["cache_dir"] = CACHE_DIR
+            dict_data["cache_size"] = int(self.cacheDropdown.currentText().split()[0]) * 1024**3
+        # Hand the rendered figures to the View tab rather than reading them back from disk
+        dict_data["keep_images"] = True
         if self.kmeansCheckbox.isChecked():
             dict_data["Run KMeans"] = "Y"
         else:
@@ -289,12 +356,78 @@ class MyTableWidget(QWidget):
             self.out_path = self.out_path + "/"
             # Create the input dictionary from user inputs
             input_dict = self.create_dict()
-            # Run the image analysis using the input dictionary
-            run_visualiser(input_dict)
-            # Activate the View tab with the visualiser and cancel the loading animation
-            # when image analysis is complete
+            # Run the image analysis on a worker thread using the input dictionary
+            self.thread = QThread()
+            self.worker = AnalysisWorker(input_dict)
+            self.worker.moveToThread(self.thread)
+            self.thread.started.connect(self.worker.run)
+            self.worker.progress.connect(self.frame_complete)
+            self.worker.finished.connect(self.analysis_finished)
+            self.worker.failed.connect(self.analysis_failed)
+            self.worker.finished.connect(self.thread.quit)
+            self.worker.failed.connect(self.thread.quit)
+            self.progressBar.setValue(0)
+            self.progressBar.setFormat("Preprocessing")
+            self.progressBar.setVisible(True)
+            self.cancelButton.setDisabled(False)
+            self.thread.start()
+
+    def cancel_clicked(self):
+        '''
+        Stops the analysis after the frame currently being processed.
+        '''
+        if self.worker is not None:
+            self.worker.cancel()
+            self.cancelButton.setDisabled(True)
+            self.progressBar.setFormat("Cancelling after the current image")
+
+    def frame_complete(self, done, total, record):
+        '''
+        Updates the progress bar when a frame is complete and adds its figures to the View tab.
+        '''
+        self.progressBar.setMaximum(total)
+        self.progressBar.setValue(done)
+        self.progressBar.setFormat("Image %v of %m")
+        if record['figures']:
+            self.create_view_tab()
+            self.add_figures(record['figures'], record['frame'], record['images'])
+
+    def analysis_finished(self, complete):
+        '''
+        Called on the GUI thread when the worker has stopped, either at the end of the stack or when cancelled.
+        '''
+        self.run_stopped()
+        if complete:
+            # Activate the View tab with the visualiser when image analysis is complete
             self.activate_visualiser()
-            self.resetButton.setDisabled(False)
+        else:
+            cancelledMsg = QMessageBox()
+            cancelledMsg.setIcon(QMessageBox.Warning)
+            cancelledMsg.setText("Run Cancelled")
+            cancelledMsg.setInformativeText("Image analysis cancelled. \nResults of the images already processed are in the 'view' tab and the output directory.")
+            cancelledMsg.setWindowTitle("Cancelled")
+            cancelledMsg.exec_()
+
+    def analysis_failed(self, message):
+        '''
+        Reports an error raised during the analysis.
+        '''
+        self.run_stopped()
+        errorMsg = QMessageBox()
+        errorMsg.setIcon(QMessageBox.Critical)
+        errorMsg.setText("Run Failed")
+        errorMsg.setInformativeText(message)
+        errorMsg.setWindowTitle("Error")
+        errorMsg.exec_()
+
+    def run_stopped(self):
+        '''
+        Stops the loading animation and progress display once the worker is done.
+        '''
+        self.stop_animation()
+        self.cancelButton.setDisabled(True)
+        self.progressBar.setVisible(False)
+        self.resetButton.setDisabled(False)
 
     def activate_visualiser(self):
         '''
@@ -311,6 +444,17 @@ class MyTableWidget(QWidget):
         finishedMsg.setWindowTitle("Complete")
         finishedMsg.exec_()
 
+        self.create_view_tab()
+        if not self._filenames:
+            #Loads data in from the filepath
+            self.load_files()
+
+    def create_view_tab(self):
+        '''
+        Creates the View tab the first time it is needed.
+        '''
+        if self.tabs.indexOf(self.tab2) != -1:
+            return
         # Create Tab 2 - View
         self.tabs.addTab(self.tab2,"View")
         self.tab2.layout = QGridLayout(self)
@@ -319,21 +463,27 @@ class MyTableWidget(QWidget):
         self.previous_button = QPushButton("Previous")
         self.next_button = QPushButton("Next")
         self.label = QLabel()
+        self.zoomCheckbox = QCheckBox("Zoom and pan")
+        self.zoomCheckbox.setToolTip("Scroll to zoom into the full resolution image and drag to move around it")
+        self.tiledViewer = TiledViewer()
+        # The fixed size label and the zoomable viewer share one place in the tab
+        self.viewStack = QStackedWidget()
+        self.viewStack.addWidget(self.label)
+        self.viewStack.addWidget(self.tiledViewer)
 
         # Add widgets and define positioning on QGridLayout
         self.tab2.layout.addWidget(self.previous_button, 0, 0)
+        self.tab2.layout.addWidget(self.zoomCheckbox, 0, 1, 1, 2)
         self.tab2.layout.addWidget(self.next_button, 0, 3)
-        self.tab2.layout.addWidget(self.label, 1, 1, 1, 2)
+        self.tab2.layout.addWidget(self.viewStack, 1, 1, 1, 2)
         self.tab2.setLayout(self.tab2.layout)
 
         # Handles button click events
         self.previous_button.clicked.connect(self.handle_previous)
         self.next_button.clicked.connect(self.handle_next)
-        self._update_button_status(False, True)
+        self.zoomCheckbox.toggled.connect(self.zoom_toggled)
+        self._update_button_status(False, False)
 
-        #Loads data in from the filepath
-        self.load_files() 
-        
     
     # ------------------------
     # TAB 2 - VISUALISER FUNCTIONS
@@ -345,13 +495,32 @@ class MyTableWidget(QWidget):
         sets the index counter to 0
         '''
         self.filesPath = self.out_path
+        self._filenames = []
         for file in os.listdir(self.filesPath):
             if file.endswith(".png"):
                 self._filenames.append(os.path.join(self.filesPath, file))
+                self.figures.add(self._filenames[-1], None)
         self._filenames = sorted(self._filenames)
         print (self._filenames)
         self.current_index = 0
 
+    def add_figures(self, filenames, frame, images=None):
+        '''
+        Adds the figures of a finished frame, keeping the figures in frame order and the
+        current figure on display. Figures whose pixels are given are shown from memory.
+        '''
+        current = self._filenames[self._current_index] if self._filenames else None
+        images = images or [None] * len(filenames)
+        for filename, image in zip(filenames, images):
+            self._figure_frames[filename] = frame
+            self.figures.add(filename, image)
+        self._filenames = sorted(set(self._filenames) | set(filenames),
+                                 key=lambda f: (self._figure_frames[f], f))
+        if current is None:
+            self.current_index = 0
+        else:
+            self.current_index = self._filenames.index(current)
+
     def handle_next(self):
         '''
         Adds one to the index counter
@@ -379,18 +548,28 @@ class MyTableWidget(QWidget):
         Allows for movement between the 
         files and greying out of buttons
         '''
-        if index <= 0:
-            self._update_button_status(False, True)
-        elif index >= (len(self._filenames) - 1):
-            self._update_button_status(True, False)
-        else:
-            self._update_button_status(True, True)
+        # More files can arrive while the analysis is running, so Next stays
+        # enabled while there is a later file
+        self._update_button_status(index > 0, index < len(self._filenames) - 1)
 
         if 0 <= index < len(self._filenames):
             self._current_index = index
             filename = self._filenames[self._current_index]
-            pixmap = QPixmap(filename)
-            self.label.setPixmap(pixmap)
+            if self.zoomCheckbox.isChecked():
+                self.tiledViewer.set_image(filename, self.figures.source(filename))
+            else:
+                self.label.setPixmap(self.figures.pixmap(filename))
+            # Decode the neighbouring figures before they are asked for
+            neighbours = [index + 1, index - 1, index + 2, index - 2]
+            self.figures.prefetch([self._filenames[i] for i in neighbours
+                                   if 0 <= i < len(self._filenames)])
+
+    def zoom_toggled(self, checked):
+        '''
+        Switches between the fixed size view and the zoomable view of the current file
+        '''
+        self.viewStack.setCurrentWidget(self.tiledViewer if checked else self.label)
+        self.current_index = self.current_index
 
     def _update_button_status(self, previous_enable, next_enable):
         '''
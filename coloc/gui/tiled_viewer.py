@@ -0,0 +1,145 @@
+from collections import OrderedDict
+from functools import partial
+import numpy as np
+import cv2
+from PyQt5.QtWidgets import QGraphicsView, QGraphicsScene, QGraphicsPixmapItem
+from PyQt5.QtGui import QPixmap, QPainter, QImageReader
+from PyQt5.QtCore import Qt, QRectF
+from backend.pyramid import TILE_SIZE, lazy_pyramid, choose_level, visible_tiles, get_tile
+from gui.viewer import array_to_qimage
+
+
+def read_rgb(source):
+    '''
+    Returns the RGB pixels of a figure given as an array or a file path.
+    '''
+    if isinstance(source, np.ndarray):
+        return source
+    image = cv2.imread(source, cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Could not read %s" % source)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+def image_shape(source):
+    '''
+    Returns the height and width of a figure given as an array or a file path, reading only the file header.
+    '''
+    if isinstance(source, np.ndarray):
+        return source.shape[:2]
+    size = QImageReader(source).size()
+    if not size.isValid():
+        raise ValueError("Could not read %s" % source)
+    return size.height(), size.width()
+
+
+class TiledViewer(QGraphicsView):
+    '''
+    Zoomable and pannable view of one figure. Only the tiles of the pyramid level matching the zoom which are
+    in view are turned into pixmaps, and a level is only made, from the figure's pixels or file, when one of
+    its tiles is missing, so large figures stay responsive and memory stays bounded. Scroll to zoom and drag
+    to pan.
+    '''
+    def __init__(self, parent=None, max_tiles=128, max_pyramids=4):
+        super().__init__(parent)
+        self.setScene(QGraphicsScene(self))
+        self.setDragMode(QGraphicsView.ScrollHandDrag)
+        self.setTransformationAnchor(QGraphicsView.AnchorUnderMouse)
+        self.setRenderHint(QPainter.SmoothPixmapTransform, False)
+        self.max_tiles = max_tiles
+        self.max_pyramids = max_pyramids
+        self._pyramids = OrderedDict()
+        self._tiles = OrderedDict()
+        self._items = {}
+        self._key = None
+        # Refit when resized until the user zooms
+        self._fitted = True
+        self.horizontalScrollBar().valueChanged.connect(self.update_tiles)
+        self.verticalScrollBar().valueChanged.connect(self.update_tiles)
+
+    def pyramid(self, key, source):
+        '''
+        Returns the pyramid of a figure. Its levels are made when they are first needed.
+        '''
+        if key not in self._pyramids:
+            self._pyramids[key] = lazy_pyramid(partial(read_rgb, source), image_shape(source))
+            while len(self._pyramids) > self.max_pyramids:
+                self._pyramids.popitem(last=False)
+        self._pyramids.move_to_end(key)
+        return self._pyramids[key]
+
+    def set_image(self, key, source):
+        '''
+        Shows a figure, fitted to the view.
+        '''
+        for item in self._items.values():
+            self.scene().removeItem(item)
+        self._items = {}
+        h, w = self.pyramid(key, source).shapes[0]
+        # No tiles are made while fitting, when the view passes through full scale
+        self._key = None
+        self.scene().setSceneRect(QRectF(0, 0, w, h))
+        self.fitInView(self.scene().sceneRect(), Qt.KeepAspectRatio)
+        self._key = key
+        self._fitted = True
+        self.update_tiles()
+
+    def wheelEvent(self, event):
+        factor = 1.25 if event.angleDelta().y() > 0 else 0.8
+        # Do not zoom out further than the whole figure
+        if factor < 1 and self.transform().m11() * factor < self._fit_scale():
+            self.fitInView(self.scene().sceneRect(), Qt.KeepAspectRatio)
+            self._fitted = True
+        else:
+            self.scale(factor, factor)
+            self._fitted = False
+        self.update_tiles()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        if self._fitted and self._key is not None:
+            self.fitInView(self.scene().sceneRect(), Qt.KeepAspectRatio)
+        self.update_tiles()
+
+    def _fit_scale(self):
+        rect = self.scene().sceneRect()
+        if rect.isEmpty():
+            return 1
+        viewport = self.viewport().rect()
+        return min(viewport.width()/rect.width(), viewport.height()/rect.height())
+
+    def update_tiles(self, *args):
+        '''
+        Shows the tiles of the level matching the zoom which overlap the visible area, and removes the others.
+        '''
+        if self._key is None:
+            return
+        pyramid = self._pyramids[self._key]
+        level = choose_level(self.transform().m11(), len(pyramid))
+        factor = 2**level
+        visible = self.mapToScene(self.viewport().rect()).boundingRect()
+        rect = (visible.left()/factor, visible.top()/factor,
+                visible.right()/factor, visible.bottom()/factor)
+        wanted = {(self._key, level, row, col)
+                  for row, col in visible_tiles(pyramid.shapes[level], rect)}
+        for tile in set(self._items) - wanted:
+            self.scene().removeItem(self._items.pop(tile))
+        for tile in wanted - set(self._items):
+            _, _, row, col = tile
+            item = QGraphicsPixmapItem(self._tile_pixmap(tile, pyramid))
+            item.setTransformationMode(Qt.FastTransformation)
+            item.setScale(factor)
+            item.setPos(col*TILE_SIZE*factor, row*TILE_SIZE*factor)
+            self.scene().addItem(item)
+            self._items[tile] = item
+
+    def _tile_pixmap(self, tile, pyramid):
+        if tile in self._tiles:
+            self._tiles.move_to_end(tile)
+            return self._tiles[tile]
+        _, level, row, col = tile
+        pixmap = QPixmap.fromImage(array_to_qimage(get_tile(pyramid.level(level), row, col)))
+        self._tiles[tile] = pixmap
+        while len(self._tiles) > self.max_tiles:
+            self._tiles.popitem(last=False)
+        return pixmap
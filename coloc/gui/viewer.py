@@ -0,0 +1,113 @@
+from collections import OrderedDict
+import numpy as np
+from PyQt5.QtGui import QImage, QPixmap
+from PyQt5.QtCore import pyqtSignal, QObject, QRunnable, QThreadPool
+
+
+def array_to_qimage(array):
+    '''
+    Wraps an RGB uint8 array in a QImage without copying the pixels. The QImage keeps a reference to the
+    array so the buffer outlives it.
+    '''
+    array = np.ascontiguousarray(array, dtype=np.uint8)
+    height, width = array.shape[:2]
+    image = QImage(array.data, width, height, array.strides[0], QImage.Format_RGB888)
+    image.array = array
+    return image
+
+
+class _Loaded(QObject):
+    loaded = pyqtSignal(str, QImage)
+
+
+class _LoadImage(QRunnable):
+    '''
+    Decodes one figure on the thread pool.
+    '''
+    def __init__(self, key, source, signals):
+        super().__init__()
+        self.key = key
+        self.source = source
+        self.signals = signals
+
+    def run(self):
+        if isinstance(self.source, np.ndarray):
+            # The image sent to the GUI thread must own its pixels, as the array may be evicted from the
+            # cache before the image arrives
+            image = array_to_qimage(self.source).copy()
+        else:
+            image = QImage(self.source)
+        self.signals.loaded.emit(self.key, image)
+
+
+class FigureCache(QObject):
+    '''
+    Source of the figures shown in the View tab. Each figure comes either from the pixels handed over by the
+    analysis or from its file. Only the pixels of the last capacity figures added and the pixmaps of the last
+    capacity figures shown are kept, so memory does not grow with the depth of the stack; older figures are
+    read back from their files. The figures around the current one are decoded on a background thread ahead
+    of time.
+    '''
+    def __init__(self, capacity=16, parent=None):
+        super().__init__(parent)
+        self.capacity = capacity
+        self._images = OrderedDict()
+        self._pixmaps = OrderedDict()
+        self._pending = set()
+        self._signals = _Loaded()
+        self._signals.loaded.connect(self._store)
+        self._pool = QThreadPool()
+        self._pool.setMaxThreadCount(1)
+
+    def add(self, key, source):
+        '''
+        Registers a figure by its file path, with its pixels if they are in memory.
+        '''
+        self._pixmaps.pop(key, None)
+        if source is None:
+            self._images.pop(key, None)
+            return
+        self._images[key] = source
+        self._images.move_to_end(key)
+        while len(self._images) > self.capacity:
+            self._images.popitem(last=False)
+
+    def source(self, key):
+        '''
+        Returns the pixels of a figure if they are still in memory, otherwise its file path.
+        '''
+        return self._images.get(key, key)
+
+    def pixmap(self, key):
+        '''
+        Returns the pixmap of a figure, decoding it now if it has not been prefetched.
+        '''
+        if key in self._pixmaps:
+            self._pixmaps.move_to_end(key)
+            return self._pixmaps[key]
+        source = self.source(key)
+        if isinstance(source, np.ndarray):
+            image = array_to_qimage(source)
+        else:
+            image = QImage(source)
+        return self._store(key, image)
+
+    def prefetch(self, keys):
+        '''
+        Decodes figures in the background so they are ready when shown.
+        '''
+        for key in keys:
+            if key in self._pixmaps or key in self._pending:
+                continue
+            self._pending.add(key)
+            self._pool.start(_LoadImage(key, self.source(key), self._signals))
+
+    def _store(self, key, image):
+        # Pixmaps can only be made on the GUI thread, where this slot runs
+        self._pending.discard(key)
+        pixmap = QPixmap.fromImage(image)
+        self._pixmaps[key] = pixmap
+        self._pixmaps.move_to_end(key)
+        while len(self._pixmaps) > self.capacity:
+            self._pixmaps.popitem(last=False)
+        return pixmap
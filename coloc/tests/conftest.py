@@ -0,0 +1,17 @@
+import numpy as np
+import pytest
+import tifffile
+
+
+@pytest.fixture
+def stack_file(tmp_path):
+    """Writes stacks of random RGB frames to .tif files, by default in
+    tmp_path, and returns the path of each file and the pixels written to it.
+    Extra keyword arguments, e.g. compression='zlib', go to tifffile.imwrite.
+    """
+    def write(shape, name='stack.tif', low=0, folder=None, **kwargs):
+        stack = np.random.randint(low, 255, shape, dtype=np.uint8)
+        path = str((folder or tmp_path) / name)
+        tifffile.imwrite(path, stack, photometric='rgb', **kwargs)
+        return path, stack
+    return write
@@ -0,0 +1,82 @@
+import json
+import pytest
+try:
+    from ..batch import find_inputs, input_root, load_params, main, \
+        read_manifest, run_batch
+except ImportError:
+    from batch import find_inputs, input_root, load_params, main, \
+        read_manifest, run_batch
+
+params = {'Run Intensity Correlation Analysis': 'Y', 'Run KMeans': 'N'}
+
+
+@pytest.fixture
+def make_inputs(stack_file):
+    """Fills a new folder with n stacks and a file which is not an image."""
+    def make(folder, n):
+        folder.mkdir()
+        for i in range(n):
+            stack_file((2, 30, 30, 3), 'stack%s.tif' % i, folder=folder)
+        (folder / 'notes.txt').write_text('not an image')
+        return folder
+    return make
+
+
+def test_find_inputs(tmp_path, make_inputs):
+    folder = make_inputs(tmp_path / 'in', 2)
+    assert len(find_inputs(str(folder))) == 2
+    assert len(find_inputs(str(folder / '*1.tif'))) == 1
+
+
+def test_load_params(tmp_path):
+    path = tmp_path / 'params.json'
+    path.write_text(json.dumps({'threshold': 0.3, 'in_path': 'ignored'}))
+    loaded = load_params(str(path))
+    assert loaded['threshold'] == 0.3
+    assert 'in_path' not in loaded
+    assert loaded['Run KMeans'] == 'Y'
+
+
+def test_run_batch_resumes(tmp_path, make_inputs):
+    """Tests that completed files are recorded and skipped on a rerun."""
+    inputs = find_inputs(str(make_inputs(tmp_path / 'in', 2)))
+    out = str(tmp_path / 'out')
+    records = run_batch(inputs[:1], params, out)
+    assert [r['status'] for r in records] == ['done']
+    assert (tmp_path / 'out' / 'stack0' / '00_ICA.png').exists()
+
+    records = run_batch(inputs, params, out)
+    assert [r['file'] for r in records] == [inputs[1]]
+    assert all(r['status'] == 'done' for r in read_manifest(out).values())
+
+
+def test_run_batch_same_names(tmp_path, make_inputs):
+    """Tests that files of the same name in different folders are kept
+    apart in the output directory and the manifest."""
+    (tmp_path / 'in').mkdir()
+    for name in ['a', 'b']:
+        make_inputs(tmp_path / 'in' / name, 1)
+    pattern = str(tmp_path / 'in' / '*' / '*.tif')
+    inputs = find_inputs(pattern)
+    assert input_root(pattern) == str(tmp_path / 'in')
+    out = str(tmp_path / 'out')
+    records = run_batch(inputs, params, out, root=input_root(pattern))
+    assert sorted(r['key'] for r in records) == ['a/stack0.tif',
+                                                 'b/stack0.tif']
+    for name in ['a', 'b']:
+        assert (tmp_path / 'out' / name / 'stack0' / '00_ICA.png').exists()
+    assert run_batch(inputs, params, out) == []
+
+
+def test_main_records_failures(tmp_path, make_inputs):
+    """Tests that a failing file is recorded and does not stop the batch."""
+    folder = make_inputs(tmp_path / 'in', 1)
+    (folder / 'broken.tif').write_bytes(b'not a tiff')
+    path = tmp_path / 'params.json'
+    path.write_text(json.dumps(params))
+    out = tmp_path / 'out'
+    assert main([str(folder), '--params', str(path),
+                 '--out', str(out)]) == 1
+    statuses = {r['output'][-6:]: r['status']
+                for r in read_manifest(str(out)).values()}
+    assert statuses == {'stack0': 'done', 'broken': 'failed'}
@@ -0,0 +1,86 @@
+import copy
+import numpy as np
+import pytest
+from ..backend.classes import pipeline_object
+from ..benchmarks.synthetic import make_stack, write_stack, true_pairs, \
+    score_matches, spot_weights
+from ..benchmarks.bench import run_suite, compare, save_report, \
+    load_report, grid_cases, QUICK_GRID
+
+
+def test_make_stack():
+    stack, spots = make_stack(64, 3, 3, n_spots=4, coloc_fraction=0.5)
+    assert stack.shape == (64, 64, 3, 3) and stack.dtype == np.uint8
+    assert stack.min() > 0
+    # n_spots per frame in every channel, half of channel 0 with a partner
+    for c in range(3):
+        assert (spots['channel'] == c).sum() == 12
+    paired = spots[spots['partner'] >= 0]
+    assert len(paired) == 12
+    for spot in paired[paired['channel'] == 0]:
+        partner = spots[spots['id'] == spot['partner']][0]
+        assert partner['partner'] == spot['id']
+        assert partner['z'] == spot['z']
+        assert abs(partner['x'] - spot['x']) <= 2
+        assert abs(partner['y'] - spot['y']) <= 2
+    # Spots are drawn where the ground truth puts them
+    spot = spots[0]
+    assert stack[spot['y'], spot['x'], 0, int(spot['z'])] > 100
+    assert len(true_pairs(spots, 3)) == 6
+    assert len(true_pairs(spots, 3, frame=1)) == 2
+
+
+def test_make_stack_errors():
+    with pytest.raises(ValueError):
+        make_stack(64, 2, 1)
+    with pytest.raises(ValueError):
+        make_stack(8, 2, 2)
+
+
+def test_spot_weights():
+    assert spot_weights(np.array([1.]), 3).tolist() == [[0, 1, 0]]
+    weights = spot_weights(np.array([1.]), 3, z_sigma=1.)
+    assert weights[0, 1] == 1 and 0 < weights[0, 0] < 1
+
+
+def test_write_stack(tmp_path):
+    """Tests that a synthetic stack reads back in the pipeline layout."""
+    stack, _ = make_stack(32, 2, 2, n_spots=2)
+    path = str(tmp_path / 'stack.tif')
+    write_stack(path, stack)
+    assert np.array_equal(pipeline_object(path, str(tmp_path)).frames, stack)
+
+
+def test_score_matches():
+    expected = [(10, 10), (30, 30)]
+    assert score_matches([(11, 10), (50, 50)], expected) == \
+        {'recall': 0.5, 'precision': 0.5}
+    assert score_matches([], expected)['recall'] == 0
+
+
+def test_run_suite(tmp_path):
+    report = run_suite(QUICK_GRID, str(tmp_path), repeat=1,
+                       stages=['read', 'fit_clusters', 'render'])
+    assert [r['stage'] for r in report['results']] == \
+        ['read', 'fit_clusters', 'render']
+    assert all(r['seconds'] > 0 and r['peak_mb'] is not None
+               for r in report['results'])
+    assert report['results'][1]['calls'] == QUICK_GRID['depth'][0]
+    assert report['accuracy'][0]['recall'] > 0.5
+
+    path = str(tmp_path / 'baseline.json')
+    save_report(report, path)
+    baseline = load_report(path)
+    assert all(r['status'] == 'ok' for r in compare(baseline, report))
+    slower = copy.deepcopy(report)
+    slower['results'][1]['seconds'] = 2*baseline['results'][1]['seconds'] + 1
+    slower['results'].pop()
+    rows = {r['stage']: r['status'] for r in compare(baseline, slower)}
+    assert rows == {'read': 'ok', 'fit_clusters': 'slower',
+                    'render': 'missing'}
+
+
+def test_grid_cases():
+    cases = grid_cases({'size': [64, 128], 'depth': [2], 'channels': [2, 3]})
+    assert len(cases) == 4
+    assert cases[0] == {'size': 64, 'depth': 2, 'channels': 2}
@@ -0,0 +1,88 @@
+import os
+import time
+import numpy as np
+from ..backend.cache import file_digest, stage_cache
+from ..backend.preprocessingclass import do_preprocess
+from ..backend.Visualiser import process_frame
+
+correctpath = './coloc/tests/test-data/colocsample1bRGB_BG.tif'
+
+
+def test_key_depends_on_params(tmp_path):
+    cache = stage_cache(str(tmp_path))
+    assert cache.key('ica', a=1, b=2) == cache.key('ica', b=2, a=1)
+    assert cache.key('ica', a=1) != cache.key('ica', a=2)
+    assert cache.key('ica', a=1) != cache.key('kmeans', a=1)
+
+
+def test_put_get(tmp_path):
+    cache = stage_cache(str(tmp_path))
+    assert cache.get('missing') is None
+    cache.put('k', x=np.arange(5))
+    assert np.array_equal(cache.get('k')['x'], np.arange(5))
+
+
+def test_cached_computes_once(tmp_path):
+    cache = stage_cache(str(tmp_path))
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return {'x': np.ones(3)}
+    for _ in range(2):
+        assert np.array_equal(cache.cached('s', compute, n=1)['x'],
+                              np.ones(3))
+    assert len(calls) == 1
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = stage_cache(str(tmp_path), max_bytes=2500)
+    cache.put('old', x=np.zeros(100))
+    cache.put('new', x=np.zeros(100))
+    past = time.time() - 60
+    os.utime(cache._path('old'), (past, past))
+    cache.put('newest', x=np.zeros(100))
+    assert cache.get('old') is None
+    assert cache.get('newest') is not None
+
+
+def test_file_digest(tmp_path):
+    path = tmp_path / 'a.bin'
+    path.write_bytes(b'abc')
+    first = file_digest(str(path))
+    assert first == file_digest(str(path))
+    path.write_bytes(b'abcd')
+    assert first != file_digest(str(path))
+
+
+def test_preprocess_cache_hit(tmp_path):
+    cache = stage_cache(str(tmp_path))
+    original, _ = do_preprocess(correctpath, str(tmp_path), threshold=0.5,
+                                cache=cache)
+    cached, thresholded = do_preprocess(correctpath, str(tmp_path),
+                                        threshold=0.5, cache=cache)
+    assert np.array_equal(original.frames, cached.frames)
+    assert original.rescaled == cached.rescaled
+    assert thresholded.frames.shape == original.frames.shape
+
+
+def test_warm_start_not_cached(tmp_path, mocker):
+    """Tests that warm-started cluster centres are always computed, so the
+    warm-start state follows every frame."""
+    cache = stage_cache(str(tmp_path))
+    cached = mocker.spy(cache, 'cached')
+    im = np.zeros((40, 40, 2))
+    im[5:10, 5:10] = 1
+    im[25:30, 20:25] = 1
+    input_dict = {'out_path': str(tmp_path), 'dtype': 'float64',
+                  'channels': [0, 1], 'num_clusts': 2, 'min_dist': 5,
+                  'cluster_mode': 'kmeans', 'render': 'none',
+                  'Run Intensity Correlation Analysis': 'N',
+                  'Run KMeans': 'Y'}
+    warm = {}
+    for _ in range(2):
+        process_frame(0, im, im, input_dict, warm, cache, 'digest')
+    assert cached.call_count == 0
+    assert len(warm[0]['centres']) == 2
+    process_frame(0, im, im, input_dict, None, cache, 'digest')
+    assert cached.call_count == 1
@@ -0,0 +1,146 @@
+import json
+import os
+import pickle
+import numpy as np
+import pytest
+from ..backend.instrument import run_log
+from ..backend.Visualiser import run_visualiser
+
+
+def test_stage_records(tmp_path):
+    path = str(tmp_path / 'log.jsonl')
+    log = run_log(path)
+    with log.stage('read', bytes_read=10, items=2):
+        pass
+    with log.stage('render', 3) as stage:
+        stage['bytes_written'] += 5
+    log.close()
+    with open(path) as f:
+        lines = [json.loads(line) for line in f]
+    assert [r['stage'] for r in lines] == ['read', 'render']
+    assert lines[0]['bytes_read'] == 10 and lines[0]['items'] == 2
+    assert lines[1]['frame'] == 3 and lines[1]['bytes_written'] == 5
+    assert all(r['wall'] >= 0 and r['cpu'] >= 0 for r in lines)
+    assert log.read() == lines
+
+
+def test_summary():
+    log = run_log()
+    for n in range(3):
+        with log.stage('ica', n, items=10):
+            pass
+    totals = log.summary()
+    assert list(totals) == ['ica']
+    assert totals['ica']['calls'] == 3 and totals['ica']['items'] == 30
+
+
+def test_stage_error():
+    """Tests that a stage is recorded even if it raises."""
+    log = run_log()
+    with pytest.raises(ValueError):
+        with log.stage('kmeans'):
+            raise ValueError
+    assert log.records[0]['stage'] == 'kmeans'
+
+
+def test_pickle(tmp_path):
+    """Tests that a log sent to another process appends to the same file."""
+    path = str(tmp_path / 'log.jsonl')
+    log = run_log(path, 'ica')
+    with log.stage('read'):
+        pass
+    copy = pickle.loads(pickle.dumps(log))
+    assert copy.path == path and copy.profile == 'ica'
+    assert copy.records == []
+    with copy.stage('match'):
+        pass
+    copy.close()
+    assert [r['stage'] for r in log.read()] == ['read', 'match']
+
+
+def test_memory(tmp_path):
+    """Tests that a log kept in memory writes nothing and hands its records
+    over."""
+    path = str(tmp_path / 'log.jsonl')
+    log = pickle.loads(pickle.dumps(run_log(path, memory=True)))
+    with log.stage('kmeans', 0):
+        pass
+    assert not os.path.exists(path)
+    records = log.take()
+    assert [r['stage'] for r in records] == ['kmeans'] and log.records == []
+
+
+def test_read_run(tmp_path):
+    """Tests that only the records of the current run are read back."""
+    path = str(tmp_path / 'log.jsonl')
+    first = run_log(path)
+    with first.stage('read'):
+        pass
+    first.close()
+    second = run_log(path)
+    assert second.run != first.run
+    with second.stage('match'):
+        pass
+    second.close()
+    assert [r['stage'] for r in second.read()] == ['match']
+    assert [r['stage'] for r in first.read()] == ['read']
+
+
+def test_profile(tmp_path):
+    log = run_log(str(tmp_path / 'log.jsonl'), 'ica')
+    with log.stage('ica'):
+        np.linalg.svd(np.ones((20, 20)))
+    with log.stage('render'):
+        pass
+    profiles = [f for f in os.listdir(str(tmp_path)) if f.endswith('.prof')]
+    assert profiles == ['profile_ica_%s.prof' % os.getpid()]
+
+
+def test_run_log(tmp_path, stack_file):
+    path, _ = stack_file((2, 40, 40, 3))
+    input_dict = {'in_path': path,
+                  'out_path': str(tmp_path),
+                  'num_clusts': 3,
+                  'Run Intensity Correlation Analysis': 'Y',
+                  'Run KMeans': 'Y'}
+    # A second run appends to the same log, and is totalled on its own
+    run_visualiser(dict(input_dict))
+    run_visualiser(dict(input_dict))
+    with open(str(tmp_path / 'run_log.jsonl')) as f:
+        records = [json.loads(line) for line in f]
+    runs = list(dict.fromkeys(r['run'] for r in records))
+    assert len(runs) == 2
+    log = run_log(str(tmp_path / 'run_log.jsonl'), run=runs[-1])
+    totals = log.summary(log.read())
+    for stage in ['read', 'normalise', 'metrics', 'ica', 'kmeans', 'match',
+                  'render', 'export']:
+        assert stage in totals
+    assert totals['ica']['calls'] == 2
+    assert totals['read']['bytes_read'] == os.path.getsize(path)
+    assert totals['render']['bytes_written'] > 0
+
+
+@pytest.mark.parametrize('write_log', [True, False])
+def test_run_log_parallel(tmp_path, stack_file, write_log, capsys):
+    """Tests that the stages run on worker processes are in the totals
+    printed at the end of a run, whether or not the log file is written."""
+    path, _ = stack_file((4, 40, 40, 3), low=1)
+    run_visualiser({'in_path': path,
+                    'out_path': str(tmp_path),
+                    'num_clusts': 3,
+                    'n_workers': 2,
+                    'run_log': write_log,
+                    'render': 'none',
+                    'export': [],
+                    'Run Intensity Correlation Analysis': 'Y',
+                    'Run KMeans': 'Y'})
+    summary = capsys.readouterr().out.split('Stage timings')[-1]
+    totals = {line.split()[0]: int(line.split()[1])
+              for line in summary.strip().splitlines()[1:]}
+    assert totals['kmeans'] == totals['ica'] == totals['scale'] == 4
+    if write_log:
+        with open(str(tmp_path / 'run_log.jsonl')) as f:
+            records = [json.loads(line) for line in f]
+        # Records of the workers are written to the file by this process
+        assert len([r for r in records if r['stage'] == 'kmeans']) == 4
+        assert len({r['pid'] for r in records}) > 1
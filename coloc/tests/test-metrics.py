@@ -0,0 +1,96 @@
+import pytest
+import numpy as np
+try:
+    from ..backend.metrics import coloc_metrics, costes_threshold, costes_thresholds, coloc_accumulator
+except ModuleNotFoundError:
+    from backend.metrics import coloc_metrics, costes_threshold, costes_thresholds, coloc_accumulator
+
+
+def reference(x, y, t1=0, t2=0):
+    """Colocalisation coefficients computed directly from their definitions."""
+    dx, dy = x - x.mean(), y - y.mean()
+    return {'pearson': np.corrcoef(x.ravel(), y.ravel())[0, 1],
+            'm1': x[y > t2].sum()/x.sum(),
+            'm2': y[x > t1].sum()/y.sum(),
+            'icq': np.mean(dx*dy > 0) - 0.5,
+            'ica': np.sum(dx*dy)}
+
+
+@pytest.mark.parametrize('block', [2, 16])
+def test_coloc_metrics(block):
+    """Tests every coefficient against its definition, per frame and for the
+    whole stack."""
+    stack = np.random.rand(20, 25, 3, 5)
+    stack[stack < 0.3] = 0
+    per_frame, volume = coloc_metrics(stack, [0, 2], (0.1, 0.2), block=block)
+    for n in range(5):
+        expected = reference(stack[:, :, 0, n], stack[:, :, 2, n], 0.1, 0.2)
+        for key, value in expected.items():
+            assert np.isclose(per_frame[key][n], value)
+    expected = reference(stack[:, :, 0], stack[:, :, 2], 0.1, 0.2)
+    for key, value in expected.items():
+        assert np.isclose(volume[key], value)
+
+
+def test_coloc_metrics_identical():
+    """Tests that identical channels are perfectly colocalised."""
+    stack = np.random.rand(10, 10, 2, 3)
+    stack[:, :, 1] = stack[:, :, 0]
+    per_frame, volume = coloc_metrics(stack)
+    np.testing.assert_allclose(per_frame['pearson'], 1)
+    assert np.isclose(volume['m1'], 1) and np.isclose(volume['m2'], 1)
+    with pytest.raises(ValueError):
+        coloc_metrics(stack, [0, 1, 2])
+
+
+def test_coloc_accumulator():
+    """Tests that coefficients collected block by block match
+    coloc_metrics, with the whole-stack ICQ within the histogram's error."""
+    stack = np.random.rand(40, 40, 2, 6)
+    stack[stack < 0.3] = 0
+    per_frame, volume = coloc_metrics(stack)
+    coefficients = coloc_accumulator(6, [(0, 1), (0, 1)])
+    for start in [4, 0]:
+        frames = slice(start, min(start + 4, 6))
+        coefficients.add(stack[:, :, 0, frames], stack[:, :, 1, frames],
+                         frames)
+    found = coefficients.result()
+    for key in per_frame:
+        np.testing.assert_allclose(found[0][key], per_frame[key])
+        tolerance = 0.01 if key == 'icq' else 1e-9
+        assert abs(found[1][key] - volume[key]) <= \
+            tolerance*max(1, abs(volume[key]))
+    # Frames never added are left out
+    partial = coloc_accumulator(6, [(0, 1), (0, 1)])
+    partial.add(stack[:, :, 0, :2], stack[:, :, 1, :2], slice(0, 2))
+    per_frame, volume = partial.result()
+    assert np.isnan(per_frame['pearson'][2:]).all()
+    assert np.isclose(volume['m1'], coloc_metrics(stack[..., :2])[1]['m1'])
+
+
+def test_costes_threshold():
+    """Tests that pixels below the Costes thresholds are uncorrelated and the
+    thresholds lie above the background."""
+    rng = np.random.default_rng(0)
+    signal = rng.random(50000)*(rng.random(50000) < 0.2)
+    x = np.clip(signal + rng.normal(0.2, 0.05, 50000), 0, None)
+    y = np.clip(0.8*signal + rng.normal(0.3, 0.05, 50000), 0, None)
+    t1, t2 = costes_threshold(x, y)
+    assert 0.2 < t1 < 0.5 and 0.3 < t2 < 0.6
+    below = (x < t1) | (y < t2)
+    assert abs(np.corrcoef(x[below], y[below])[0, 1]) < 0.05
+
+
+def test_costes_threshold_uncorrelated():
+    """Tests that nothing is removed from anti-correlated channels."""
+    x = np.linspace(0, 1, 1000)
+    assert costes_threshold(x, 1 - x) == (0.0, 0.0)
+
+
+def test_costes_thresholds_stack():
+    """Tests that a threshold is found for both channels of every frame."""
+    stack = np.random.rand(30, 30, 3, 4)
+    stack[:, :, 1] = stack[:, :, 0]*0.5 + np.random.rand(30, 30, 4)*0.1
+    thresholds = costes_thresholds(stack, [0, 1], bins=64)
+    assert thresholds.shape == (2, 4)
+    assert np.all(np.isfinite(thresholds))
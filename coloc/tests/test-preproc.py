@@ -1,5 +1,10 @@
+import cv2
 import pytest
 from ..backend.classes import pipeline_object
+from ..backend.reader import read_header
+from ..backend.preprocessingclass import do_preprocess
+from ..backend.resample import resample_frames
+from ..backend.stream import stream_pipeline
 import os
 import random
 import numpy as np
@@ -87,3 +92,178 @@ def test_pipeline_visualise(mocker):
     #     patched.assert_called()
 
  
+
+
+def test_pipeline_lazy_memmap():
+    """Tests that the memory-mapped stack matches the fully read stack."""
+    eager = pipeline_object(correctpath, filepath)
+    lazy = pipeline_object(correctpath, filepath, lazy=True)
+    assert lazy.frames.shape == eager.frames.shape
+    assert not lazy.frames.flags.writeable
+    np.testing.assert_array_equal(lazy.frames[:, :, :, 4],
+                                  eager.frames[:, :, :, 4])
+    eager.reshape()
+    lazy.reshape()
+    np.testing.assert_array_equal(lazy.frames, eager.frames)
+
+
+def test_pipeline_lazy_compressed(tmp_path, stack_file):
+    """Tests that compressed stacks are decoded page by page on demand."""
+    path, stack = stack_file((5, 20, 30, 3), 'compressed.tif',
+                             compression='zlib')
+
+    test_obj = pipeline_object(path, str(tmp_path), lazy=True)
+    assert test_obj.frames.shape == (20, 30, 3, 5)
+    np.testing.assert_array_equal(test_obj.frames[:, :, :, 2], stack[2])
+    np.testing.assert_array_equal(test_obj.frames[2:4, :, 1, 1:3],
+                                  np.moveaxis(stack[1:3, 2:4, :, 1], 0, -1))
+    np.testing.assert_array_equal(np.asarray(test_obj.frames),
+                                  np.moveaxis(stack, 0, -1))
+
+
+def test_pipeline_close(tmp_path, stack_file):
+    """Tests that the file of a lazy stack is closed once it is loaded."""
+    path, _ = stack_file((3, 20, 20, 3), 'compressed.tif', low=1,
+                         compression='zlib')
+    with pipeline_object(path, str(tmp_path), lazy=True) as test_obj:
+        handle = test_obj.frames._tif.filehandle
+        test_obj.reshape()
+        test_obj.normalise_all()
+    assert handle.closed
+    assert test_obj.frames.shape == (20, 20, 3, 3)
+    original, _ = do_preprocess(path, str(tmp_path), lazy=True)
+    assert original._source is None
+
+
+def test_read_header():
+    """Tests that the header is parsed without decoding and is cached."""
+    header = read_header(correctpath)
+    assert header.shape == (152, 172, 3, 33)
+    assert header.dtype == np.uint8
+    assert header.page_count == 33
+    assert not header.compressed
+    assert header.memmappable
+    assert read_header(correctpath) is header
+    assert pipeline_object(correctpath, filepath).frames.shape == header.shape
+
+
+def test_do_preprocess_shared_decode():
+    """Tests that the derived thresholded stack matches thresholding a
+    separately processed stack."""
+    original, full = do_preprocess(correctpath, filepath, threshold=0.3)
+    expected = pipeline_object(correctpath, filepath, 0.3)
+    expected.reshape()
+    expected.normalise_all()
+
+    assert full.threshold == 0.3
+    assert full.frames.shape == expected.frames.shape
+    np.testing.assert_array_equal(full.frames[:, :, :, 2],
+                                  expected.frames[:, :, :, 2])
+    np.testing.assert_array_equal(full.frames[5, :, 1, 2],
+                                  expected.frames[5, :, 1, 2])
+    np.testing.assert_array_equal(np.asarray(full.frames), expected.frames)
+    assert original.frames is full.frames.frames
+
+
+@pytest.mark.parametrize('n_jobs', [1, 3])
+def test_resample_frames(n_jobs):
+    """Tests that batched resizing matches resizing each channel separately."""
+    stack = np.random.randint(0, 255, (30, 40, 3, 4), dtype=np.uint8)
+    out = resample_frames(stack, 30, dtype=np.float32, n_jobs=n_jobs)
+    assert out.shape == (30, 30, 3, 4)
+    assert out.dtype == np.float32
+    for i in range(4):
+        for j in range(3):
+            expected = cv2.resize(np.ascontiguousarray(stack[:, :, j, i]),
+                                  (30, 30), interpolation=cv2.INTER_CUBIC)
+            np.testing.assert_allclose(out[:, :, j, i], expected, atol=1)
+
+
+def test_resample_frames_square():
+    """Tests that square stacks are not resized."""
+    stack = np.random.rand(20, 20, 2, 3)
+    assert resample_frames(stack, 20) is stack
+    buffer = np.zeros((20, 20, 2, 3), dtype=np.float32)
+    assert resample_frames(stack, 20, out=buffer) is buffer
+    np.testing.assert_allclose(buffer, stack, rtol=1e-6)
+    with pytest.raises(ValueError):
+        resample_frames(stack, 10, out=buffer)
+
+
+@pytest.mark.parametrize('policy, work, out',
+    [('float64', np.float64, np.int64),
+     ('float32', np.float32, np.int32),
+     ('native', np.float32, np.uint8)
+    ]
+)
+def test_pipeline_dtype_policy(policy, work, out):
+    """Tests that the dtype policy is carried through preprocessing."""
+    reference, _ = do_preprocess(correctpath, filepath, threshold=0.5)
+    original, full = do_preprocess(correctpath, filepath, threshold=0.5,
+                                   dtype=policy)
+    assert original.frames.dtype == work
+    assert full.scaled(3).dtype == out
+    assert full.scaled(3).shape == full.frames.shape[:3]
+    np.testing.assert_allclose(original.frames, reference.frames, atol=1e-5)
+    assert np.abs(original.scaled(3).astype(int) -
+                  reference.scaled(3)).max() <= 1
+
+
+def test_pipeline_dtype_invalid():
+    """Tests that unknown dtype policies are rejected."""
+    with pytest.raises(ValueError):
+        pipeline_object(correctpath, filepath, dtype='float16')
+
+
+def test_do_preprocess_costes():
+    """Tests that automatic thresholds are found and applied per frame."""
+    original, full = do_preprocess(correctpath, filepath, threshold='costes',
+                                   channels=[0, 1])
+    assert full.threshold == 'costes'
+    assert full.thresholds.shape == (3, 33)
+    assert np.all(np.isneginf(full.thresholds[2]))
+    frame = full.frames[:, :, :, 7]
+    below = original.frames[:, :, 0, 7] < full.thresholds[0, 7]
+    assert np.all(frame[:, :, 0][below] == 0)
+    np.testing.assert_array_equal(frame[:, :, 2], original.frames[:, :, 2, 7])
+    with pytest.raises(TypeError):
+        do_preprocess(correctpath, filepath, threshold='otsu')
+
+
+def test_rethreshold_changed_frames():
+    """Tests that a new threshold is applied to the retained normalised stack
+    and that only frames whose mask changed are reported."""
+    original, full = do_preprocess(correctpath, filepath, threshold=0.5)
+    retrimmed = full.thresholded(0.3)
+    assert retrimmed.frames.frames is original.frames
+    np.testing.assert_array_equal(
+        np.asarray(retrimmed.frames),
+        np.asarray(original.thresholded(0.3).frames))
+    assert full.frames.changed_frames(full.frames.with_threshold(0.5)) == []
+    changed = full.frames.changed_frames(retrimmed.frames)
+    for n in range(original.frames.shape[-1]):
+        differs = not np.array_equal(full.frames[:, :, :, n],
+                                     retrimmed.frames[:, :, :, n])
+        assert differs == (n in changed)
+
+
+@pytest.mark.parametrize('threshold', [0.5, 'costes', False])
+def test_stream_pipeline_matches(threshold):
+    """Tests that streaming a window of frames at a time gives the same
+    stack as preprocessing it all at once."""
+    original, full = do_preprocess(correctpath, filepath, threshold=threshold)
+    stream = stream_pipeline(correctpath, threshold=threshold, window=5)
+    assert stream.shape == original.frames.shape
+    assert stream.rescaled == original.rescaled
+    np.testing.assert_array_equal(stream[:, :, :, :], np.asarray(full.frames))
+    np.testing.assert_array_equal(stream[3, :, 1, 7], full.frames[3, :, 1, 7])
+    for n, orig, denoised in stream.frames():
+        np.testing.assert_array_equal(orig, original.scaled(n))
+        np.testing.assert_array_equal(denoised, full.scaled(n))
+
+
+def test_stream_pipeline_errors():
+    with pytest.raises(ValueError):
+        stream_pipeline(correctpath, window=0)
+    with pytest.raises(TypeError):
+        stream_pipeline(correctpath, threshold='otsu')
@@ -0,0 +1,55 @@
+import cv2
+import numpy as np
+import pytest
+from ..backend.pyramid import level_shapes, lazy_pyramid, choose_level, \
+    visible_tiles, get_tile
+
+
+def test_level_shapes():
+    assert level_shapes((1000, 600, 3), 256) == \
+        [(1000, 600), (500, 300), (250, 150)]
+    assert level_shapes((1001, 600), 256) == \
+        [(1001, 600), (501, 300), (251, 150)]
+    assert level_shapes((100, 100, 3), 256) == [(100, 100)]
+
+
+def test_lazy_pyramid():
+    image = np.random.randint(0, 255, (2000, 1200, 3), dtype=np.uint8)
+    shapes = level_shapes(image.shape, 256)
+    # Each level is the one before halved
+    expected = [image]
+    for h, w in shapes[1:]:
+        expected.append(cv2.resize(expected[-1], (w, h),
+                                   interpolation=cv2.INTER_AREA))
+    loads = []
+
+    def load():
+        loads.append(1)
+        return image
+
+    pyramid = lazy_pyramid(load, image.shape, tile_size=256)
+    assert len(pyramid) == len(shapes) == 4 and not loads
+    for n in [3, 2, 1, 0, 1, 2, 3]:
+        np.testing.assert_array_equal(pyramid.level(n), expected[n])
+    # The image is loaded for the first level and again for the full image,
+    # and every other level is made from a finer one that is kept
+    assert len(loads) == 2
+    # Coarse levels are always kept, and only one of levels 0 and 1
+    assert sorted(pyramid._levels) == [1, 2, 3]
+
+
+@pytest.mark.parametrize('scale, level',
+    [(2, 0), (1, 0), (0.6, 0), (0.5, 1), (0.3, 1), (0.2, 2), (0.001, 2)])
+def test_choose_level(scale, level):
+    assert choose_level(scale, 3) == level
+
+
+def test_visible_tiles():
+    shape = (600, 1000)
+    assert visible_tiles(shape, (0, 0, 100, 100), 256) == [(0, 0)]
+    assert visible_tiles(shape, (250, 250, 600, 260), 256) == \
+        [(0, 0), (0, 1), (0, 2), (1, 0), (1, 1), (1, 2)]
+    # Rectangles reaching past the image only cover existing tiles
+    assert len(visible_tiles(shape, (-50, -50, 5000, 5000), 256)) == 3*4
+    tile = get_tile(np.zeros(shape), 2, 3, 256)
+    assert tile.shape == (600 - 512, 1000 - 768)
@@ -0,0 +1,41 @@
+import cv2
+import numpy as np
+import pytest
+from ..backend.render import to_rgb8, render_panels, overlay_ica, \
+    overlay_kmeans, MIN_PANEL_SIZE
+from ..backend.Visualiser import compare_dists
+
+
+@pytest.mark.parametrize('channels', [1, 2, 3, 4])
+def test_to_rgb8(channels):
+    frame = np.full((5, 6, channels), 300, dtype=np.int64)
+    rgb = to_rgb8(frame)
+    assert rgb.shape == (5, 6, 3)
+    assert rgb.dtype == np.uint8
+    assert rgb.max() == 255
+    if channels == 2:
+        assert not rgb[:, :, 2].any()
+
+
+def test_render_panels_circles():
+    """Tests that circles are drawn at the cluster position in both panels."""
+    im = np.zeros((20, 20, 3), dtype=int)
+    empty = render_panels(im, im, None, 'Title')
+    drawn = render_panels(im, im, [(10, 5)], 'Title')
+    assert empty.shape == drawn.shape
+    assert empty.shape[1] > 2*MIN_PANEL_SIZE
+    changed = np.argwhere(np.any(empty != drawn, axis=2))
+    # One circle in each half of the canvas
+    middle = empty.shape[1]//2
+    assert (changed[:, 1] < middle).any() and (changed[:, 1] > middle).any()
+
+
+def test_overlays_saved(tmp_path):
+    im = np.random.randint(0, 255, (30, 40, 3))
+    overlay_ica(im, im, [(3, 4), (10, 12)], str(tmp_path), '/ica')
+    pairs = compare_dists([(5, 5)], [(5, 6)], 5)
+    overlay_kmeans(im, im, pairs, str(tmp_path), '/pairs', compression=9)
+    overlay_kmeans(im, im, None, str(tmp_path), '/none')
+    for name in ['ica', 'pairs', 'none']:
+        image = cv2.imread(str(tmp_path / (name + '.png')))
+        assert image is not None and image.ndim == 3
@@ -0,0 +1,97 @@
+import csv
+import json
+import os
+import numpy as np
+import pytest
+from ..backend.results import results_writer, frame_record, load_results
+from ..backend.Visualiser import compare_dists, run_visualiser, \
+    render_results
+
+
+def make_record(n):
+    record = frame_record(n)
+    record['ica_sum'] = 2.5
+    record['ica_peaks'] = [(1, 2), (3, 4)]
+    record['clusters'] = {0: np.array([[5., 5.]]), 1: np.array([[5., 6.]])}
+    record['pairs'] = compare_dists([(5, 5)], [(5, 6)], 5)
+    return record
+
+
+def test_results_writer(tmp_path):
+    writer = results_writer(str(tmp_path))
+    writer.add(make_record(1), {'pearson': 0.5})
+    writer.add(frame_record(0))
+    paths = writer.write({'pearson': 0.25, 'icq': np.nan})
+    assert len(paths) == 6
+
+    with open(str(tmp_path / 'pairs.csv')) as f:
+        rows = list(csv.DictReader(f))
+    assert len(rows) == 1 and float(rows[0]['distance']) == 1
+    with open(str(tmp_path / 'results.json')) as f:
+        data = json.load(f)
+    assert data['volume']['pearson'] == 0.25
+    assert data['frames']['frame'] == [0, 1]
+    # Missing values are null rather than NaN, which is not valid JSON
+    assert data['volume']['icq'] is None
+    assert data['frames']['ica_sum'][0] is None
+    tables = load_results(str(tmp_path))
+    assert tables['frames']['n_pairs'].tolist() == [0, 1]
+    assert tables['frames']['pearson'][1] == 0.5
+    assert len(tables['ica_peaks']) == 2
+    assert len(tables['clusters']) == 2
+
+
+def test_costes_thresholds(tmp_path, stack_file):
+    """Tests that the Costes threshold of each channel is exported with the
+    frames table and read back."""
+    path, _ = stack_file((3, 40, 40, 3), low=1)
+    input_dict = {'in_path': path,
+                  'out_path': str(tmp_path),
+                  'threshold': 'costes',
+                  'render': 'none',
+                  'Run Intensity Correlation Analysis': 'Y',
+                  'Run KMeans': 'N'}
+    records = run_visualiser(dict(input_dict))
+    frames = load_results(str(tmp_path))['frames']
+    for c in [0, 1]:
+        np.testing.assert_array_equal(
+            frames['costes_threshold_%s' % c],
+            [r['thresholds'][c] for r in records])
+    assert np.all(np.isfinite(frames['costes_threshold_0']))
+    with open(str(tmp_path / 'frames.csv')) as f:
+        assert 'costes_threshold_1' in next(csv.reader(f))
+    # The streamed run saves the same thresholds
+    run_visualiser(dict(input_dict, stream=True, window=2))
+    np.testing.assert_allclose(
+        load_results(str(tmp_path))['frames']['costes_threshold_1'],
+        frames['costes_threshold_1'])
+    # Fixed thresholds add no columns
+    run_visualiser(dict(input_dict, threshold=0.5))
+    assert 'costes_threshold_0' not in \
+        load_results(str(tmp_path))['frames'].dtype.names
+
+
+def test_results_writer_formats(tmp_path):
+    with pytest.raises(ValueError):
+        results_writer(str(tmp_path), ['xlsx'])
+    writer = results_writer(str(tmp_path), ['json'])
+    writer.add(make_record(0))
+    assert writer.write() == [str(tmp_path / 'results.json')]
+
+
+def test_deferred_render(tmp_path, stack_file):
+    """Tests that no figures are drawn until render_results is called."""
+    path, _ = stack_file((3, 40, 40, 3))
+    input_dict = {'in_path': path,
+                  'out_path': str(tmp_path),
+                  'render': 'deferred',
+                  'num_clusts': 3,
+                  'Run Intensity Correlation Analysis': 'Y',
+                  'Run KMeans': 'Y'}
+    run_visualiser(dict(input_dict))
+    assert not [f for f in os.listdir(str(tmp_path)) if f.endswith('.png')]
+    assert len(load_results(str(tmp_path))['frames']) == 3
+    render_results(input_dict, frames=[1])
+    assert (tmp_path / '01_ICA.png').exists()
+    assert (tmp_path / '01_kmeans.png').exists()
+    assert not (tmp_path / '00_ICA.png').exists()
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+from ..backend.spots import detect_spots
+from ..backend.Visualiser import fit_clusters, get_colocs, run_visualiser
+from ..benchmarks.synthetic import make_stack, write_stack, true_pairs, \
+    score_matches
+
+
+def blob(shape, centre, sigma=2., amplitude=100.):
+    rows, cols = np.indices(shape)
+    return amplitude*np.exp(-((rows - centre[0])**2 + (cols - centre[1])**2)
+                            / (2*sigma**2))
+
+
+def test_detect_spots():
+    im = blob((40, 40), (10, 12)) + blob((40, 40), (30, 25))
+    im[im < 20] = 0
+    spots = detect_spots(im)
+    assert len(spots) == 2
+    assert np.allclose(spots['row'], [10, 30])
+    assert np.allclose(spots['col'], [12, 25])
+    assert spots['area'].sum() == np.count_nonzero(im)
+    assert np.isclose(spots['intensity'].sum(), im.sum())
+
+
+def test_touching_spots():
+    """Tests that one patch of foreground with two maxima is split."""
+    im = blob((30, 40), (15, 14)) + blob((30, 40), (15, 20))
+    im[im < 10] = 0
+    assert np.count_nonzero(np.diff(im[15] > 0)) == 2
+    spots = detect_spots(im)
+    assert len(spots) == 2
+    assert np.allclose(np.sort(spots['col']), [14, 20], atol=0.5)
+    assert spots['area'].sum() == np.count_nonzero(im)
+
+
+def test_plateau():
+    im = np.zeros((10, 10))
+    im[3:6, 3:6] = 5
+    spots = detect_spots(im, sigma=0)
+    assert len(spots) == 1 and spots[0]['area'] == 9
+    assert spots[0]['row'] == 4 and spots[0]['col'] == 4
+
+
+def test_detect_spots_edge_cases():
+    assert len(detect_spots(np.zeros((8, 8)))) == 0
+    im = np.zeros((8, 8))
+    im[1, 1] = 1
+    im[5:7, 5:7] = 1
+    assert len(detect_spots(im)) == 2
+    assert len(detect_spots(im, min_area=2)) == 1
+    with pytest.raises(ValueError):
+        detect_spots(np.zeros((8, 8, 2)))
+
+
+def test_spots_mode():
+    stack, spots = make_stack(128, 1, 2, n_spots=8, seed=6)
+    im = stack[:, :, :, 0].astype(float)
+    im[im < 70] = 0
+    centres = fit_clusters(im[:, :, 0], 3, mode='spots')
+    # Every spot is found, whatever the number of clusters asked for
+    assert centres.shape == (8, 2)
+    pairs = get_colocs(im, [0, 1], 3, 5, mode='spots')
+    assert score_matches(pairs['centroid'], true_pairs(spots, 1, 0)) == \
+        {'recall': 1., 'precision': 1.}
+    with pytest.raises(ValueError):
+        fit_clusters(np.ones((8, 8)), 3, mode='spots')
+
+
+def test_run_spots(tmp_path):
+    stack, _ = make_stack(64, 2, 2, n_spots=4, seed=5)
+    path = str(tmp_path / 'stack.tif')
+    write_stack(path, stack)
+    input_dict = {'in_path': path,
+                  'out_path': str(tmp_path),
+                  'cluster_mode': 'spots',
+                  'render': 'none',
+                  'Run Intensity Correlation Analysis': 'N',
+                  'Run KMeans': 'Y'}
+    records = run_visualiser(input_dict)
+    assert all(len(r['pairs']) > 0 for r in records)
@@ -1,10 +1,17 @@
 import pytest
 import numpy as np
 import matplotlib.pyplot as plt
+from sklearn.cluster import KMeans
 try:
-    from ..backend.Visualiser import correlate, fit_clusters, run_visualiser, annotate, scaled_dist, compare_dists
+    from ..backend.Visualiser import correlate, fit_clusters, run_visualiser, annotate, scaled_dist, compare_dists, ica_stack, select_cluster_mode, stratified_subsample, plot_kmeans, run_frames_parallel, run_stream, print_metrics
+    from ..backend.preprocessingclass import do_preprocess
+    from ..backend.reader import lazy_stack
+    from ..backend import classes
 except ModuleNotFoundError:
-    from backend.Visualiser import correlate, fit_clusters, run_visualiser, annotate, scaled_dist, compare_dists
+    from backend.Visualiser import correlate, fit_clusters, run_visualiser, annotate, scaled_dist, compare_dists, ica_stack, select_cluster_mode, stratified_subsample, plot_kmeans, run_frames_parallel, run_stream, print_metrics
+    from backend.preprocessingclass import do_preprocess
+    from backend.reader import lazy_stack
+    from backend import classes
 
 
 # Tests for visualiser.py
@@ -52,8 +59,11 @@ class Vistest():
         clust1 = [(1,1),(10,10),(20,20),(40,40)]
         clust2 = [(1,1),(10,10),(20,20)]
 
-        with pytest.raises(ValueError):
-            compare_dists(clust1, clust2, 5)
+        # Unequal numbers of clusters are matched
+        pairs = compare_dists(clust1, clust2, 5)
+        assert len(pairs) == 3
+        np.testing.assert_array_equal(pairs['index1'], [0, 1, 2])
+        np.testing.assert_array_equal(pairs['centroid'], clust2)
 
         
     
@@ -87,6 +97,11 @@ class Vistest():
         with pytest.raises(KeyError):
             run_visualiser(tdict5)
 
+        tdict6=self.testdict.copy()
+        tdict6['cluster_mode']='spot'
+        with pytest.raises(ValueError):
+            run_visualiser(tdict6)
+
 vis = Vistest()
 vis.test_correlate()
 vis.test_fit_clusters()
@@ -119,3 +134,198 @@ def test_annotate_circle(test):
 # def test_scale_dist(test, expected):
 #     pix_dist = 1
 #     assert scaled_dist(test) == expected
+
+
+def test_ica_stack():
+    """Tests that the vectorised ICA matches a per-pixel computation."""
+    stack = np.random.randint(0, 255, size=(30, 40, 3, 5))
+    sums, peaks = ica_stack(stack, [0, 2], 4, block=2)
+    assert sums.shape == (5,)
+    assert peaks.shape == (5, 4, 2)
+    for n in range(5):
+        chan1, chan2 = stack[:, :, 0, n], stack[:, :, 2, n]
+        out = (chan1 - np.mean(chan1)) * (chan2 - np.mean(chan2))
+        assert np.isclose(sums[n], np.sum(out))
+        expected = np.sort(out.ravel())[-4:]
+        np.testing.assert_allclose(out[peaks[n, :, 0], peaks[n, :, 1]],
+                                   expected)
+        assert correlate(stack[:, :, :, n], [0, 2], 4) == \
+            [tuple(p) for p in peaks[n]]
+
+
+def test_fit_clusters_modes():
+    """Tests every clustering backend finds separated blobs."""
+    im = np.zeros((100, 100))
+    im[10:20, 10:20] = 1
+    im[70:80, 60:70] = 1
+    for mode in ['kmeans', 'subsample', 'minibatch', 'auto']:
+        centres = sorted(map(tuple, fit_clusters(im, 2, mode)))
+        assert np.allclose(centres, [(14, 14), (74, 64)], atol=1)
+    with pytest.raises(ValueError):
+        fit_clusters(im, 2, 'dbscan')
+
+
+def test_select_cluster_mode():
+    assert select_cluster_mode(100) == 'kmeans'
+    assert select_cluster_mode(10**5) == 'subsample'
+    assert select_cluster_mode(10**7) == 'minibatch'
+
+
+def test_stratified_subsample():
+    """Tests that the subsample keeps the spatial distribution of points."""
+    points = np.argwhere(np.ones((100, 100)))
+    sample = stratified_subsample(points, (100, 100), 1000, grid=4,
+                                  random_state=0)
+    assert 1000 <= len(sample) <= 1100
+    counts, _, _ = np.histogram2d(sample[:, 0], sample[:, 1], bins=4,
+                                  range=[[0, 100], [0, 100]])
+    assert counts.min() >= 60
+
+
+def test_fit_clusters_warm_start(mocker):
+    """Tests that adjacent slices are seeded with the previous centroids,
+    unless the foreground changes too much."""
+    im = np.zeros((100, 100))
+    im[10:20, 10:20] = 1
+    im[70:80, 60:70] = 1
+    warm = {}
+    first = fit_clusters(im, 2, 'kmeans', warm)
+    assert warm['n_points'] == 200
+    spy = mocker.spy(KMeans, '__init__')
+    second = fit_clusters(im, 2, 'kmeans', warm)
+    assert spy.call_args.kwargs['n_init'] == 1
+    np.testing.assert_array_equal(first, second)
+
+    im[30:60, 30:60] = 1
+    fit_clusters(im, 2, 'kmeans', warm)
+    assert spy.call_args.kwargs['n_init'] == 5
+    assert warm['n_points'] == 1100
+
+
+def test_compare_dists_modes():
+    """Tests all-within-radius and one-to-one matching."""
+    clust1 = [(0, 0), (0, 4)]
+    clust2 = [(0, 1), (0, 3), (50, 50)]
+    pairs = compare_dists(clust1, clust2, 5)
+    assert len(pairs) == 4
+    np.testing.assert_allclose(pairs['distance'], [1, 3, 3, 1])
+    np.testing.assert_array_equal(pairs['centroid'][0], [0, 0])
+
+    pairs = compare_dists(clust1, clust2, 5, mode='one_to_one')
+    assert sorted(zip(pairs['index1'], pairs['index2'])) == [(0, 0), (1, 1)]
+    assert len(compare_dists(clust1, [], 5)) == 0
+    assert len(compare_dists(clust1, clust2, 1)) == 0
+
+
+def test_plot_kmeans(tmp_path):
+    """Tests that matched pairs are drawn from the structured array."""
+    im = np.zeros((20, 20, 3), dtype=int)
+    pairs = compare_dists([(5, 5)], [(5, 6)], 5)
+    plot_kmeans(im, im, pairs, str(tmp_path), '/pairs')
+    plot_kmeans(im, im, None, str(tmp_path), '/none')
+    assert (tmp_path / 'pairs.png').exists()
+
+
+def test_run_visualiser_lazy(tmp_path, stack_file, mocker):
+    """Tests that lazy runs read the stack through a memory map or a lazy
+    stack rather than decoding it all up front."""
+    opened = mocker.spy(classes, 'open_frames')
+    input_dict = {'out_path': str(tmp_path),
+                  'lazy': True,
+                  'render': 'none',
+                  'export': [],
+                  'Run Intensity Correlation Analysis': 'Y',
+                  'Run KMeans': 'N'}
+    # Uncompressed stacks are memory-mapped, compressed ones decoded lazily
+    for name, kwargs, backing in [
+            ('plain.tif', {}, np.memmap),
+            ('compressed.tif', {'compression': 'zlib'}, lazy_stack)]:
+        path, _ = stack_file((3, 40, 40, 3), name, **kwargs)
+        records = run_visualiser(dict(input_dict, in_path=path))
+        assert len(records) == 3
+        assert isinstance(opened.spy_return, backing)
+    assert opened.call_count == 2
+    with pytest.raises(ValueError):
+        run_visualiser(dict(input_dict, in_path=path, lazy='yes'))
+
+
+def test_run_visualiser_parallel(tmp_path, stack_file):
+    """Tests that frames processed on worker processes are all saved."""
+    path, _ = stack_file((4, 40, 40, 3))
+    run_visualiser({'in_path': path,
+                    'out_path': str(tmp_path),
+                    'n_workers': 2,
+                    'Run Intensity Correlation Analysis': 'Y',
+                    'Run KMeans': 'N'})
+    saved = sorted(p.name for p in tmp_path.glob('*.png'))
+    assert saved == ['0%s_ICA.png' % n for n in range(4)]
+
+
+def test_run_visualiser_parallel_progress(tmp_path, stack_file):
+    """Tests that frames processed on worker processes are reported one at
+    a time, and that a run stopped after the first frame stops there."""
+    path, _ = stack_file((5, 40, 40, 3))
+    input_dict = {'in_path': path,
+                  'out_path': str(tmp_path),
+                  'n_workers': 2,
+                  'warm_start': True,
+                  'render': 'none',
+                  'export': [],
+                  'Run Intensity Correlation Analysis': 'Y',
+                  'Run KMeans': 'N'}
+    calls = []
+    records = run_visualiser(dict(input_dict), progress=lambda done, total,
+                             record: calls.append((done, total,
+                                                   record['frame'])))
+    assert [(done, total) for done, total, _ in calls] == \
+        [(n, 5) for n in range(1, 6)]
+    assert sorted(frame for _, _, frame in calls) == list(range(5))
+    assert len(records) == 5
+    stopped = run_visualiser(dict(input_dict), should_stop=lambda: True)
+    assert len(stopped) == 1
+
+
+def test_run_frames_parallel_blocks(tmp_path, stack_file):
+    """Tests that copying the stack to shared memory a few frames at a time
+    gives the same results as processing every frame in this process."""
+    path, _ = stack_file((5, 40, 40, 3), low=1)
+    input_dict = {'in_path': path,
+                  'out_path': str(tmp_path),
+                  'render': 'none',
+                  'export': [],
+                  'Run Intensity Correlation Analysis': 'Y',
+                  'Run KMeans': 'N'}
+    # run_visualiser fills in the defaults of the other settings
+    serial = run_visualiser(input_dict)
+    original, preprocessed = do_preprocess(path, str(tmp_path),
+                                           threshold=0.5)
+    parallel = run_frames_parallel(original, preprocessed,
+                                   input_dict, 2, block=2)
+    parallel = sorted(parallel, key=lambda r: r['frame'])
+    assert [r['ica_peaks'] for r in parallel] == \
+        [r['ica_peaks'] for r in serial]
+
+
+def test_run_stream_metrics(tmp_path, stack_file):
+    """Tests that the coefficients collected while streaming match those of
+    the whole stack, and that streaming runs on one process only."""
+    path, _ = stack_file((6, 40, 40, 3), low=1)
+    input_dict = {'in_path': path,
+                  'out_path': str(tmp_path),
+                  'stream': True,
+                  'window': 4,
+                  'render': 'none',
+                  'export': [],
+                  'Run Intensity Correlation Analysis': 'Y',
+                  'Run KMeans': 'N'}
+    records = run_visualiser(input_dict)
+    assert [r['frame'] for r in records] == list(range(6))
+    _, metrics = run_stream(input_dict)
+    _, preprocessed = do_preprocess(path, str(tmp_path), threshold=0.5)
+    expected = print_metrics(preprocessed.frames, [0, 1])
+    for key in expected[0]:
+        np.testing.assert_allclose(metrics[0][key], expected[0][key])
+    assert np.isclose(metrics[1]['pearson'], expected[1]['pearson'])
+    assert abs(metrics[1]['icq'] - expected[1]['icq']) < 0.01
+    with pytest.raises(ValueError):
+        run_visualiser(dict(input_dict, n_workers=2))
@@ -0,0 +1,119 @@
+import os
+import numpy as np
+import pytest
+from scipy.spatial import cKDTree
+from ..backend.volume import find_objects, match_objects, match_points, \
+    z_scale, volume_colocalisation, write_objects
+from ..backend.Visualiser import run_visualiser
+from ..benchmarks.synthetic import make_stack, write_stack, true_pairs, \
+    score_matches
+
+
+def test_find_objects():
+    stack = np.zeros((10, 10, 4))
+    # An object spanning three frames and a single voxel
+    stack[2:4, 2:4, 0:3] = 1
+    stack[3, 3, 1] = 3
+    stack[8, 7, 3] = 2
+    objects = find_objects(stack, channel=1, z_scale=2.)
+    assert len(objects) == 2
+    big, small = objects
+    assert big['voxels'] == 12 and big['volume'] == 24
+    assert big['intensity'] == 14
+    assert big['channel'] == 1 and big['z'] == 1
+    assert small['x'] == 7 and small['y'] == 8 and small['z'] == 3
+    assert len(find_objects(stack, min_voxels=2)) == 1
+
+
+def test_connectivity():
+    stack = np.zeros((5, 5, 2))
+    stack[1, 1, 0] = stack[2, 2, 1] = 1
+    assert len(find_objects(stack)) == 2
+    assert len(find_objects(stack, connectivity=3)) == 1
+    with pytest.raises(ValueError):
+        find_objects(stack, connectivity=4)
+    with pytest.raises(ValueError):
+        find_objects(stack[:, :, 0])
+
+
+def test_z_scale():
+    assert z_scale(100) == 1
+    # 0.5 um pixels and frames 2 um apart
+    assert z_scale(100, scale=50, z_step=2) == 4
+    with pytest.raises(ValueError):
+        z_scale(100, z_step=2)
+
+
+def test_match_objects():
+    objects = np.zeros(2, dtype=find_objects(np.zeros((2, 2, 2))).dtype)
+    objects['x'], objects['z'] = [0, 10], [0, 0]
+    others = objects.copy()
+    others['z'] = [1, 5]
+    pairs = match_objects(objects, others, 3)
+    assert len(pairs) == 1 and pairs[0]['distance'] == 1
+    assert pairs[0]['centroid'].tolist() == [0, 0, 0.5]
+    # Frames further apart than the pixels pull objects apart
+    assert len(match_objects(objects, others, 3, z_scale=4)) == 0
+    assert len(match_objects(objects, others[:0], 3)) == 0
+
+
+def test_match_points():
+    points = np.array([[0., 0.], [1., 0.]])
+    others = np.array([[0.5, 0.], [5., 5.]])
+    assert match_points(points, others, 1)[['i', 'j']].tolist() == \
+        [(0, 0), (1, 0)]
+    # Each point is used at most once, closest pairs first
+    assert len(match_points(points, others, 1, 'one_to_one')) == 1
+    assert len(match_points(points[:, :1], others[:, :1], 10)) == 4
+    with pytest.raises(ValueError):
+        match_points(points, others, 1, 'nearest')
+
+
+def test_volume_colocalisation(tmp_path):
+    """Tests that puncta spanning frames are found once, and matched."""
+    stack, spots = make_stack(96, 6, 2, n_spots=2, z_sigma=1., seed=0)
+    stack = stack.astype(float)
+    stack[stack < 60] = 0
+    objects, pairs = volume_colocalisation(stack, [0, 1], 5)
+    for c in [0, 1]:
+        truth, found = spots[spots['channel'] == c], \
+            objects[objects['channel'] == c]
+        assert len(found) == len(truth)
+        # Centroids are recovered in x, y and z
+        distance = cKDTree(np.stack([found['x'], found['y'], found['z']],
+                                    axis=-1)).query(
+            np.stack([truth['x'], truth['y'], truth['z']], axis=-1))[0]
+        assert distance.max() < 0.5
+    assert objects['voxels'].min() > 5
+    found = pairs['centroid'][:, :2]
+    assert score_matches(found, true_pairs(spots, 6)) == \
+        {'recall': 1., 'precision': 1.}
+    paths = write_objects(str(tmp_path), objects, pairs, {'pearson': 0.5})
+    assert len(paths) == 4
+    with np.load(str(tmp_path / 'objects.npz')) as data:
+        assert len(data['objects']) == len(objects)
+        assert len(data['object_pairs']) == len(pairs)
+
+
+def test_volume_mode(tmp_path):
+    stack, spots = make_stack(64, 6, 2, n_spots=3, z_sigma=1., seed=3)
+    path = str(tmp_path / 'stack.tif')
+    write_stack(path, stack)
+    input_dict = {'in_path': path,
+                  'out_path': str(tmp_path),
+                  'mode': 'volume',
+                  'threshold': 0.3,
+                  'min_dist': 5,
+                  'scale': 32.,
+                  'z_step': 0.5,
+                  'Run Intensity Correlation Analysis': 'Y',
+                  'Run KMeans': 'Y'}
+    records = run_visualiser(input_dict)
+    assert len(records) == 1 and records[0]['frame'] is None
+    assert len(records[0]['pairs']) > 0
+    for name in ['objects.csv', 'object_pairs.csv', 'volume_objects.png']:
+        assert os.path.exists(str(tmp_path / name))
+    with pytest.raises(ValueError):
+        run_visualiser(dict(input_dict, stream=True))
+    with pytest.raises(ValueError):
+        run_visualiser(dict(input_dict, scale=None))